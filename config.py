@@ -7,13 +7,78 @@ load_dotenv(os.path.join(basedir, ".env"))
 
 
 class Config:
+    # The editor autosaves once typing has stopped for AUTOSAVE_IDLE_SECONDS,
+    # or AUTOSAVE_MAX_WAIT_SECONDS after the first unsaved edit if it hasn't
+    AUTOSAVE_IDLE_SECONDS = float(os.environ.get("AUTOSAVE_IDLE_SECONDS") or 3)
+    AUTOSAVE_MAX_WAIT_SECONDS = float(os.environ.get("AUTOSAVE_MAX_WAIT_SECONDS") or 30)
+    # With the job queue on, seconds an autosaved draft waits to be rendered so
+    # a burst of autosaves is rendered once
+    AUTOSAVE_RENDER_DELAY = float(os.environ.get("AUTOSAVE_RENDER_DELAY") or 5)
+    # With the job queue on, seconds to collect new comments into one email, 0
+    # sends one per comment
+    COMMENT_DIGEST_INTERVAL = float(os.environ.get("COMMENT_DIGEST_INTERVAL") or 0)
+    IMAGE_UPLOAD_MAX_BYTES = int(
+        os.environ.get("IMAGE_UPLOAD_MAX_BYTES") or 16 * 1024 * 1024
+    )
+    IMAGE_VARIANT_CACHE_DIR = os.environ.get("IMAGE_VARIANT_CACHE_DIR") or os.path.join(
+        basedir, "cache", "variants"
+    )
+    IMAGE_VARIANT_CACHE_MAX_BYTES = int(
+        os.environ.get("IMAGE_VARIANT_CACHE_MAX_BYTES") or 512 * 1024 * 1024
+    )
+    # Variants are named after the upload, which could be deleted and uploaded
+    # again with different content, so they can't be cached forever
+    IMAGE_VARIANT_MAX_AGE = int(
+        os.environ.get("IMAGE_VARIANT_MAX_AGE") or 30 * 24 * 60 * 60
+    )
+    JOB_BATCH_SIZE = int(os.environ.get("JOB_BATCH_SIZE") or 10)
+    # Threads per process that run deferred tasks when the job queue is off
+    JOB_LOCAL_WORKERS = int(os.environ.get("JOB_LOCAL_WORKERS") or 2)
+    JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS") or 5)
+    JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL") or 1)
+    # Defer comment language checks, draft rendering and notification mail to
+    # `flask run-jobs` workers rather than doing them in the request
+    JOB_QUEUE_ENABLED = os.environ.get("JOB_QUEUE_ENABLED") == "1"
+    JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY") or 10)
+    # Seconds a claimed job is hidden from other workers, one still running
+    # after this is assumed lost and run again
+    JOB_VISIBILITY_TIMEOUT = float(os.environ.get("JOB_VISIBILITY_TIMEOUT") or 300)
     MAIL_SERVER = os.environ.get("MAIL_SERVER") or "smtp.googlemail.com"
     MAIL_PORT = os.environ.get("MAIL_PORT") or 587
     MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS") or 1
     MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
     MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+    MAIL_QUEUE_SIZE = int(os.environ.get("MAIL_QUEUE_SIZE") or 100)
+    # Seconds a sender waits for room on a full queue before dropping mail
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get("MAIL_QUEUE_TIMEOUT") or 5)
+    MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE") or 20)
+    MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS") or 4)
+    MAIL_RETRY_DELAY = float(os.environ.get("MAIL_RETRY_DELAY") or 1)
+    # Seconds without mail before the SMTP connection is closed
+    MAIL_IDLE_TIMEOUT = float(os.environ.get("MAIL_IDLE_TIMEOUT") or 30)
+    MAIL_DRAIN_TIMEOUT = float(os.environ.get("MAIL_DRAIN_TIMEOUT") or 10)
+    # Room for the rest of the upload form, larger requests are turned away
+    # before they're read
+    MAX_CONTENT_LENGTH = IMAGE_UPLOAD_MAX_BYTES + 64 * 1024
+    METRICS_ENABLED = (os.environ.get("METRICS_ENABLED") or "1") == "1"
+    # Behind a reverse proxy every request looks local so this is off by default
+    METRICS_ALLOW_LOCALHOST = os.environ.get("METRICS_ALLOW_LOCALHOST") == "1"
+    PREVIEW_CACHE_SIZE = int(os.environ.get("PREVIEW_CACHE_SIZE") or 100)
     RECAPTCHA_PUBLIC_KEY = os.environ.get("RECAPTCHA_PUBLIC_KEY")
     RECAPTCHA_PRIVATE_KEY = os.environ.get("RECAPTCHA_PRIVATE_KEY")
+    # "simple" caches per process, so pages changed by other processes (other
+    # web workers, job workers, `flask` commands) are only seen once their
+    # cached copy is RESPONSE_CACHE_TTL seconds old. "filesystem" is shared by
+    # every process on a host.
+    RESPONSE_CACHE_TYPE = os.environ.get("RESPONSE_CACHE_TYPE") or "null"
+    RESPONSE_CACHE_MAX_BYTES = int(
+        os.environ.get("RESPONSE_CACHE_MAX_BYTES") or 64 * 1024 * 1024
+    )
+    RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR") or os.path.join(
+        basedir, "cache", "responses"
+    )
+    RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL") or 60)
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND") or "auto"
     SECRET_KEY = os.environ.get("SECRET_KEY") or "ISolemnlySwearImUpToNoGood"
     SENTRY_DSN = os.environ.get("SENTRY_DSN")
     SERVER_NAME = os.environ.get("SERVER_NAME")
@@ -23,9 +88,15 @@ class Config:
     ) or "sqlite:///" + os.path.join(basedir, "dtns.db")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = "uploads"
+    # Uploads still processing after this many seconds are marked failed, the
+    # process working on them has likely been restarted
+    UPLOAD_PROCESSING_TIMEOUT = float(
+        os.environ.get("UPLOAD_PROCESSING_TIMEOUT") or 600
+    )
 
 
 class TestingConfig(Config):
+    RESPONSE_CACHE_TYPE = "null"
     SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_TEST_DATABASE_URI")
     TESTING = True
     WTF_CSRF_ENABLED = False
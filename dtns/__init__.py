@@ -9,12 +9,23 @@ from flask_sqlalchemy import SQLAlchemy
 from sentry_sdk.integrations.flask import FlaskIntegration
 
 from config import config
-
+from dtns.utils import lang_utils
+from dtns.utils.asset_utils import Assets
+from dtns.utils.cache_utils import ResponseCache
+from dtns.utils.mail_queue_utils import MailQueue
+from dtns.utils.metrics_utils import Metrics
+from dtns.utils.preview_utils import PreviewCache
+
+assets = Assets()
 db = SQLAlchemy()
 login_manager = LoginManager()
 mail = Mail()
+mail_queue = MailQueue()
+metrics = Metrics()
 migrate = Migrate()
 moment = Moment()
+preview_cache = PreviewCache()
+response_cache = ResponseCache()
 toolbar = DebugToolbarExtension()
 
 
@@ -32,13 +43,26 @@ def create_app(testing_config=None):
     else:
         app.config.from_object(config["testing"])
 
+    if app.config["COMMENT_DIGEST_INTERVAL"] and not app.config["JOB_QUEUE_ENABLED"]:
+        app.logger.warning(
+            "COMMENT_DIGEST_INTERVAL needs JOB_QUEUE_ENABLED, new comment emails "
+            "will be sent one per comment"
+        )
+
+    assets.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
+    metrics.init_app(app)
     migrate.init_app(app, db)
     moment.init_app(app)
+    preview_cache.init_app(app)
+    response_cache.init_app(app)
     toolbar.init_app(app)
 
+    lang_utils.get_factory()
+
     from dtns.routes import main
 
     app.register_blueprint(main)
@@ -51,6 +75,12 @@ def create_app(testing_config=None):
 
     app.register_blueprint(ajax)
 
+    from dtns.commands import render_posts
+    from dtns.commands import run_jobs
+
+    app.cli.add_command(render_posts)
+    app.cli.add_command(run_jobs)
+
     from dtns import models  # noqa: F401
 
     if app.debug:
@@ -2,13 +2,25 @@ from datetime import datetime
 from urllib.parse import unquote
 
 from flask import Blueprint
+from flask import abort
 from flask import current_app
+from flask import make_response
 from flask import render_template
 from flask import request
 from flask_login.utils import login_required
 
+from dtns import preview_cache
+from dtns.constants import COMMENT_STATUS_STYLE
+from dtns.constants import POST_STATUS_STYLE
+from dtns.model_storage import CommentModelStorage
 from dtns.model_storage import PostModelStorage
+from dtns.model_storage import UploadModelStorage
+from dtns.routes import get_site_validators
+from dtns.utils import http_utils
 from dtns.utils import image_utils
+from dtns.utils import post_utils
+from dtns.utils import preview_utils
+from dtns.utils.post_utils import InvalidCursorError
 
 ajax = Blueprint("ajax", __name__)
 
@@ -23,6 +35,7 @@ def search_posts():
 
 
 @ajax.route("/posts/<month_year>")
+@http_utils.conditional(get_site_validators)
 def posts_month_year(month_year):
     posts = PostModelStorage.get_posts_by_month_year(unquote(month_year))
     return render_template(
@@ -30,6 +43,58 @@ def posts_month_year(month_year):
     )
 
 
+@ajax.route("/load-more/posts")
+@http_utils.conditional(get_site_validators)
+def load_more_posts():
+    try:
+        posts, next_cursor = PostModelStorage.get_published_posts_page(
+            request.args["cursor"]
+        )
+    except InvalidCursorError:
+        abort(400)
+    return render_template(
+        "components/post-page.html", posts=posts, next_cursor=next_cursor
+    )
+
+
+@ajax.route("/load-more/admin/posts")
+@login_required
+def load_more_admin_posts():
+    try:
+        posts, next_cursor = PostModelStorage.get_posts_page_ordered_by_updated_at(
+            request.args["cursor"], **post_utils.get_listing_filters(request.args)
+        )
+    except InvalidCursorError:
+        abort(400)
+    return render_template(
+        "components/admin-post-rows.html",
+        posts=posts,
+        next_cursor=next_cursor,
+        POST_STATUS_STYLE=POST_STATUS_STYLE,
+    )
+
+
+@ajax.route("/load-more/admin/comments")
+@login_required
+def load_more_admin_comments():
+    user_id = request.args.get("user_id", type=int)
+    try:
+        comments, next_cursor = CommentModelStorage.get_page(
+            request.args["cursor"],
+            user_id=user_id,
+            **post_utils.get_listing_filters(request.args),
+        )
+    except InvalidCursorError:
+        abort(400)
+    return render_template(
+        "components/admin-comment-rows.html",
+        comments=comments,
+        next_cursor=next_cursor,
+        user_id=user_id,
+        COMMENT_STATUS_STYLE=COMMENT_STATUS_STYLE,
+    )
+
+
 @ajax.route("/save/<post_id>", methods=["POST"])
 @login_required
 def save_post(post_id):
@@ -40,15 +105,39 @@ def save_post(post_id):
         "source": request.form["source"],
     }
 
-    PostModelStorage.edit_post(post_id, data)
+    saved = PostModelStorage.edit_post(post_id, data, autosave=True)
+
+    if saved:
+        message = f"Saved at { datetime.utcnow().strftime('%H:%M:%S') }!"
+    else:
+        message = "No changes to save!"
 
     return render_template(
         "components/alert.html",
         category="success",
-        message=f"Saved at { datetime.utcnow().strftime('%H:%M:%S') }!",
+        message=message,
     )
 
 
+@ajax.route("/preview", methods=["POST"])
+@login_required
+def preview_post():
+    key = preview_utils.get_preview_key(request.form.get("editor", ""))
+    try:
+        source = preview_cache.get_source(key, request.form)
+    except preview_utils.StalePreviewError:
+        abort(409)
+    except preview_utils.InvalidPatchError:
+        abort(400)
+
+    preview = preview_cache.render(key, source)
+    response = make_response(
+        render_template("components/post-content.html", html=preview.html)
+    )
+    response.headers["X-Preview-Hash"] = preview.source_hash
+    return response
+
+
 @ajax.route("/image-manager/sort")
 @login_required
 def sort_image_manager_images():
@@ -63,6 +152,22 @@ def sort_image_manager_images():
 def delete_image_manager_image():
     image = request.args["image"]
     image_manager = image_utils.ImageManager(current_app)
-    image_manager.delete_image(image)
+    if image_manager.delete_image(image):
+        UploadModelStorage.delete_upload(image)
     image_list = image_manager.get_all_images()
     return render_template("components/image-list.html", image_list=image_list)
+
+
+@ajax.route("/image-manager/uploads/<int:upload_id>")
+@login_required
+def upload_progress(upload_id):
+    """
+    Polled by the image manager until the upload has been processed, or has
+    taken so long it never will be
+    """
+    upload = UploadModelStorage.get(upload_id)
+    if not upload:
+        abort(404)
+    if upload.is_stalled:
+        UploadModelStorage.fail_upload(upload.id, "Processing didn't finish")
+    return render_template("components/upload-progress.html", upload=upload)
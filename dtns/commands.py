@@ -0,0 +1,216 @@
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam
+from sqlalchemy import or_
+
+from dtns import db
+from dtns import response_cache
+from dtns import tasks  # noqa: F401
+from dtns.models import Post
+from dtns.utils import render_utils
+from dtns.utils.job_utils import JobWorker
+
+RENDER_BATCH_SIZE = 100
+
+
+def render_batch(posts):
+    """
+    Render a batch of (id, source) rows. Runs in a worker process, so it only
+    uses render_utils and never touches the database.
+    """
+    return [
+        {
+            "_id": post_id,
+            "_source": source,
+            "html": render_utils.render_source(source),
+            "source_hash": render_utils.hash_source(source),
+            "renderer_version": render_utils.RENDERER_VERSION,
+        }
+        for post_id, source in posts
+    ]
+
+
+def iter_post_batches(batch_size, only_stale):
+    """
+    Yield batches of (id, source) rows in id order, a batch at a time so
+    every post is never loaded at once.
+    """
+    query = db.session.query(Post.id, Post.source)
+    if only_stale:
+        query = query.filter(
+            or_(
+                Post.renderer_version.is_(None),
+                Post.renderer_version != render_utils.RENDERER_VERSION,
+            )
+        )
+
+    last_id = 0
+    while True:
+        batch = (
+            query.filter(Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+        )
+        if not batch:
+            return
+        yield [tuple(row) for row in batch]
+        last_id = batch[-1].id
+
+
+def write_rendered(rendered):
+    """
+    Save a rendered batch with a single executemany UPDATE and return how
+    many posts were written. Rows are written directly so updated_at and the
+    search index are left alone. A post whose source was edited since it was
+    read is skipped, its edit has rendered it or will.
+    """
+    if not rendered:
+        return 0
+    result = db.session.execute(
+        Post.__table__.update()
+        .where(Post.id == bindparam("_id"), Post.source == bindparam("_source"))
+        .values(
+            html=bindparam("html"),
+            source_hash=bindparam("source_hash"),
+            renderer_version=bindparam("renderer_version"),
+        ),
+        rendered,
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def render_posts_in_pool(batches, workers):
+    """
+    Render batches across a process pool, keeping a couple of batches per
+    worker in flight, and yield each rendered batch as it completes.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for batch in batches:
+            pending.add(executor.submit(render_batch, batch))
+            if len(pending) < workers * 2:
+                continue
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+        for future in pending:
+            yield future.result()
+
+
+@click.command("render-posts")
+@click.option(
+    "--only-stale",
+    is_flag=True,
+    help="Only render posts rendered with an older renderer version.",
+)
+@click.option(
+    "--workers",
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of processes to render with. 1 renders in this process.",
+)
+@click.option(
+    "--batch-size",
+    default=RENDER_BATCH_SIZE,
+    show_default=True,
+    help="Number of posts read, rendered and written at a time.",
+)
+@with_appcontext
+def render_posts(only_stale, workers, batch_size):
+    """
+    Re-render the html of every post from its markdown source.
+    """
+    start = time.perf_counter()
+    batches = iter_post_batches(batch_size, only_stale)
+    if workers > 1:
+        rendered_batches = render_posts_in_pool(batches, workers)
+    else:
+        rendered_batches = map(render_batch, batches)
+
+    num_posts = 0
+    num_skipped = 0
+    for rendered in rendered_batches:
+        num_written = write_rendered(rendered)
+        num_posts += num_written
+        num_skipped += len(rendered) - num_written
+
+    if num_posts:
+        response_cache.invalidate()
+
+    elapsed = time.perf_counter() - start
+    rate = num_posts / elapsed if elapsed else 0
+    click.echo(f"Rendered {num_posts} posts in {elapsed:.2f}s ({rate:.1f} posts/s)")
+    if num_skipped:
+        click.echo(f"Skipped {num_skipped} posts edited while they were rendering")
+
+
+def run_worker(app, burst):
+    """
+    Run a job worker in this process until it's stopped, or with burst until
+    no job is ready. SIGTERM stops it once the jobs it has claimed have run.
+    """
+    worker = JobWorker(app)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    worker.run(burst)
+    click.echo(
+        f"{worker.name} ran {worker.num_done} jobs, "
+        f"{worker.num_failed} failed for good"
+    )
+
+
+def run_forked_worker(app, burst):
+    # Connections inherited from the parent can't be shared with it
+    with app.app_context():
+        db.engine.dispose()
+    run_worker(app, burst)
+
+
+@click.command("run-jobs")
+@click.option(
+    "--processes",
+    default=1,
+    show_default=True,
+    help="Number of worker processes. 1 runs the worker in this process.",
+)
+@click.option(
+    "--burst",
+    is_flag=True,
+    help="Exit once no job is ready rather than waiting for more.",
+)
+@with_appcontext
+def run_jobs(processes, burst):
+    """
+    Run queued jobs.
+    """
+    app = current_app._get_current_object()
+    if processes <= 1:
+        return run_worker(app, burst)
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=run_forked_worker, args=(app, burst))
+        for _ in range(processes)
+    ]
+    for process in workers:
+        process.start()
+
+    def stop_workers(signum, frame):
+        for process in workers:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    for process in workers:
+        process.join()
+
+    if any(process.exitcode for process in workers):
+        raise click.ClickException("A worker process exited with an error")
@@ -1,16 +1,31 @@
 class CommentState:
     HIDDEN = "hidden"
+    PENDING = "pending"
     VISIBLE = "visible"
 
 
+class JobState:
+    FAILED = "failed"
+    QUEUED = "queued"
+    RUNNING = "running"
+
+
 class PostStatus:
     ARCHIVED = "archived"
     DRAFT = "draft"
     PUBLISHED = "published"
 
 
+class UploadState:
+    DONE = "done"
+    FAILED = "failed"
+    PROCESSING = "processing"
+    QUEUED = "queued"
+
+
 COMMENT_STATUS_STYLE = {
     CommentState.HIDDEN: "badge bg-danger",
+    CommentState.PENDING: "badge bg-warning text-dark",
     CommentState.VISIBLE: "badge bg-success",
 }
 
@@ -21,3 +36,10 @@ POST_STATUS_STYLE = {
 }
 
 ALLOWABLE_IMAGE_TYPES = [".jpg", ".jpeg", ".png", ".gif"]
+
+# Widths and formats uploads can be resized and converted to, by extension
+IMAGE_VARIANT_WIDTHS = (320, 640, 960, 1280, 1920)
+IMAGE_VARIANT_FORMATS = {"jpg": "JPEG", "webp": "WEBP"}
+
+POSTS_PER_PAGE = 10
+ADMIN_ROWS_PER_PAGE = 50
@@ -14,6 +14,11 @@ def page_not_found(error):
     return render_template("errors/404.html"), 404
 
 
+@error.app_errorhandler(413)
+def request_entity_too_large(error):
+    return render_template("errors/413.html"), 413
+
+
 @error.app_errorhandler(500)
 def internal_service_error(error):
     return render_template("errors/500.html"), 500
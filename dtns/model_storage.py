@@ -1,17 +1,31 @@
 from datetime import datetime
 
+from flask import current_app
+from sqlalchemy import and_
 from sqlalchemy import asc
 from sqlalchemy import desc
 from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload
 
 from dtns import db
+from dtns import response_cache
+from dtns.constants import ADMIN_ROWS_PER_PAGE
+from dtns.constants import POSTS_PER_PAGE
 from dtns.constants import CommentState
 from dtns.constants import PostStatus
+from dtns.constants import UploadState
 from dtns.models import Comment
 from dtns.models import Post
+from dtns.models import PostArchiveMonth
+from dtns.models import SearchTerm
+from dtns.models import Upload
 from dtns.models import User
 from dtns.utils import email_utils
+from dtns.utils import job_utils
 from dtns.utils import post_utils
+from dtns.utils import search_utils
 
 
 class BaseModelStorage:
@@ -40,6 +54,46 @@ class BaseModelStorage:
         if len(obj) == 1:
             return obj[0]
 
+    @classmethod
+    def _get_page(cls, query, sort_column, cursor, per_page, oldest_first=False):
+        """
+        Return a page of rows ordered newest first by sort_column, id, or
+        oldest first, and the cursor for the next page (None on the last
+        page).
+
+        Rows are selected relative to the last row of the previous page
+        rather than with an OFFSET so every page costs the same.
+        """
+        order = asc if oldest_first else desc
+        if cursor:
+            last_sort_value, last_id = post_utils.decode_cursor(cursor)
+            if oldest_first:
+                after = or_(
+                    sort_column > last_sort_value,
+                    and_(sort_column == last_sort_value, cls.model.id > last_id),
+                )
+            else:
+                after = or_(
+                    sort_column < last_sort_value,
+                    and_(sort_column == last_sort_value, cls.model.id < last_id),
+                )
+            query = query.filter(after)
+
+        rows = (
+            query.order_by(order(sort_column), order(cls.model.id))
+            .limit(per_page + 1)
+            .all()
+        )
+        if len(rows) <= per_page:
+            return rows, None
+
+        rows = rows[:per_page]
+        last_row = rows[-1]
+        next_cursor = post_utils.encode_cursor(
+            getattr(last_row, sort_column.key), last_row.id
+        )
+        return rows, next_cursor
+
 
 class PostModelStorage(BaseModelStorage):
     model = Post
@@ -55,6 +109,32 @@ class PostModelStorage(BaseModelStorage):
             .all()
         )
 
+    @classmethod
+    def get_published_posts_page(cls, cursor=None, per_page=POSTS_PER_PAGE):
+        """
+        Return a page of published posts ordered by published date and the
+        cursor for the next page.
+        """
+        return cls._get_page(
+            cls.model.query.filter_by(state=PostStatus.PUBLISHED),
+            Post.published_at,
+            cursor,
+            per_page,
+        )
+
+    @classmethod
+    def get_post_archive(cls):
+        """
+        Return (month year, number of published posts) for each month with
+        published posts, most recent first.
+        """
+        return [
+            (archive_month.month_year, archive_month.num_posts)
+            for archive_month in PostArchiveMonth.query.order_by(
+                desc(PostArchiveMonth.month)
+            )
+        ]
+
     @classmethod
     def get_recent_posts(cls):
         """
@@ -71,6 +151,67 @@ class PostModelStorage(BaseModelStorage):
     def get_all_posts_ordered_by_updated_at(cls):
         return cls.model.query.order_by(desc("updated_at")).all()
 
+    @classmethod
+    def get_posts_page_ordered_by_updated_at(
+        cls,
+        cursor=None,
+        per_page=ADMIN_ROWS_PER_PAGE,
+        search=None,
+        state=None,
+        oldest_first=False,
+    ):
+        """
+        Return a page of posts for the admin, optionally only those in state
+        or with search in their title, and the cursor for the next page.
+        """
+        query = cls.model.query
+        if search:
+            query = query.filter(
+                func.lower(Post.title).contains(search.lower(), autoescape=True)
+            )
+        if state:
+            query = query.filter_by(state=state)
+        return cls._get_page(query, Post.updated_at, cursor, per_page, oldest_first)
+
+    @classmethod
+    def get_last_updated_at(cls):
+        """
+        Return when any post was last created or changed
+        """
+        return db.session.query(func.max(Post.updated_at)).scalar()
+
+    @classmethod
+    def get_post_version(cls, slug):
+        """
+        Return (updated at, source hash, renderer version, number of visible
+        comments, newest visible comment created at) for a post without loading
+        it or its comments. Rendering again, e.g. with `flask render-posts`,
+        changes the html without touching updated_at, so the render is part of
+        the version.
+        """
+        post = (
+            db.session.query(
+                Post.id, Post.updated_at, Post.source_hash, Post.renderer_version
+            )
+            .filter_by(slug=slug)
+            .first()
+        )
+        if not post:
+            return
+
+        num_comments, last_comment_at = (
+            db.session.query(func.count(Comment.id), func.max(Comment.created_at))
+            .filter(Comment.post_id == post.id, Comment.state == CommentState.VISIBLE)
+            .one()
+        )
+        return (
+            post.updated_at,
+            post.source_hash,
+            post.renderer_version,
+            num_comments,
+            last_comment_at,
+        )
+
     @classmethod
     def get_post_by_slug(cls, slug, include_comments=False):
         post = cls.filter_(slug=slug)
@@ -84,7 +225,8 @@ class PostModelStorage(BaseModelStorage):
     @classmethod
     def _get_post_and_comments(cls, post):
         comments = (
-            post.comments.filter_by(state=CommentState.VISIBLE)
+            post.comments.options(joinedload(Comment.user))
+            .filter_by(state=CommentState.VISIBLE)
             .order_by(asc("created_at"))
             .all()
         )
@@ -100,23 +242,56 @@ class PostModelStorage(BaseModelStorage):
         )
         db.session.add(post)
         db.session.commit()
+        response_cache.invalidate()
 
     @classmethod
-    def edit_post(cls, post_id, data):
+    def edit_post(cls, post_id, data, autosave=False):
+        """
+        Save the fields in data that differ from the post and return whether
+        anything was saved.
+
+        An autosave is written straight away, but rendering a draft's html is
+        put off, see Post.is_render_deferred.
+        """
         post = cls.get(id=post_id)
 
-        post.title = data["title"] if data["title"] != post.title else post.title
-        post.slug = data["slug"] if data["slug"] != post.slug else post.slug
-        post.description = (
-            data["description"]
-            if data["description"] != post.description
-            else post.description
-        )
-        post.source = data["source"] if data["source"] != post.source else post.source
+        changed = False
+        for field in ("title", "slug", "description"):
+            if data[field] != getattr(post, field):
+                setattr(post, field, data[field])
+                changed = True
+
+        # Not source_hash, it's the hash of the last render, which is behind
+        # the source while a draft's render is deferred to a job
+        if data["source"] != post.source:
+            post.source = data["source"]
+            changed = True
+
+        if not changed:
+            return False
+
         post.updated_at = datetime.utcnow()
+        post.defer_render = autosave
+
+        db.session.add(post)
+        db.session.commit()
+        post.defer_render = False
+        response_cache.invalidate()
+        return True
+
+    @classmethod
+    def render_html(cls, post):
+        """
+        Save freshly rendered html for a post whose html is stale, e.g. a
+        draft whose render job hasn't run yet. Return whether it was.
+        """
+        if not post.render_html():
+            return False
 
         db.session.add(post)
         db.session.commit()
+        response_cache.invalidate()
+        return True
 
     @classmethod
     def publish_post(cls, post_id):
@@ -129,6 +304,7 @@ class PostModelStorage(BaseModelStorage):
 
         db.session.add(post)
         db.session.commit()
+        response_cache.invalidate()
 
     @classmethod
     def archive_post(cls, post_id):
@@ -140,6 +316,7 @@ class PostModelStorage(BaseModelStorage):
 
         db.session.add(post)
         db.session.commit()
+        response_cache.invalidate()
 
     @classmethod
     def mark_post_as_draft(cls, post_id):
@@ -151,22 +328,152 @@ class PostModelStorage(BaseModelStorage):
 
         db.session.add(post)
         db.session.commit()
+        response_cache.invalidate()
 
     @classmethod
     def search_posts(cls, search_terms):
         """
-        Return published posts with source containing given search terms
+        Return published posts matching all of the given search terms, best
+        matches first.
+
+        The last term is matched as a prefix since searches are sent as the
+        user types. The database's full-text search is used when it has been
+        set up, see search_utils.get_search_backend.
         """
+        if not search_utils.tokenize(search_terms):
+            return cls.get_all_published_posts()
+
+        backend = search_utils.get_search_backend(
+            db.engine, current_app.config["SEARCH_BACKEND"]
+        )
+        if backend == search_utils.SearchBackend.SQLITE_FTS:
+            post_ids = cls._search_sqlite_fts(search_terms)
+        elif backend == search_utils.SearchBackend.MYSQL_FULLTEXT:
+            post_ids = cls._search_mysql_fulltext(search_terms)
+        elif backend == search_utils.SearchBackend.INDEX:
+            post_ids = cls._search_index(search_terms)
+        else:
+            return cls._search_like(search_terms)
+
+        if post_ids is None:
+            post_ids = cls._search_index(search_terms)
+        if not post_ids:
+            return []
+
+        posts = cls.model.query.filter(
+            Post.id.in_(post_ids), Post.state == PostStatus.PUBLISHED
+        ).all()
+        order = {post_id: index for index, post_id in enumerate(post_ids)}
+        return sorted(posts, key=lambda post: order[post.id])
+
+    @classmethod
+    def _search_like(cls, search_terms):
         return cls.model.query.filter(
             func.lower(Post.source).like(f"%{search_terms.lower()}%"),
             Post.state == PostStatus.PUBLISHED,
         ).all()
 
+    @classmethod
+    def _search_sqlite_fts(cls, search_terms):
+        query = search_utils.build_sqlite_fts_query(search_terms)
+        fts_table = search_utils.SQLITE_FTS_TABLE
+        rows = db.session.execute(
+            text(
+                f"SELECT {fts_table}.rowid FROM {fts_table} "
+                f"JOIN posts ON posts.id = {fts_table}.rowid "
+                f"WHERE {fts_table} MATCH :query AND posts.state = :state "
+                f"ORDER BY {fts_table}.rank"
+            ),
+            {"query": query, "state": PostStatus.PUBLISHED},
+        )
+        return [row[0] for row in rows]
+
+    @classmethod
+    def _search_mysql_fulltext(cls, search_terms):
+        query = search_utils.build_mysql_boolean_query(search_terms)
+        if not query:
+            # Every term is shorter than InnoDB's minimum token size
+            return
+
+        rows = db.session.execute(
+            text(
+                "SELECT id FROM posts "
+                "WHERE MATCH (title, description, source) "
+                "AGAINST (:query IN BOOLEAN MODE) "
+                "AND state = :state "
+                "ORDER BY MATCH (title, description, source) "
+                "AGAINST (:query IN BOOLEAN MODE) DESC"
+            ),
+            {"query": query, "state": PostStatus.PUBLISHED},
+        )
+        return [row[0] for row in rows]
+
+    @classmethod
+    def _search_index(cls, search_terms):
+        terms = search_utils.analyze(search_terms)
+        postings = cls._get_search_postings(terms)
+        num_docs = db.session.query(func.count(Post.id)).scalar()
+        return search_utils.rank(postings, num_docs)
+
+    @classmethod
+    def _get_search_postings(cls, terms):
+        """
+        Return a {post_id: (frequency, positions)} lookup for each term
+        """
+        *complete_terms, last_term = terms
+        if len(last_term) >= search_utils.MIN_PREFIX_LENGTH:
+            last_term_filter = SearchTerm.term.startswith(last_term, autoescape=True)
+        else:
+            last_term_filter = SearchTerm.term == last_term
+
+        rows = (
+            db.session.query(
+                SearchTerm.term,
+                SearchTerm.post_id,
+                SearchTerm.frequency,
+                SearchTerm.positions,
+            )
+            .filter(or_(SearchTerm.term.in_(set(complete_terms)), last_term_filter))
+            .all()
+        )
+
+        postings = []
+        for index, query_term in enumerate(terms):
+            is_prefix = index == len(terms) - 1
+            posting = {}
+            for term, post_id, frequency, positions in rows:
+                if term != query_term and not (
+                    is_prefix and term.startswith(last_term)
+                ):
+                    continue
+                prev_frequency, prev_positions = posting.get(post_id, (0, []))
+                posting[post_id] = (
+                    prev_frequency + frequency,
+                    prev_positions + search_utils.deserialize_positions(positions),
+                )
+            postings.append(posting)
+        return postings
+
     @classmethod
     def get_posts_by_month_year(cls, month_year):
-        return cls.model.query.filter(
-            (func.date_format(Post.published_at, "%M %Y") == month_year)
-        ).all()
+        """
+        Return posts published in a month year like "November 2021", newest
+        first.
+        """
+        try:
+            start, end = post_utils.get_month_year_range(month_year)
+        except ValueError:
+            return []
+
+        return (
+            cls.model.query.filter(
+                Post.state == PostStatus.PUBLISHED,
+                Post.published_at >= start,
+                Post.published_at < end,
+            )
+            .order_by(desc(Post.published_at), desc(Post.id))
+            .all()
+        )
 
 
 class UserModelStorage(BaseModelStorage):
@@ -186,21 +493,15 @@ class UserModelStorage(BaseModelStorage):
 
     @classmethod
     def get_all_for_admin(cls):
-        users = cls.get_all()
-        if not users:
-            return []
-
-        return [
-            {
-                "id": user.id,
-                "created_at": user.created_at,
-                "email": user.email,
-                "username": user.username,
-                "is_admin": user.is_admin,
-                "num_comments": user.comments.count(),
-            }
-            for user in users
-        ]
+        columns = (User.id, User.created_at, User.email, User.username, User.is_admin)
+        users = (
+            db.session.query(*columns, func.count(Comment.id).label("num_comments"))
+            .outerjoin(Comment, Comment.user_id == User.id)
+            .group_by(*columns)
+            .order_by(User.id)
+            .all()
+        )
+        return [user._asdict() for user in users]
 
     @classmethod
     def get_or_create_comment_user(cls, email, username):
@@ -217,17 +518,82 @@ class CommentModelStorage(BaseModelStorage):
 
     @classmethod
     def create_comment(cls, data):
-        post_utils.validate_comment_text(data.get("comment"))
+        """
+        With the job queue on the language check and notification happen in
+        a job, the comment is pending until the job publishes it or hides it
+        if its language isn't supported.
+        """
+        deferred = job_utils.is_enabled()
+        if not deferred:
+            post_utils.validate_comment_text(data.get("comment"))
 
         user = UserModelStorage.get_or_create_comment_user(
             data.get("email"), data.get("username")
         )
         comment = Comment(text=data.get("comment"), user=user, post=data.get("post"))
+        if deferred:
+            comment.state = CommentState.PENDING
 
         db.session.add(comment)
+        if deferred:
+            db.session.flush()
+            job_utils.enqueue(
+                "check-comment-language",
+                comment_id=comment.id,
+                url_root=email_utils.get_url_root(),
+            )
         db.session.commit()
+        response_cache.invalidate()
+
+        if not deferred:
+            email_utils.send_new_comment_notif(comment)
 
-        email_utils.send_new_comment_notif(comment)
+        return comment
+
+    @classmethod
+    def publish_comment(cls, comment_id):
+        comment = cls.get_by_id(comment_id)
+        if not comment or comment.state != CommentState.PENDING:
+            return
+
+        comment.state = CommentState.VISIBLE
+
+        db.session.add(comment)
+        db.session.commit()
+        response_cache.invalidate()
+
+    @classmethod
+    def get_ids_to_notify(cls):
+        """
+        Published comments the site admin hasn't been sent an email about
+        """
+        return [
+            comment_id
+            for comment_id, in db.session.query(Comment.id).filter(
+                Comment.notified_at.is_(None), Comment.state == CommentState.VISIBLE
+            )
+        ]
+
+    @classmethod
+    def mark_notified(cls, comment_ids):
+        db.session.execute(
+            Comment.__table__.update()
+            .where(Comment.id.in_(comment_ids))
+            .values(notified_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+    @classmethod
+    def hide_comment(cls, comment_id):
+        comment = cls.get_by_id(comment_id)
+        if not comment or comment.state == CommentState.HIDDEN:
+            return
+
+        comment.state = CommentState.HIDDEN
+
+        db.session.add(comment)
+        db.session.commit()
+        response_cache.invalidate()
 
     @classmethod
     def toggle_visibility_state(cls, comment_id):
@@ -237,7 +603,7 @@ class CommentModelStorage(BaseModelStorage):
 
         if comment.state == CommentState.VISIBLE:
             new_state = CommentState.HIDDEN
-        elif comment.state == CommentState.HIDDEN:
+        elif comment.state in (CommentState.HIDDEN, CommentState.PENDING):
             new_state = CommentState.VISIBLE
         else:
             raise ValueError("Comment in unknown visibility state")
@@ -246,7 +612,123 @@ class CommentModelStorage(BaseModelStorage):
 
         db.session.add(comment)
         db.session.commit()
+        response_cache.invalidate()
+
+    @classmethod
+    def _query_with_user_and_post(cls):
+        """
+        Comments are listed with their author and post so load them in the same
+        query rather than one query per comment.
+        """
+        return cls.model.query.options(
+            joinedload(Comment.user), joinedload(Comment.post)
+        )
+
+    @classmethod
+    def get_all(cls):
+        return cls._query_with_user_and_post().all()
 
     @classmethod
     def get_all_by_user_id(cls, user_id):
-        return cls.filter_(user_id=user_id)
+        return cls._query_with_user_and_post().filter_by(user_id=user_id).all()
+
+    @classmethod
+    def get_page(
+        cls,
+        cursor=None,
+        per_page=ADMIN_ROWS_PER_PAGE,
+        user_id=None,
+        search=None,
+        state=None,
+        oldest_first=False,
+    ):
+        """
+        Return a page of comments, newest first, optionally for a single
+        user, in state or with search in their text or username, and the
+        cursor for the next page.
+        """
+        query = cls._query_with_user_and_post()
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        if search:
+            search = search.lower()
+            query = query.filter(
+                or_(
+                    func.lower(Comment.text).contains(search, autoescape=True),
+                    Comment.user.has(
+                        func.lower(User.username).contains(search, autoescape=True)
+                    ),
+                )
+            )
+        if state:
+            query = query.filter_by(state=state)
+        return cls._get_page(query, Comment.created_at, cursor, per_page, oldest_first)
+
+
+class UploadModelStorage(BaseModelStorage):
+    model = Upload
+
+    @classmethod
+    def get_recent_uploads(cls, limit=5):
+        return Upload.query.order_by(desc(Upload.id)).limit(limit).all()
+
+    @classmethod
+    def get_name_by_source_hash(cls, source_hash):
+        upload = Upload.query.filter_by(source_hash=source_hash).first()
+        return upload.name if upload else None
+
+    @classmethod
+    def create_upload(cls, name, source_hash=None):
+        """
+        Record a newly saved upload and have it processed off the request
+        thread.
+        """
+        upload = Upload(name=name, source_hash=source_hash)
+        db.session.add(upload)
+        db.session.commit()
+
+        job_utils.defer("process-upload", upload_id=upload.id)
+        db.session.commit()
+        return upload
+
+    @classmethod
+    def set_progress(cls, upload_id, state, progress):
+        db.session.execute(
+            Upload.__table__.update()
+            .where(Upload.id == upload_id)
+            .values(state=state, progress=progress)
+        )
+        db.session.commit()
+
+    @classmethod
+    def finish_upload(cls, upload_id, metadata, webp_name=None):
+        upload = cls.get(upload_id)
+        upload.state = UploadState.DONE
+        upload.progress = 100
+        upload.processed_at = datetime.utcnow()
+        upload.width = metadata["width"]
+        upload.height = metadata["height"]
+        upload.num_bytes = metadata["num_bytes"]
+        upload.content_hash = metadata["content_hash"]
+        upload.webp_name = webp_name
+
+        db.session.add(upload)
+        db.session.commit()
+        # Pages showing it link to it by its content, which processing changed
+        response_cache.invalidate()
+
+    @classmethod
+    def fail_upload(cls, upload_id, error):
+        upload = cls.get(upload_id)
+        upload.state = UploadState.FAILED
+        upload.processed_at = datetime.utcnow()
+        upload.error = error
+
+        db.session.add(upload)
+        db.session.commit()
+
+    @classmethod
+    def delete_upload(cls, name):
+        Upload.query.filter_by(name=name).delete()
+        db.session.commit()
+        response_cache.invalidate()
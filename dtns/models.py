@@ -1,40 +1,236 @@
+import json
 from datetime import datetime
+from datetime import timedelta
 
+from flask import current_app
 from flask_login import UserMixin
 
 from dtns import db
 from dtns import login_manager
 from dtns.constants import CommentState
+from dtns.constants import JobState
 from dtns.constants import PostStatus
-from dtns.utils.render_utils import md
+from dtns.constants import UploadState
+from dtns.utils import post_utils
+from dtns.utils import render_utils
+from dtns.utils import search_utils
+
+SEARCHABLE_POST_FIELDS = ("title", "description", "source", "state")
 
 
 class Post(db.Model):
     __tablename__ = "posts"
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    published_at = db.Column(db.DateTime, index=True)
+    updated_at = db.Column(
+        db.DateTime, index=True, nullable=False, default=datetime.utcnow
+    )
+    published_at = db.column_property(
+        db.Column(db.DateTime, index=True), active_history=True
+    )
     title = db.Column(db.String(256), nullable=False)
     slug = db.Column(db.String(256), index=True, nullable=False)
     description = db.Column(db.Text)
     state = db.Column(db.String(30), default=PostStatus.DRAFT)
     source = db.Column(db.Text)
     html = db.Column(db.Text)
+    source_hash = db.Column(db.String(64))
+    renderer_version = db.Column(db.Integer)
     comments = db.relationship("Comment", backref="post", lazy="dynamic")
+    # Not a column, set for an autosave whose render can wait
+    defer_render = False
+
+    @property
+    def is_html_stale(self):
+        return (
+            self.renderer_version != render_utils.RENDERER_VERSION
+            or self.source_hash != render_utils.hash_source(self.source)
+        )
+
+    @property
+    def is_render_deferred(self):
+        """
+        With the job queue on drafts are rendered by a job, otherwise
+        autosaved drafts are rendered once they're previewed or published.
+        Only their author sees them and the editor previews without saving.
+        """
+        return self.state in (None, PostStatus.DRAFT) and (
+            self.defer_render or current_app.config["JOB_QUEUE_ENABLED"]
+        )
+
+    def render_html(self, force=False):
+        """
+        Render source to html unless the html already matches the current
+        source and renderer. Return whether it was rendered.
+        """
+        if not force and not self.is_html_stale:
+            return False
+
+        self.html = render_utils.render_source(self.source)
+        self.source_hash = render_utils.hash_source(self.source)
+        self.renderer_version = render_utils.RENDERER_VERSION
+        return True
+
+    @staticmethod
+    def on_insert_update_render_html(mapper, connection, target):
+        if not target.is_render_deferred:
+            target.render_html()
 
-    def generate_html(self, source):
-        self.html = md.render(source)
+    @staticmethod
+    def on_insert_update_queue_render(mapper, connection, target):
+        if not current_app.config["JOB_QUEUE_ENABLED"]:
+            return
+        if target.is_render_deferred and target.is_html_stale:
+            # Autosaves come in bursts, one render once it's over is enough
+            delay = (
+                current_app.config["AUTOSAVE_RENDER_DELAY"]
+                if target.defer_render
+                else 0
+            )
+            Job.enqueue(
+                connection, "render-post", delay, unique=True, post_id=target.id
+            )
+
+    @staticmethod
+    def on_insert_update_search_terms(mapper, connection, target):
+        return SearchTerm.index_post(connection, target)
+
+    @staticmethod
+    def on_update_update_search_terms(mapper, connection, target):
+        state = db.inspect(target)
+        if any(
+            state.attrs[field].history.has_changes() for field in SEARCHABLE_POST_FIELDS
+        ):
+            return SearchTerm.index_post(connection, target)
+
+    @staticmethod
+    def on_delete_remove_search_terms(mapper, connection, target):
+        return SearchTerm.remove_post(connection, target.id)
 
     @staticmethod
-    def on_change_source(target, value, oldvalue, initiator):
-        return target.generate_html(value)
+    def on_insert_update_archive(mapper, connection, target):
+        return PostArchiveMonth.refresh_months(connection, [target.published_at])
+
+    @staticmethod
+    def on_update_update_archive(mapper, connection, target):
+        state = db.inspect(target)
+        published_at_history = state.attrs.published_at.history
+        if not (
+            published_at_history.has_changes()
+            or state.attrs.state.history.has_changes()
+        ):
+            return
+
+        return PostArchiveMonth.refresh_months(
+            connection,
+            [target.published_at, *published_at_history.deleted],
+        )
 
     def __repr__(self):
         return f"<Post {self.id} {self.slug}>"
 
 
-db.event.listen(Post.source, "set", Post.on_change_source)
+db.event.listen(Post, "before_insert", Post.on_insert_update_render_html)
+db.event.listen(Post, "before_update", Post.on_insert_update_render_html)
+db.event.listen(Post, "after_insert", Post.on_insert_update_queue_render)
+db.event.listen(Post, "after_update", Post.on_insert_update_queue_render)
+db.event.listen(Post, "after_insert", Post.on_insert_update_search_terms)
+db.event.listen(Post, "after_update", Post.on_update_update_search_terms)
+db.event.listen(Post, "before_delete", Post.on_delete_remove_search_terms)
+db.event.listen(Post, "after_insert", Post.on_insert_update_archive)
+db.event.listen(Post, "after_update", Post.on_update_update_archive)
+db.event.listen(Post, "after_delete", Post.on_insert_update_archive)
+
+
+class PostArchiveMonth(db.Model):
+    """
+    Number of published posts per month, kept up to date as posts change so
+    the archive doesn't need to look at every post.
+    """
+
+    __tablename__ = "post_archive_months"
+    month = db.Column(db.Date, primary_key=True)
+    num_posts = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def month_year(self):
+        return self.month.strftime("%B %Y")
+
+    @classmethod
+    def refresh_months(cls, connection, published_ats):
+        """
+        Recount the published posts for the months of the given dates
+        """
+        month_ranges = {
+            post_utils.get_month_range(dt) for dt in published_ats if dt is not None
+        }
+        for start, end in month_ranges:
+            month = start.date()
+            num_posts = connection.execute(
+                db.select([db.func.count(Post.id)]).where(
+                    Post.state == PostStatus.PUBLISHED,
+                    Post.published_at >= start,
+                    Post.published_at < end,
+                )
+            ).scalar()
+
+            connection.execute(cls.__table__.delete().where(cls.month == month))
+            if num_posts:
+                connection.execute(
+                    cls.__table__.insert(), {"month": month, "num_posts": num_posts}
+                )
+
+    def __repr__(self):
+        return f"<PostArchiveMonth {self.month} {self.num_posts}>"
+
+
+class SearchTerm(db.Model):
+    """
+    Inverted index of stemmed terms to the published posts containing them
+    """
+
+    __tablename__ = "search_terms"
+    term = db.Column(db.String(search_utils.MAX_TERM_LENGTH), primary_key=True)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("posts.id"), primary_key=True, index=True
+    )
+    frequency = db.Column(db.Integer, nullable=False)
+    positions = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def remove_post(cls, connection, post_id):
+        connection.execute(cls.__table__.delete().where(cls.post_id == post_id))
+
+    @classmethod
+    def index_post(cls, connection, post):
+        """
+        Replace the terms for a post, only published posts are searchable
+        """
+        cls.remove_post(connection, post.id)
+        if post.state != PostStatus.PUBLISHED:
+            return
+
+        postings = search_utils.build_postings(
+            post.title, post.description, post.source
+        )
+        if not postings:
+            return
+
+        connection.execute(
+            cls.__table__.insert(),
+            [
+                {
+                    "term": term,
+                    "post_id": post.id,
+                    "frequency": len(positions),
+                    "positions": search_utils.serialize_positions(positions),
+                }
+                for term, positions in postings.items()
+            ],
+        )
+
+    def __repr__(self):
+        return f"<SearchTerm {self.term} {self.post_id}>"
 
 
 class User(UserMixin, db.Model):
@@ -58,8 +254,10 @@ def load_user(id):
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    __table_args__ = (db.Index("ix_comments_created_at_id", "created_at", "id"),)
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    notified_at = db.Column(db.DateTime)
     state = db.Column(db.String(30), default=CommentState.VISIBLE)
     text = db.Column(db.Text)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -67,3 +265,96 @@ class Comment(db.Model):
 
     def __repr__(self):
         return f"<Comment {self.id}>"
+
+
+class Upload(db.Model):
+    """
+    An uploaded image and what processing it found out about it
+    """
+
+    __tablename__ = "uploads"
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+    name = db.Column(db.String(256), index=True, unique=True, nullable=False)
+    state = db.Column(db.String(30), nullable=False, default=UploadState.QUEUED)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    num_bytes = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64), index=True)
+    # The hash of the image as it was uploaded, before processing rewrote it
+    source_hash = db.Column(db.String(64), index=True)
+    webp_name = db.Column(db.String(256))
+    error = db.Column(db.Text)
+
+    @property
+    def is_processing(self):
+        return self.state in (UploadState.QUEUED, UploadState.PROCESSING)
+
+    @property
+    def is_stalled(self):
+        timeout = timedelta(seconds=current_app.config["UPLOAD_PROCESSING_TIMEOUT"])
+        return self.is_processing and self.created_at < datetime.utcnow() - timeout
+
+    def __repr__(self):
+        return f"<Upload {self.id} {self.name}>"
+
+
+class Job(db.Model):
+    """
+    Work deferred to `flask run-jobs` workers.
+
+    A job can be claimed once run_at has passed. Claiming it moves run_at
+    forward by the visibility timeout, so a job whose worker died is claimed
+    again once that runs out. Finished jobs are deleted, jobs that failed
+    every attempt are kept with their last error.
+    """
+
+    __tablename__ = "jobs"
+    __table_args__ = (db.Index("ix_jobs_state_run_at", "state", "run_at"),)
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    name = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    state = db.Column(db.String(30), nullable=False, default=JobState.QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(128))
+    last_error = db.Column(db.Text)
+
+    @property
+    def kwargs(self):
+        return json.loads(self.payload)
+
+    @classmethod
+    def enqueue(cls, connection, name, delay=0, unique=False, **kwargs):
+        """
+        Add a job to run name with kwargs on connection, so it is only saved
+        if the caller's transaction is. With unique, nothing is added when
+        the same job is already waiting to run.
+        """
+        payload = json.dumps(kwargs, sort_keys=True)
+        if unique:
+            existing = connection.execute(
+                db.select([cls.id]).where(
+                    cls.name == name,
+                    cls.payload == payload,
+                    cls.state == JobState.QUEUED,
+                )
+            ).first()
+            if existing is not None:
+                return
+
+        connection.execute(
+            cls.__table__.insert().values(
+                name=name,
+                payload=payload,
+                max_attempts=current_app.config["JOB_MAX_ATTEMPTS"],
+                run_at=datetime.utcnow() + timedelta(seconds=delay),
+            )
+        )
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.name}>"
@@ -5,9 +5,11 @@ from flask import Blueprint
 from flask import abort
 from flask import current_app
 from flask import flash
+from flask import make_response
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import send_file
 from flask import send_from_directory
 from flask import url_for
 from flask_login import current_user
@@ -18,8 +20,14 @@ from itsdangerous import SignatureExpired
 from werkzeug.security import check_password_hash
 
 from dtns import db
+from dtns import login_manager
+from dtns import metrics
+from dtns import response_cache
 from dtns.constants import COMMENT_STATUS_STYLE
+from dtns.constants import IMAGE_VARIANT_FORMATS
+from dtns.constants import IMAGE_VARIANT_WIDTHS
 from dtns.constants import POST_STATUS_STYLE
+from dtns.constants import CommentState
 from dtns.constants import PostStatus
 from dtns.forms import BlogPostForm
 from dtns.forms import CommentForm
@@ -27,28 +35,66 @@ from dtns.forms import ImageUploadForm
 from dtns.forms import LoginForm
 from dtns.model_storage import CommentModelStorage
 from dtns.model_storage import PostModelStorage
+from dtns.model_storage import UploadModelStorage
 from dtns.model_storage import UserModelStorage
+from dtns.utils import asset_utils
+from dtns.utils import http_utils
 from dtns.utils import image_utils
+from dtns.utils import metrics_utils
 from dtns.utils import post_utils
 from dtns.utils.post_utils import UnsupportedLanguageError
 
 main = Blueprint("main", __name__)
 
 
+def get_site_validators(**kwargs):
+    """
+    Pages listing posts change whenever any post does
+    """
+    updated_at = PostModelStorage.get_last_updated_at()
+    return (updated_at,), updated_at
+
+
+def get_about_validators():
+    version = PostModelStorage.get_post_version("about")
+    if not version:
+        return (None,), None
+    # Uploads shown in the page are served at urls made from their content
+    return (*version, asset_utils.get_uploads_version()), version[0]
+
+
+def get_post_validators(slug):
+    version = PostModelStorage.get_post_version(slug)
+    if not version:
+        return
+
+    site_updated_at, last_modified = get_site_validators()
+    last_comment_at = version[-1]
+    if last_comment_at and last_comment_at > last_modified:
+        last_modified = last_comment_at
+    uploads_version = asset_utils.get_uploads_version()
+    return (*site_updated_at, *version, uploads_version), last_modified
+
+
 @main.route("/")
+@http_utils.conditional(get_site_validators)
+@response_cache.cached
 def index():
     recent_post_list = PostModelStorage.get_recent_posts()
-    posts = PostModelStorage.get_all_published_posts()
-    post_archive = post_utils.aggregate_and_sort_posts_by_month_year(posts)
+    posts, next_cursor = PostModelStorage.get_published_posts_page()
+    post_archive = PostModelStorage.get_post_archive()
     return render_template(
         "home.html",
         recent_post_list=recent_post_list,
         posts=posts,
+        next_cursor=next_cursor,
         post_archive=post_archive,
     )
 
 
 @main.route("/about")
+@http_utils.conditional(get_about_validators)
+@response_cache.cached
 def about():
     post = PostModelStorage.get_post_by_slug("about")
     return render_template("about.html", post=post)
@@ -105,9 +151,14 @@ def admin():
 @main.route("/admin/posts", methods=["GET"])
 @login_required
 def admin_posts():
-    posts = PostModelStorage.get_all_posts_ordered_by_updated_at()
+    posts, next_cursor = PostModelStorage.get_posts_page_ordered_by_updated_at(
+        **post_utils.get_listing_filters(request.args)
+    )
     return render_template(
-        "admin/posts.html", posts=posts, POST_STATUS_STYLE=POST_STATUS_STYLE
+        "admin/posts.html",
+        posts=posts,
+        next_cursor=next_cursor,
+        POST_STATUS_STYLE=POST_STATUS_STYLE,
     )
 
 
@@ -122,13 +173,14 @@ def admin_users():
 @login_required
 def admin_comments():
     user_id = request.args.get("user_id", type=int)
-    if user_id is not None:
-        comments = CommentModelStorage.get_all_by_user_id(user_id=user_id)
-    else:
-        comments = CommentModelStorage.get_all()
+    comments, next_cursor = CommentModelStorage.get_page(
+        user_id=user_id, **post_utils.get_listing_filters(request.args)
+    )
     return render_template(
         "admin/comments.html",
         comments=comments,
+        next_cursor=next_cursor,
+        user_id=user_id,
         COMMENT_STATUS_STYLE=COMMENT_STATUS_STYLE,
     )
 
@@ -277,6 +329,7 @@ def temp_preview():
     if not post:
         abort(404)
 
+    PostModelStorage.render_html(post)
     return render_template("post.html", recent_post_list=recent_post_list, post=post)
 
 
@@ -287,10 +340,14 @@ def preview(slug):
     post = PostModelStorage.get_post_by_slug(slug)
     if not post:
         abort(404)
+    # A draft's render job may not have run yet
+    PostModelStorage.render_html(post)
     return render_template("post.html", recent_post_list=recent_post_list, post=post)
 
 
 @main.route("/post/<slug>", methods=["GET", "POST"])
+@http_utils.conditional(get_post_validators)
+@response_cache.cached
 def post(slug):
     recent_post_list = PostModelStorage.get_recent_posts()
     post, comments = PostModelStorage.get_post_by_slug(slug, include_comments=True)
@@ -306,8 +363,11 @@ def post(slug):
                 "comment": form.comment.data,
                 "post": post,
             }
-            CommentModelStorage.create_comment(data)
-            flash("Your comment has been added!", "success")
+            comment = CommentModelStorage.create_comment(data)
+            if comment.state == CommentState.PENDING:
+                flash("Your comment will show once it's been checked!", "success")
+            else:
+                flash("Your comment has been added!", "success")
             return redirect(url_for("main.post", slug=post.slug))
         except Exception as e:
             if isinstance(e, UnsupportedLanguageError):
@@ -332,6 +392,26 @@ def post(slug):
     )
 
 
+@main.route("/assets/<fingerprint>/<path:filename>")
+def asset(fingerprint, filename):
+    """
+    A file from the static folder at a url made from its content, so it never
+    changes and can be cached for good. Urls with an old fingerprint, e.g. in
+    a page cached before a deploy, redirect to the current one.
+    """
+    current_fingerprint = asset_utils.get_fingerprint(filename)
+    if current_fingerprint is None:
+        abort(404)
+    if fingerprint != current_fingerprint:
+        return redirect(asset_utils.asset_url(filename))
+
+    response = send_from_directory(
+        current_app.static_folder, filename, max_age=asset_utils.IMMUTABLE_MAX_AGE
+    )
+    response.cache_control.immutable = True
+    return response
+
+
 @main.route("/uploads/<name>")
 def download_file(name):
     upload_folder_path = os.path.join(
@@ -340,6 +420,28 @@ def download_file(name):
     return send_from_directory(upload_folder_path, name, max_age=3600)
 
 
+@main.route("/uploads/<name>/<int:width>.<ext>")
+def image_variant(name, width, ext):
+    """
+    An upload resized to one of IMAGE_VARIANT_WIDTHS in one of
+    IMAGE_VARIANT_FORMATS, e.g. /uploads/photo.jpg/640.webp
+    """
+    if width not in IMAGE_VARIANT_WIDTHS or ext not in IMAGE_VARIANT_FORMATS:
+        abort(404)
+
+    image_manager = image_utils.ImageManager(current_app)
+    variant = image_manager.get_variant(name, width, ext)
+    if variant is None:
+        abort(404)
+
+    return send_file(
+        variant.path,
+        mimetype=variant.mimetype,
+        etag=variant.key,
+        max_age=current_app.config["IMAGE_VARIANT_MAX_AGE"],
+    )
+
+
 @main.route("/image-manager", methods=["GET", "POST"])
 @login_required
 def image_manager():
@@ -348,16 +450,30 @@ def image_manager():
     image_list = image_manager.get_all_images()
     if request.method == "POST":
         file_upload = request.files["file"]
-        filename = image_manager.save_image(file_upload)
-        if not filename:
+        try:
+            saved = image_manager.save_image(
+                file_upload, UploadModelStorage.get_name_by_source_hash
+            )
+        except image_utils.UploadTooLargeError:
+            max_mb = current_app.config["IMAGE_UPLOAD_MAX_BYTES"] // (1024 * 1024)
+            flash(f"Sorry, images can't be bigger than {max_mb}MB!", "danger")
+            return redirect(url_for("main.image_manager"))
+        if not saved:
             flash(
                 "Something went wrong with your upload. Please check and try again.",
                 "danger",
             )
             return redirect(url_for("main.image_manager"))
-        flash(f'Sucessfully uploaded "{filename}"', "success")
+        if not saved.is_new:
+            flash(f'This image has already been uploaded as "{saved.name}"', "info")
+            return redirect(url_for("main.image_manager"))
+        UploadModelStorage.create_upload(saved.name, saved.content_hash)
+        flash(f'Sucessfully uploaded "{saved.name}"', "success")
         return redirect(url_for("main.image_manager"))
-    return render_template("image-manager.html", form=form, image_list=image_list)
+    uploads = UploadModelStorage.get_recent_uploads()
+    return render_template(
+        "image-manager.html", form=form, image_list=image_list, uploads=uploads
+    )
 
 
 @main.route("/logout")
@@ -370,3 +486,17 @@ def logout():
 def health_check():
     db.engine.execute("SELECT 1")
     return ""
+
+
+@main.route("/metrics", methods=["GET"])
+def metrics_report():
+    allow_localhost = current_app.config["METRICS_ALLOW_LOCALHOST"]
+    if not current_user.is_authenticated and not (
+        allow_localhost and metrics_utils.is_local_request()
+    ):
+        return login_manager.unauthorized()
+
+    response = make_response(metrics.registry.render())
+    response.content_type = metrics_utils.PROMETHEUS_CONTENT_TYPE
+    response.cache_control.no_store = True
+    return response
@@ -0,0 +1,82 @@
+from flask import current_app
+from PIL import UnidentifiedImageError
+
+from dtns import mail
+from dtns.constants import UploadState
+from dtns.model_storage import CommentModelStorage
+from dtns.model_storage import PostModelStorage
+from dtns.model_storage import UploadModelStorage
+from dtns.utils import email_utils
+from dtns.utils import image_utils
+from dtns.utils import post_utils
+from dtns.utils.job_utils import task
+from dtns.utils.post_utils import UnsupportedLanguageError
+
+
+@task("check-comment-language")
+def check_comment_language(comment_id, url_root=None):
+    """
+    Hide a comment in an unsupported language, otherwise publish it and let
+    the site admin know about it.
+    """
+    comment = CommentModelStorage.get_by_id(comment_id)
+    if not comment:
+        return
+
+    try:
+        post_utils.validate_comment_text(comment.text)
+    except UnsupportedLanguageError:
+        CommentModelStorage.hide_comment(comment.id)
+        return
+
+    CommentModelStorage.publish_comment(comment.id)
+    email_utils.send_new_comment_notif(comment, url_root)
+
+
+@task("send-new-comment-notif")
+def send_new_comment_notif(comment_ids, url_root=None):
+    # Sent here rather than through the mail queue, so a failure fails the
+    # job and it's retried
+    app = current_app._get_current_object()
+    for msg in email_utils.render_new_comment_notif(app, comment_ids, url_root):
+        mail.send(msg)
+
+
+@task("send-comment-digest")
+def send_comment_digest(url_root=None):
+    """
+    Send the site admin one email about every comment published since the
+    last one they were sent
+    """
+    comment_ids = CommentModelStorage.get_ids_to_notify()
+    send_new_comment_notif(comment_ids, url_root)
+    CommentModelStorage.mark_notified(comment_ids)
+
+
+@task("render-post")
+def render_post(post_id):
+    post = PostModelStorage.get(post_id)
+    if post:
+        PostModelStorage.render_html(post)
+
+
+@task("process-upload")
+def process_upload(upload_id):
+    upload = UploadModelStorage.get(upload_id)
+    if not upload:
+        return
+
+    def on_step(step):
+        progress = step * 100 // len(image_utils.PROCESSING_STEPS)
+        UploadModelStorage.set_progress(upload_id, UploadState.PROCESSING, progress)
+
+    image_manager = image_utils.ImageManager(current_app._get_current_object())
+    try:
+        metadata = image_manager.process_image(upload.name, on_step)
+    except (UnidentifiedImageError, OSError) as e:
+        # Trying again won't help a broken or missing image
+        UploadModelStorage.fail_upload(upload_id, str(e))
+        return
+
+    webp_name = image_utils.get_webp_name(upload.name) if metadata["has_webp"] else None
+    UploadModelStorage.finish_upload(upload_id, metadata, webp_name)
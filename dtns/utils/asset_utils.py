@@ -0,0 +1,161 @@
+import os
+import re
+import stat
+import threading
+from urllib.parse import urlsplit
+
+from flask import current_app
+from flask import has_request_context
+from flask import request
+from flask import url_for
+from werkzeug.security import safe_join
+
+from dtns.constants import IMAGE_VARIANT_WIDTHS
+from dtns.utils.image_utils import hash_file
+
+# Enough of a file's SHA-256 to tell its versions apart
+FINGERPRINT_LENGTH = 12
+# A year, the most HTTP caches are expected to honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# The image manager gives authors absolute upload urls, posts can use either
+UPLOAD_SRC_RE = re.compile(r'\bsrc="(https?://[^/"]+)?/uploads/([^/?#"]+)"')
+# Formats of the variants offered for uploads in post html by their extension,
+# gifs can be animated so are only ever sent whole
+SRCSET_VARIANT_EXTS = {".jpg": "jpg", ".jpeg": "jpg", ".png": "webp"}
+# Posts are in a column two thirds wide from the md breakpoint up
+POST_IMAGE_SIZES = "(min-width: 768px) 66vw, 100vw"
+
+
+class AssetManifest:
+    """
+    Fingerprints of the files in the static folder by their path in it, made
+    from their content so a file's fingerprinted url changes whenever it
+    does.
+
+    Files are hashed when first asked for and only hashed again once their
+    size or modified time changes, uploads can be rewritten while the app is
+    running.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        path = safe_join(self.app.static_folder, filename)
+        if path is None:
+            return
+
+        try:
+            stat_result = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        if not stat.S_ISREG(stat_result.st_mode):
+            return
+        version = (stat_result.st_size, stat_result.st_mtime_ns)
+
+        with self._lock:
+            fingerprinted = self._fingerprints.get(filename)
+        if fingerprinted is not None and fingerprinted[0] == version:
+            return fingerprinted[1]
+
+        fingerprint = hash_file(path)[:FINGERPRINT_LENGTH]
+        with self._lock:
+            self._fingerprints[filename] = (version, fingerprint)
+        return fingerprint
+
+
+class Assets:
+    """
+    Adds asset_url to templates, in place of url_for("static", ...), and
+    the fingerprint_uploads filter for post html.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["assets"] = AssetManifest(app)
+        app.add_template_global(asset_url)
+        app.add_template_filter(fingerprint_uploads)
+
+
+def get_fingerprint(filename):
+    return current_app.extensions["assets"].get(filename)
+
+
+def asset_url(filename, _external=False):
+    """
+    url_for a file in the static folder at its fingerprinted url, which can
+    be cached forever. Falls back to the static url for a file that doesn't
+    exist.
+    """
+    fingerprint = get_fingerprint(filename)
+    if fingerprint is None:
+        return url_for("static", filename=filename, _external=_external)
+    return url_for(
+        "main.asset", fingerprint=fingerprint, filename=filename, _external=_external
+    )
+
+
+def is_own_origin(origin):
+    return has_request_context() and urlsplit(origin).netloc == request.host
+
+
+def get_upload_url(match):
+    origin, name = match.groups()
+    if origin and not is_own_origin(origin):
+        return match.group(0)
+
+    filename = f"{current_app.config['UPLOAD_FOLDER']}/{name}"
+    if get_fingerprint(filename) is None:
+        return match.group(0)
+    src = f'src="{asset_url(filename, _external=bool(origin))}"'
+
+    srcset = get_srcset(name, _external=bool(origin))
+    if srcset is None:
+        return src
+    return f'{src} srcset="{srcset}" sizes="{POST_IMAGE_SIZES}"'
+
+
+def get_srcset(name, _external=False):
+    """
+    The resized variants of an upload, for browsers to pick the smallest
+    one that fills the image's width on the reader's screen
+    """
+    ext = SRCSET_VARIANT_EXTS.get(os.path.splitext(name)[1].lower())
+    if ext is None:
+        return
+    srcset = []
+    for width in IMAGE_VARIANT_WIDTHS:
+        url = url_for(
+            "main.image_variant", name=name, width=width, ext=ext, _external=_external
+        )
+        srcset.append(f"{url} {width}w")
+    return ", ".join(srcset)
+
+
+def fingerprint_uploads(html):
+    """
+    Swap the /uploads/<name> image srcs in rendered html, on this site or
+    with its own origin, for fingerprinted urls and add a srcset of their
+    resized variants. Done as pages are served, not when posts are rendered,
+    since uploads can change after the posts showing them are rendered.
+    """
+    return UPLOAD_SRC_RE.sub(get_upload_url, html or "")
+
+
+def get_uploads_version():
+    """
+    Changes whenever an upload is added, removed or rewritten, they're all
+    written to a temporary file that's then renamed into place.
+    """
+    try:
+        return os.stat(
+            os.path.join(current_app.static_folder, current_app.config["UPLOAD_FOLDER"])
+        ).st_mtime_ns
+    except FileNotFoundError:
+        return
@@ -0,0 +1,244 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app
+from flask import g
+from flask import request
+from flask import session
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+
+CSRF_TOKEN_PLACEHOLDER = b"__RESPONSE_CACHE_CSRF_TOKEN__"
+CACHE_FILE_EXT = ".cache"
+
+
+class CacheType:
+    FILESYSTEM = "filesystem"
+    NULL = "null"
+    SIMPLE = "simple"
+
+
+class NullCacheBackend:
+    def get(self, key):
+        return
+
+    def set(self, key, value):
+        return
+
+    def clear(self):
+        return
+
+
+class LRUCacheBackend:
+    """
+    In-process cache that evicts the least recently used responses once the
+    cached bodies add up to more than max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        size = get_entry_size(key, value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= get_entry_size(key, self._entries.pop(key))
+
+            self._entries[key] = value
+            self.num_bytes += size
+
+            while self.num_bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.num_bytes -= get_entry_size(old_key, old_value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+
+class FileSystemCacheBackend:
+    """
+    Cache stored as one file per response so it can be shared (and cleared)
+    by every worker on a host. The least recently used files are removed once
+    the directory is over max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_path(self, key):
+        filename = hashlib.sha256(key.encode()).hexdigest() + CACHE_FILE_EXT
+        return os.path.join(self.cache_dir, filename)
+
+    def _get_cache_files(self):
+        return [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.is_file() and entry.name.endswith(CACHE_FILE_EXT)
+        ]
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        return value
+
+    def set(self, key, value):
+        if get_entry_size(key, value) > self.max_bytes:
+            return
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f)
+        os.replace(tmp_path, self._get_path(key))
+
+        self._evict()
+
+    def _evict(self):
+        cache_files = self._get_cache_files()
+        num_bytes = sum(entry.stat().st_size for entry in cache_files)
+        if num_bytes <= self.max_bytes:
+            return
+
+        for entry in sorted(cache_files, key=lambda entry: entry.stat().st_mtime):
+            if num_bytes <= self.max_bytes:
+                break
+            num_bytes -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for entry in self._get_cache_files():
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def get_entry_size(key, value):
+    return len(key) + len(value["body"])
+
+
+class ResponseCache:
+    """
+    Cache of full rendered responses for public pages.
+
+    Only anonymous GET requests without pending flash messages are cached.
+    Anything that changes what those pages show must call invalidate(), but
+    that only reaches the processes sharing the backend, e.g. not other
+    workers' "simple" caches. Every response is dropped RESPONSE_CACHE_TTL
+    seconds after it's cached so those catch up too.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cache_type = app.config["RESPONSE_CACHE_TYPE"]
+        max_bytes = app.config["RESPONSE_CACHE_MAX_BYTES"]
+
+        if cache_type == CacheType.SIMPLE:
+            backend = LRUCacheBackend(max_bytes)
+        elif cache_type == CacheType.FILESYSTEM:
+            backend = FileSystemCacheBackend(
+                app.config["RESPONSE_CACHE_DIR"], max_bytes
+            )
+        elif cache_type == CacheType.NULL:
+            backend = NullCacheBackend()
+        else:
+            raise ValueError(f"Unknown response cache type: {cache_type}")
+
+        app.extensions["response_cache"] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions["response_cache"]
+
+    def invalidate(self):
+        self.backend.clear()
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not is_cacheable_request():
+                return view(*args, **kwargs)
+
+            key = make_cache_key()
+            value = self.backend.get(key)
+            if value is not None and not is_expired(value):
+                return make_cached_response(value)
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                self.backend.set(key, make_cache_value(response))
+            return response
+
+        return wrapper
+
+
+def is_cacheable_request():
+    return (
+        request.method in ("GET", "HEAD")
+        and not current_user.is_authenticated
+        and not session.get("_flashes")
+    )
+
+
+def make_cache_key():
+    view_args = sorted((request.view_args or {}).items())
+    args = sorted(request.args.items(multi=True))
+    return f"{request.endpoint}|{view_args}|{args}"
+
+
+def make_cache_value(response):
+    """
+    The CSRF token is per session so it is swapped for a placeholder and
+    filled in again for each response.
+    """
+    body = response.get_data()
+    csrf_token = g.get(current_app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token"))
+    if csrf_token:
+        body = body.replace(csrf_token.encode(), CSRF_TOKEN_PLACEHOLDER)
+    return {"body": body, "mimetype": response.mimetype, "cached_at": time.time()}
+
+
+def is_expired(value):
+    # Files cached before responses had a time count as expired
+    age = time.time() - value.get("cached_at", 0)
+    return age > current_app.config["RESPONSE_CACHE_TTL"]
+
+
+def make_cached_response(value):
+    body = value["body"]
+    if CSRF_TOKEN_PLACEHOLDER in body:
+        body = body.replace(CSRF_TOKEN_PLACEHOLDER, generate_csrf().encode())
+    return current_app.response_class(body, mimetype=value["mimetype"])
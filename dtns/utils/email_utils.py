@@ -1,19 +1,21 @@
-from threading import Thread
+from datetime import datetime
+from functools import partial
 
 from flask import current_app
+from flask import has_request_context
 from flask import render_template
+from flask import request
 from flask_mail import Message
+from sqlalchemy.orm import joinedload
 
-from dtns import mail
+from dtns import db
+from dtns import mail_queue
+from dtns.models import Comment
+from dtns.utils import job_utils
 from dtns.utils.post_utils import generate_toggle_comment_url
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-
-
-def send_email(subject, sender, recipients, msg_body=None, msg_html=None):
+def make_email(subject, sender, recipients, msg_body=None, msg_html=None):
     msg = Message(
         subject,
         sender=sender,
@@ -21,28 +23,97 @@ def send_email(subject, sender, recipients, msg_body=None, msg_html=None):
     )
     msg.body = msg_body
     msg.html = msg_html
+    return msg
+
+
+def send_email(subject, sender, recipients, msg_body=None, msg_html=None):
+    return mail_queue.send(make_email(subject, sender, recipients, msg_body, msg_html))
+
+
+def render_new_comment_notif(app, comment_ids, url_root):
+    """
+    Render the email about new comments, a digest when there's more than
+    one. Runs on the mail worker, so it sets up its own app and request
+    context for the database and external urls.
+    """
+    with app.app_context(), app.test_request_context(base_url=url_root):
+        comments = (
+            Comment.query.options(joinedload(Comment.user), joinedload(Comment.post))
+            .filter(Comment.id.in_(comment_ids))
+            .order_by(Comment.created_at, Comment.id)
+            .all()
+        )
+        if not comments:
+            return []
 
-    Thread(
-        target=send_async_email, args=(current_app._get_current_object(), msg)
-    ).start()
+        if len(comments) == 1:
+            comment = comments[0]
+            subject = f"New Comment from: {comment.user.username}"
+            html = render_template(
+                "admin/new-comment.html",
+                comment=comment,
+                toggle_url=generate_toggle_comment_url(comment),
+            )
+        else:
+            subject = f"{len(comments)} New Comments"
+            html = render_template(
+                "admin/new-comments-digest.html",
+                comments=[
+                    (comment, generate_toggle_comment_url(comment))
+                    for comment in comments
+                ],
+            )
 
+        return [
+            make_email(
+                subject,
+                ("Data Things and Stuff", app.config["MAIL_USERNAME"]),
+                [app.config["SITE_ADMIN"]],
+                None,
+                html,
+            )
+        ]
 
-def send_new_comment_notif(comment):
-    subject = f"New Comment from: {comment.user.username}"
-    recipient = current_app.config["SITE_ADMIN"]
 
+def get_url_root():
+    return request.url_root if has_request_context() else None
+
+
+def send_new_comment_notif(comment, url_root=None):
+    """
+    Send the site admin an email about a new comment. With the job queue on
+    it's sent by a job, saved when the caller commits, and with
+    COMMENT_DIGEST_INTERVAL set that job waits to send every comment made in
+    the meantime in one email.
+    """
     if current_app.debug:
+        subject = f"New Comment from: {comment.user.username}"
+        recipient = current_app.config["SITE_ADMIN"]
         print(f"A {subject} email would be sent from {recipient}")
         return
 
-    send_email(
-        subject,
-        ("Data Things and Stuff", current_app.config["MAIL_USERNAME"]),
-        [recipient],
-        None,
-        render_template(
-            "admin/new-comment.html",
-            comment=comment,
-            toggle_url=generate_toggle_comment_url(comment),
-        ),
+    url_root = url_root or get_url_root()
+    interval = current_app.config["COMMENT_DIGEST_INTERVAL"]
+    if job_utils.is_enabled() and interval:
+        job_utils.enqueue(
+            "send-comment-digest", delay=interval, unique=True, url_root=url_root
+        )
+        return
+
+    # Not left for a digest to pick up
+    comment.notified_at = datetime.utcnow()
+    if job_utils.is_enabled():
+        job_utils.enqueue(
+            "send-new-comment-notif", comment_ids=[comment.id], url_root=url_root
+        )
+        return
+
+    db.session.commit()
+    mail_queue.send(
+        partial(
+            render_new_comment_notif,
+            current_app._get_current_object(),
+            [comment.id],
+            url_root,
+        )
     )
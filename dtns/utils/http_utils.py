@@ -0,0 +1,84 @@
+import hashlib
+from datetime import timezone
+from functools import wraps
+
+from flask import current_app
+from flask import request
+from flask import session
+from flask_login import current_user
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def to_http_date(dt):
+    """
+    HTTP dates have no fractional seconds, make dt comparable to them
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.replace(microsecond=0)
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and last_modified:
+        return to_http_date(last_modified) <= to_http_date(request.if_modified_since)
+
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = to_http_date(last_modified)
+    # Pages can include a per-session CSRF token so only the browser may keep
+    # them, and it has to check they're still current before reusing them.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional(get_validators):
+    """
+    Answer GET requests with a 304 when the client's copy is still current,
+    before the view does any work.
+
+    get_validators is called with the view's arguments and returns a tuple
+    of (version parts, last modified datetime), or None to skip the check.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD") or session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            validators = get_validators(**kwargs)
+            if validators is None:
+                return view(*args, **kwargs)
+
+            parts, last_modified = validators
+            etag = make_etag(
+                request.endpoint,
+                current_user.get_id(),
+                # Pages embed a CSRF token tied to the session's secret
+                make_etag(session.get("csrf_token")),
+                *parts,
+            )
+
+            if is_not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+                return set_validators(response, etag, last_modified)
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_validators(response, etag, last_modified)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -1,54 +1,508 @@
+import hashlib
+import io
 import os
+import tempfile
+import threading
+from collections import namedtuple
 
+from PIL import Image
+from PIL import ImageOps
+from PIL import UnidentifiedImageError
 from werkzeug.utils import secure_filename
 
 from dtns.constants import ALLOWABLE_IMAGE_TYPES
+from dtns.constants import IMAGE_VARIANT_FORMATS
+
+# Part of every variant's cache key, bump it when make_variant changes
+VARIANT_VERSION = 1
+# Processed uploads are scaled down to fit in this many pixels square
+PROCESSED_MAX_SIZE = 2560
+PROCESSED_SAVE_OPTIONS = {
+    "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+    "PNG": {"optimize": True},
+    "WEBP": {"quality": 80, "method": 4},
+}
+PROCESSING_STEPS = ("orienting", "recompressing", "making webp")
+# Uploads are written and files hashed this many bytes at a time
+CHUNK_SIZE = 64 * 1024
+VARIANT_SAVE_OPTIONS = {
+    "JPEG": {"quality": 82, "optimize": True, "progressive": True},
+    "WEBP": {"quality": 80, "method": 4},
+}
+
+ImageInfo = namedtuple("ImageInfo", ["name", "size", "mtime", "width", "height"])
+SavedImage = namedtuple("SavedImage", ["name", "content_hash", "is_new"])
+Variant = namedtuple("Variant", ["key", "path", "mimetype"])
+
+_extension_lock = threading.Lock()
+
+
+class UploadTooLargeError(ValueError):
+    pass
+
+
+class ImageIndex:
+    """
+    The images in a directory by name, with their size, modified time and
+    dimensions.
+
+    Before each use the directory's modified time is checked, it changes
+    whenever a file is added, removed or renamed, and only then is the
+    directory scanned again. Files whose size and modified time haven't
+    changed keep their entry, so only new or changed images are opened to
+    read their dimensions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._images = {}
+        self._hashes = {}
+        self._sorted = None
+        self._dir_mtime = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        try:
+            dir_mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            dir_mtime = None
+
+        with self._lock:
+            if dir_mtime == self._dir_mtime and not force:
+                return
+            self._images = self._scan() if dir_mtime is not None else {}
+            self._hashes = {
+                name: hashed
+                for name, hashed in self._hashes.items()
+                if name in self._images
+            }
+            self._sorted = None
+            self._dir_mtime = dir_mtime
+
+    def _scan(self):
+        images = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not is_valid_image_type(entry.name) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                info = self._images.get(entry.name)
+                if info is None or (info.size, info.mtime) != (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ):
+                    info = ImageInfo(
+                        entry.name,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        *get_image_dimensions(entry.path),
+                    )
+                images[entry.name] = info
+        return images
+
+    def names(self):
+        self.refresh()
+        return list(self._images)
+
+    def sorted_names(self):
+        self.refresh()
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self._images)
+            return self._sorted
+
+    def get(self, name):
+        self.refresh()
+        return self._images.get(name)
+
+    def get_content_hash(self, name):
+        """
+        SHA-256 of an image's content, only read again when it changes
+        """
+        if name not in self:
+            return
+
+        # The file's own stat, rewriting a file in place doesn't change the
+        # directory's modified time
+        path = os.path.join(self.path, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        version = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            hashed = self._hashes.get(name)
+        if hashed is not None and hashed[0] == version:
+            return hashed[1]
+
+        content_hash = hash_file(path)
+        with self._lock:
+            self._hashes[name] = (version, content_hash)
+        return content_hash
+
+    def find(self, content_hash, size):
+        """
+        Return the name of an image with this content, only images of the
+        same size are hashed to find it.
+        """
+        self.refresh()
+        with self._lock:
+            names = [info.name for info in self._images.values() if info.size == size]
+        for name in sorted(names):
+            if self.get_content_hash(name) == content_hash:
+                return name
+        return
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+class VariantCache:
+    """
+    Resized copies of uploads stored on disk by a key made from the upload's
+    content and how it was resized, so a changed upload never gets an old
+    copy. Shared by every worker on a host, the least recently used files are
+    removed once the directory is over max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.num_bytes = None
+        self._lock = threading.Lock()
+
+    def get_path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{ext}")
+
+    def get(self, key, ext):
+        path = self.get_path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+        return path
+
+    def set(self, key, ext, data):
+        path = self.get_path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self.num_bytes is None:
+                self.num_bytes = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self.num_bytes += len(data)
+            if self.num_bytes > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _entries(self):
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry
+
+    def _evict(self, keep):
+        # Rescanned so files added or removed by other workers are counted
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        num_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if num_bytes <= self.max_bytes:
+                break
+            if entry.path == keep:
+                continue
+            num_bytes -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        self.num_bytes = num_bytes
+
+
+def get_image_index(app):
+    """
+    One index per app, shared by the ImageManagers made for each request
+    """
+    with _extension_lock:
+        if "image_index" not in app.extensions:
+            app.extensions["image_index"] = ImageIndex(
+                os.path.join(app.static_folder, app.config["UPLOAD_FOLDER"])
+            )
+        return app.extensions["image_index"]
+
+
+def get_variant_cache(app):
+    with _extension_lock:
+        if "image_variant_cache" not in app.extensions:
+            app.extensions["image_variant_cache"] = VariantCache(
+                app.config["IMAGE_VARIANT_CACHE_DIR"],
+                app.config["IMAGE_VARIANT_CACHE_MAX_BYTES"],
+            )
+        return app.extensions["image_variant_cache"]
 
 
 class ImageManager:
     def __init__(self, app):
         self.app = app
+        self.index = get_image_index(app)
+        self.max_bytes = app.config["IMAGE_UPLOAD_MAX_BYTES"]
 
     @property
     def upload_path(self):
         return os.path.join(self.app.static_folder, self.app.config["UPLOAD_FOLDER"])
 
     def get_all_images(self):
-        return [
-            image
-            for image in os.listdir(self.upload_path)
-            if is_valid_image_type(image)
-        ]
+        return self.index.names()
 
     def get_all_images_sorted(self, asc=True):
         if not asc:
-            return sorted(self.get_all_images(), reverse=True)
+            return self.index.sorted_names()[::-1]
 
-        return sorted(self.get_all_images())
+        return list(self.index.sorted_names())
 
     def get_image(self, image_name):
-        image = [image for image in self.get_all_images() if image == image_name]
-        if image:
-            return image[0]
+        if image_name in self.index:
+            return image_name
         return
 
-    def save_image(self, file_upload):
-        if (
-            is_valid_image(file_upload.filename)
-            and file_upload.filename not in self.get_all_images()
-        ):
-            filename = secure_filename(file_upload.filename)
-            file_upload.save(os.path.join(self.upload_path, filename))
-            return filename
-        return
+    def get_image_info(self, image_name):
+        return self.index.get(image_name)
+
+    def get_variant(self, image_name, width, ext):
+        """
+        Return the Variant of an image resized to width and converted to the
+        format for ext, making it the first time it's asked for.
+        """
+        content_hash = self.index.get_content_hash(image_name)
+        if content_hash is None:
+            return
+
+        image_format = IMAGE_VARIANT_FORMATS[ext]
+        key = hashlib.sha256(
+            f"{content_hash}:{width}:{image_format}:{VARIANT_VERSION}".encode()
+        ).hexdigest()
+        cache = get_variant_cache(self.app)
+        path = cache.get(key, ext)
+        if path is None:
+            data = make_variant(
+                os.path.join(self.upload_path, image_name), width, image_format
+            )
+            path = cache.set(key, ext, data)
+        return Variant(key, path, Image.MIME[image_format])
+
+    def save_image(self, file_upload, find_existing=None):
+        """
+        Save an upload to the uploads folder and return a SavedImage, or None
+        if it isn't an allowed image type or its name is already taken.
+
+        An image that's already been uploaded, under any name, isn't saved
+        again and the SavedImage has the existing image's name instead.
+        Processing rewrites images, so find_existing can look up an image's
+        name by the content hash it was uploaded with.
+
+        Raise UploadTooLargeError if the upload is over IMAGE_UPLOAD_MAX_BYTES.
+        """
+        if not is_valid_image(file_upload.filename):
+            return
+
+        filename = secure_filename(file_upload.filename)
+        tmp_path, num_bytes, content_hash = self._write_upload(file_upload.stream)
+        try:
+            existing = self.index.find(content_hash, num_bytes)
+            if existing is None and find_existing is not None:
+                existing = find_existing(content_hash)
+                existing = existing if existing in self.index else None
+
+            if existing is not None or filename in self.index:
+                os.remove(tmp_path)
+                return SavedImage(existing, content_hash, False) if existing else None
+
+            os.replace(tmp_path, os.path.join(self.upload_path, filename))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.index.refresh(force=True)
+        return SavedImage(filename, content_hash, True)
+
+    def _write_upload(self, stream):
+        """
+        Copy an upload to a temporary file in the uploads folder a chunk at a
+        time, hashing it as it goes. Return the file's path, size and hash.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.upload_path, suffix=".tmp")
+        sha256 = hashlib.sha256()
+        num_bytes = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    num_bytes += len(chunk)
+                    if num_bytes > self.max_bytes:
+                        raise UploadTooLargeError(
+                            f"Uploads can't be over {self.max_bytes} bytes"
+                        )
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, num_bytes, sha256.hexdigest()
 
     def delete_image(self, image_name):
         image = self.get_image(image_name)
         if image:
             os.remove(os.path.join(self.upload_path, image_name))
+            try:
+                os.remove(os.path.join(self.upload_path, get_webp_name(image_name)))
+            except FileNotFoundError:
+                pass
+            self.index.refresh(force=True)
             return image_name
         return
 
+    def process_image(self, image_name, on_step=None):
+        return process_image(
+            os.path.join(self.upload_path, image_name),
+            os.path.join(self.upload_path, get_webp_name(image_name)),
+            on_step,
+        )
+
+
+def get_webp_name(image_name):
+    """
+    The WebP copy made alongside a processed upload. It doesn't have an
+    allowed image type, so it isn't listed as an upload itself.
+    """
+    return f"{image_name}.webp"
+
+
+def process_image(path, webp_path, on_step=None):
+    """
+    Rewrite the image at path the right way up, without its EXIF metadata
+    (e.g. where it was taken), no bigger than PROCESSED_MAX_SIZE and
+    recompressed, then save a WebP copy at webp_path. Animated images are
+    left alone, as are images with no EXIF metadata that are already small
+    enough and don't get any smaller recompressed. on_step is called with
+    the index of each of PROCESSING_STEPS as it starts.
+
+    Return the processed image's width, height, size and content hash, and
+    whether a WebP copy was made.
+    """
+    on_step = on_step or (lambda step: None)
+    with Image.open(path) as original:
+        image_format = original.format
+        icc_profile = original.info.get("icc_profile")
+        is_animated = getattr(original, "is_animated", False)
+
+        if not is_animated and image_format in PROCESSED_SAVE_OPTIONS:
+            on_step(0)
+            image = ImageOps.exif_transpose(original)
+            image.thumbnail((PROCESSED_MAX_SIZE, PROCESSED_MAX_SIZE), Image.LANCZOS)
+            # Recompressing can only lose quality, so only keep it if it's
+            # smaller or something else about the image had to change
+            unchanged = "exif" not in original.info and image.size == original.size
+
+            on_step(1)
+            _save_atomic(
+                image,
+                path,
+                image_format,
+                max_bytes=os.path.getsize(path) if unchanged else None,
+                icc_profile=icc_profile,
+                **PROCESSED_SAVE_OPTIONS[image_format],
+            )
+
+            on_step(2)
+            if image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGBA")
+            _save_atomic(
+                image,
+                webp_path,
+                "WEBP",
+                icc_profile=icc_profile,
+                **PROCESSED_SAVE_OPTIONS["WEBP"],
+            )
+
+    width, height = get_image_dimensions(path)
+    return {
+        "width": width,
+        "height": height,
+        "num_bytes": os.path.getsize(path),
+        "content_hash": hash_file(path),
+        "has_webp": os.path.exists(webp_path),
+    }
+
+
+def _save_atomic(image, path, image_format, max_bytes=None, **options):
+    """
+    Save to a temporary file first, so the image is never seen half written.
+    With max_bytes the file at path is only replaced if the image saves
+    smaller than that.
+    """
+    options = {key: value for key, value in options.items() if value is not None}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            image.save(f, image_format, **options)
+        if max_bytes is not None and os.path.getsize(tmp_path) >= max_bytes:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def make_variant(path, width, image_format):
+    """
+    Resize an image down to width, keeping its aspect ratio, and save it in
+    image_format without its metadata. Return the encoded image.
+    """
+    with Image.open(path) as image:
+        # JPEGs can be decoded at a fraction of their size, much cheaper than
+        # decoding them whole when the variant is a lot smaller
+        image.draft("RGB", (width, width))
+        image = ImageOps.exif_transpose(image)
+
+        if image.width > width:
+            height = max(round(image.height * width / image.width), 1)
+            image = image.resize((width, height), Image.LANCZOS)
+
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA")
+
+        output = io.BytesIO()
+        image.save(output, image_format, **VARIANT_SAVE_OPTIONS[image_format])
+    return output.getvalue()
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_image_dimensions(path):
+    """
+    Return an image's (width, height), only its header is read
+    """
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except (UnidentifiedImageError, OSError):
+        return None, None
+
 
 def is_valid_image(filename):
     if filename == "":
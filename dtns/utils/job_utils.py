@@ -0,0 +1,241 @@
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+
+from flask import current_app
+
+from dtns import db
+from dtns.constants import JobState
+from dtns.models import Job
+
+TASKS = {}
+
+_pool_lock = threading.Lock()
+
+
+class UnknownTaskError(LookupError):
+    pass
+
+
+def task(name):
+    """
+    Register a function as the task run for jobs called name
+    """
+
+    def decorator(f):
+        TASKS[name] = f
+        return f
+
+    return decorator
+
+
+def is_enabled():
+    return current_app.config["JOB_QUEUE_ENABLED"]
+
+
+def enqueue(name, delay=0, unique=False, **kwargs):
+    """
+    Queue a job in the current session's transaction, it's saved when the
+    caller commits.
+    """
+    Job.enqueue(db.session.connection(), name, delay, unique, **kwargs)
+
+
+def defer(name, **kwargs):
+    """
+    Run a task off the request thread: as a job when the job queue is on,
+    saved when the caller commits, otherwise on this process's LocalJobPool.
+    """
+    if is_enabled():
+        return enqueue(name, **kwargs)
+    get_local_pool(current_app._get_current_object()).submit(name, kwargs)
+
+
+class LocalJobPool:
+    """
+    Threads that run tasks in this process for when there's no job queue.
+    Nothing is retried and tasks still waiting are lost if the process
+    stops.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config["JOB_LOCAL_WORKERS"], thread_name_prefix="job"
+        )
+        self.pid = os.getpid()
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def submit(self, name, kwargs):
+        future = self.executor.submit(self._run, name, kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+
+    def join(self):
+        """
+        Wait for every task submitted so far to finish
+        """
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.exception()
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _run(self, name, kwargs):
+        with self.app.app_context():
+            try:
+                TASKS[name](**kwargs)
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception(f"Task {name} failed")
+
+
+def get_local_pool(app):
+    # Started on first use, after any fork, so every process gets its own
+    with _pool_lock:
+        pool = app.extensions.get("job_pool")
+        if pool is None or pool.pid != os.getpid():
+            pool = app.extensions["job_pool"] = LocalJobPool(app)
+        return pool
+
+
+class JobWorker:
+    """
+    Claims jobs from the jobs table and runs their tasks.
+
+    Several workers can share the table. A job is claimed with an UPDATE
+    that only succeeds if the job is still as the worker read it, and
+    finishing or retrying it only succeeds while the claim hasn't run out
+    and been taken over by another worker. Failed jobs are retried with
+    exponential backoff until they run out of attempts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config["JOB_BATCH_SIZE"]
+        self.poll_interval = app.config["JOB_POLL_INTERVAL"]
+        self.retry_delay = app.config["JOB_RETRY_DELAY"]
+        self.visibility_timeout = app.config["JOB_VISIBILITY_TIMEOUT"]
+        self.num_done = 0
+        self.num_failed = 0
+        self._stopping = False
+
+    @property
+    def name(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def run(self, burst=False):
+        """
+        Run jobs until stopped, or with burst until none are ready
+        """
+        with self.app.app_context():
+            while not self._stopping:
+                jobs = self.claim()
+                if not jobs:
+                    if burst:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+
+                for job in jobs:
+                    self.run_job(job)
+
+    def stop(self):
+        """
+        Stop once the jobs already claimed have run
+        """
+        self._stopping = True
+
+    def claim(self):
+        now = datetime.utcnow()
+        ready = (
+            db.session.query(Job.id, Job.run_at)
+            .filter(Job.state != JobState.FAILED, Job.run_at <= now)
+            .order_by(Job.run_at, Job.id)
+            .limit(self.batch_size)
+            .all()
+        )
+
+        claimed = []
+        for job_id, run_at in ready:
+            result = db.session.execute(
+                Job.__table__.update()
+                .where(
+                    Job.id == job_id,
+                    Job.run_at == run_at,
+                    Job.state != JobState.FAILED,
+                )
+                .values(
+                    state=JobState.RUNNING,
+                    attempts=Job.attempts + 1,
+                    run_at=now + timedelta(seconds=self.visibility_timeout),
+                    locked_by=self.name,
+                )
+            )
+            if result.rowcount == 1:
+                claimed.append(job_id)
+        db.session.commit()
+
+        if not claimed:
+            return []
+
+        # Detached so they keep the values they were claimed with, run_at is
+        # what tells this worker's claim apart from a later one
+        jobs = Job.query.filter(Job.id.in_(claimed)).order_by(Job.id).all()
+        for job in jobs:
+            db.session.expunge(job)
+        return jobs
+
+    def run_job(self, job):
+        try:
+            if job.name not in TASKS:
+                raise UnknownTaskError(f"No task called {job.name}")
+            TASKS[job.name](**job.kwargs)
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception(f"Job {job.id} {job.name} failed")
+            self._retry(job, traceback.format_exc())
+            return False
+
+        self._finish(job)
+        return True
+
+    def _owns(self, job):
+        return db.and_(Job.id == job.id, Job.run_at == job.run_at)
+
+    def _finish(self, job):
+        # Deleted in the same transaction as anything the task left
+        # uncommitted, e.g. the jobs it queued
+        result = db.session.execute(Job.__table__.delete().where(self._owns(job)))
+        db.session.commit()
+        self.num_done += 1
+        if result.rowcount != 1:
+            self.app.logger.warning(f"Job {job.id} ran after its claim ran out")
+
+    def _retry(self, job, error):
+        if job.attempts >= job.max_attempts:
+            values = {"state": JobState.FAILED}
+            self.num_failed += 1
+        else:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            values = {
+                "state": JobState.QUEUED,
+                "run_at": datetime.utcnow() + timedelta(seconds=delay),
+            }
+
+        db.session.execute(
+            Job.__table__.update()
+            .where(self._owns(job))
+            .values(locked_by=None, last_error=error, **values)
+        )
+        db.session.commit()
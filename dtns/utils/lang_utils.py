@@ -0,0 +1,99 @@
+import re
+import threading
+from functools import lru_cache
+
+from langdetect.detector_factory import PROFILES_DIRECTORY
+from langdetect.detector_factory import DetectorFactory
+
+# langdetect is random, seeding it makes the same text always get the same
+# language
+DETECTOR_SEED = 0
+DETECT_CACHE_SIZE = 1024
+# Longer text is sampled down to this, it's plenty to tell a language apart
+MAX_SAMPLE_LENGTH = 1200
+
+# Short, common English words that aren't also common words in the languages
+# langdetect most often confuses with English (e.g. "is", "was", "die", "in")
+ENGLISH_STOPWORDS = frozenset(
+    (
+        "about all and are be been but by can could did do does don't for from "
+        "had has have he her his how i i'm i've if it it's its just my not of "
+        "our really she should than that the their them there they this those "
+        "very what when which who why with would you you're your"
+    ).split()
+)
+FAST_PATH_MIN_WORDS = 4
+FAST_PATH_MIN_STOPWORD_RATIO = 0.3
+FAST_PATH_MAX_NON_ASCII_RATIO = 0.05
+
+WORD_RE = re.compile(r"[a-z]+(?:'[a-z]+)?")
+
+_factory = None
+_factory_lock = threading.Lock()
+
+
+def get_factory():
+    """
+    Load langdetect's language profiles once per process. Loading them takes
+    a while, so it's done when the app starts rather than on the first
+    comment.
+    """
+    global _factory
+    with _factory_lock:
+        if _factory is None:
+            factory = DetectorFactory()
+            factory.load_profile(PROFILES_DIRECTORY)
+            factory.set_seed(DETECTOR_SEED)
+            _factory = factory
+        return _factory
+
+
+def is_probably_english(text):
+    """
+    Cheap check for the common case of plainly English text: nearly all ASCII
+    with enough English stopwords among its words.
+    """
+    if not text:
+        return False
+
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    if non_ascii / len(text) > FAST_PATH_MAX_NON_ASCII_RATIO:
+        return False
+
+    words = WORD_RE.findall(text.lower().replace("’", "'"))
+    if len(words) < FAST_PATH_MIN_WORDS:
+        return False
+
+    num_stopwords = sum(1 for word in words if word in ENGLISH_STOPWORDS)
+    return num_stopwords / len(words) >= FAST_PATH_MIN_STOPWORD_RATIO
+
+
+def sample_text(text, max_length=MAX_SAMPLE_LENGTH):
+    """
+    Take the start, middle and end of text longer than max_length, so a long
+    comment that switches language part way through is still caught.
+    """
+    if len(text) <= max_length:
+        return text
+
+    size = max_length // 3
+    start = (len(text) - size) // 2
+    end = start + size
+    return " ".join((text[:size], text[start:end], text[-size:]))
+
+
+@lru_cache(maxsize=DETECT_CACHE_SIZE)
+def _detect(sample):
+    detector = get_factory().create()
+    detector.append(sample)
+    return detector.detect()
+
+
+def detect_language(text):
+    """
+    Return the language code of text, e.g. "en"
+    """
+    sample = sample_text(text)
+    if is_probably_english(sample):
+        return "en"
+    return _detect(sample)
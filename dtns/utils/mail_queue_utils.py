@@ -0,0 +1,185 @@
+import atexit
+import os
+import queue
+import smtplib
+import threading
+import time
+
+from flask import current_app
+from flask_mail import Connection
+
+# Put on the queue to tell the worker to stop once it has sent what's ahead
+STOP = object()
+
+
+class MailQueue:
+    """
+    Sends mail from a single background worker per process.
+
+    The queue is bounded, when it is full senders wait up to
+    MAIL_QUEUE_TIMEOUT for room before the message is dropped. The worker
+    keeps one SMTP connection open while there is mail to send, sends up to
+    MAIL_BATCH_SIZE messages per wake up, retries failures with exponential
+    backoff and sends whatever is queued before the process exits.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["mail_queue"] = MailWorker(app)
+
+    @property
+    def worker(self):
+        return current_app.extensions["mail_queue"]
+
+    def send(self, msg):
+        """
+        Queue a Message, or a callable returning Messages which is called by
+        the worker so rendering them happens off the request thread.
+        """
+        return self.worker.put(msg)
+
+    def join(self):
+        self.worker.join()
+
+
+class MailWorker:
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config["MAIL_BATCH_SIZE"]
+        self.put_timeout = app.config["MAIL_QUEUE_TIMEOUT"]
+        self.max_attempts = app.config["MAIL_MAX_ATTEMPTS"]
+        self.retry_delay = app.config["MAIL_RETRY_DELAY"]
+        self.idle_timeout = app.config["MAIL_IDLE_TIMEOUT"]
+        self.drain_timeout = app.config["MAIL_DRAIN_TIMEOUT"]
+        self.queue = queue.Queue(maxsize=app.config["MAIL_QUEUE_SIZE"])
+        self.connection = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, msg):
+        """
+        Queue msg, return False if it was dropped because the queue is full
+        """
+        self._ensure_started()
+        try:
+            self.queue.put(msg, timeout=self.put_timeout)
+        except queue.Full:
+            subject = getattr(msg, "subject", msg)
+            self.app.logger.error(f"Mail queue full, dropped: {subject}")
+            return False
+        return True
+
+    def join(self):
+        """
+        Wait until every queued message has been sent or given up on
+        """
+        self.queue.join()
+
+    def stop(self):
+        """
+        Send what's already queued then stop the worker
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None or not thread.is_alive() or self._pid != os.getpid():
+                return
+            self._thread = None
+
+        try:
+            self.queue.put(STOP, timeout=self.drain_timeout)
+        except queue.Full:
+            return
+        thread.join(self.drain_timeout)
+
+    def _ensure_started(self):
+        # The worker is started on first use, after any fork, so every
+        # process that sends mail gets its own, and again if it has died.
+        with self._lock:
+            is_new_process = self._pid != os.getpid()
+            if not is_new_process and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="mail-worker", daemon=True
+            )
+            self._thread.start()
+        if is_new_process:
+            atexit.register(self.stop)
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    msg = self.queue.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    self._disconnect()
+                    continue
+
+                batch = self._get_batch(msg)
+                for msg in batch:
+                    if msg is not STOP:
+                        self._process(msg)
+                    self.queue.task_done()
+
+                if batch[-1] is STOP:
+                    self._disconnect()
+                    return
+
+    def _get_batch(self, msg):
+        """
+        Take up to batch_size messages that are already queued
+        """
+        batch = [msg]
+        while len(batch) < self.batch_size and msg is not STOP:
+            try:
+                msg = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(msg)
+        return batch
+
+    def _process(self, msg):
+        if not callable(msg):
+            return self._send(msg)
+        for rendered in self._render(msg):
+            self._send(rendered)
+
+    def _render(self, render):
+        try:
+            return render() or []
+        except Exception:
+            self.app.logger.exception("Failed to render mail")
+            return []
+
+    def _send(self, msg):
+        for attempt in range(self.max_attempts):
+            try:
+                if self.connection is None:
+                    self.connection = Connection(
+                        self.app.extensions["mail"]
+                    ).__enter__()
+                self.connection.send(msg)
+                return True
+            except (smtplib.SMTPException, OSError) as e:
+                self._disconnect()
+                if attempt + 1 == self.max_attempts:
+                    self.app.logger.error(f"Failed to send {msg.subject}: {e}")
+                    return False
+                time.sleep(self.retry_delay * 2**attempt)
+            except Exception:
+                # Not something retrying can fix (e.g. a bad header)
+                self.app.logger.exception(f"Failed to send {msg.subject}")
+                return False
+
+    def _disconnect(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.connection = None
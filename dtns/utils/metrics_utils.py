@@ -0,0 +1,229 @@
+import ipaddress
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app
+from flask import g
+from flask import has_request_context
+from flask import request
+from flask import template_rendered
+from flask.signals import before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRIC_PREFIX = "dtns"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """
+    Prometheus style histogram: a count per upper bound, plus the overall sum
+    and count of observed values.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        total = 0
+        for bound, bucket_count in zip((*self.buckets, "+Inf"), self.bucket_counts):
+            total += bucket_count
+            yield bound, total
+
+
+class RequestMetric:
+    DB_DURATION = "request_db_duration_seconds"
+    DB_STATEMENTS = "request_db_statements"
+    DURATION = "request_duration_seconds"
+    TEMPLATE_DURATION = "request_template_duration_seconds"
+
+
+METRIC_HELP = {
+    RequestMetric.DB_DURATION: ("Time spent running SQL per request", DURATION_BUCKETS),
+    RequestMetric.DB_STATEMENTS: ("SQL statements run per request", COUNT_BUCKETS),
+    RequestMetric.DURATION: ("Total time to handle a request", DURATION_BUCKETS),
+    RequestMetric.TEMPLATE_DURATION: (
+        "Time spent rendering templates per request",
+        DURATION_BUCKETS,
+    ),
+}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, endpoint, value):
+        with self._lock:
+            key = (name, endpoint)
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(METRIC_HELP[name][1])
+            self._histograms[key].observe(value)
+
+    def get(self, name, endpoint):
+        return self._histograms.get((name, endpoint))
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self):
+        """
+        Return every histogram in the Prometheus text exposition format
+        """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+
+        lines = []
+        for name in sorted(METRIC_HELP):
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {METRIC_HELP[name][0]}")
+            lines.append(f"# TYPE {metric} histogram")
+            for (histogram_name, endpoint), histogram in histograms:
+                if histogram_name != name:
+                    continue
+                labels = f'endpoint="{escape_label(endpoint)}"'
+                for bound, count in histogram.get_cumulative_counts():
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f"{metric}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RequestStats:
+    __slots__ = (
+        "start",
+        "db_statements",
+        "db_duration",
+        "template_duration",
+        "template_depth",
+        "template_start",
+    )
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_statements = 0
+        self.db_duration = 0.0
+        self.template_duration = 0.0
+        self.template_depth = 0
+        self.template_start = None
+
+
+class Metrics:
+    """
+    Records per-endpoint SQL statement counts, SQL time, template render time
+    and total latency for every request.
+
+    Only a few counters are updated per statement and per request, so it is
+    left on in production. Set METRICS_ENABLED to False to turn it off.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["metrics"] = MetricsRegistry()
+        if not app.config["METRICS_ENABLED"]:
+            return
+
+        app.before_request(start_request)
+        app.teardown_request(finish_request)
+        before_render_template.connect(start_template, app)
+        template_rendered.connect(finish_template, app)
+
+    @property
+    def registry(self):
+        return current_app.extensions["metrics"]
+
+
+def get_request_stats():
+    if not has_request_context():
+        return
+    return g.get("_request_stats")
+
+
+def start_request():
+    g._request_stats = RequestStats()
+
+
+def finish_request(exc=None):
+    stats = g.pop("_request_stats", None)
+    if stats is None:
+        return
+
+    endpoint = request.endpoint or "unmatched"
+    registry = current_app.extensions["metrics"]
+    registry.observe(RequestMetric.DB_STATEMENTS, endpoint, stats.db_statements)
+    registry.observe(RequestMetric.DB_DURATION, endpoint, stats.db_duration)
+    registry.observe(RequestMetric.TEMPLATE_DURATION, endpoint, stats.template_duration)
+    registry.observe(
+        RequestMetric.DURATION, endpoint, time.perf_counter() - stats.start
+    )
+
+
+def start_template(sender, template, context, **extra):
+    stats = get_request_stats()
+    if stats is None:
+        return
+    # Templates can render other templates (e.g. an ajax fragment rendered
+    # into a page) so only time the outermost one.
+    if stats.template_depth == 0:
+        stats.template_start = time.perf_counter()
+    stats.template_depth += 1
+
+
+def finish_template(sender, template, context, **extra):
+    stats = get_request_stats()
+    if stats is None or stats.template_depth == 0:
+        return
+    stats.template_depth -= 1
+    if stats.template_depth == 0:
+        stats.template_duration += time.perf_counter() - stats.template_start
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if get_request_stats() is not None:
+        conn.info.setdefault("_statement_starts", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    stats = get_request_stats()
+    starts = conn.info.get("_statement_starts")
+    if stats is None or not starts:
+        return
+    stats.db_statements += 1
+    stats.db_duration += time.perf_counter() - starts.pop()
+
+
+@event.listens_for(Engine, "handle_error")
+def fail_statement(context):
+    starts = context.connection.info.get("_statement_starts")
+    if starts:
+        starts.pop()
+
+
+def is_local_request():
+    try:
+        return ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
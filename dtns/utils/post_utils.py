@@ -1,9 +1,13 @@
+import binascii
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
 from datetime import datetime
 
 from flask import current_app
 from flask import url_for
 from itsdangerous.url_safe import URLSafeTimedSerializer
-from langdetect import detect
+
+from dtns.utils import lang_utils
 
 TEMP_PREVIEW_MAX_AGE = 30 * 60
 TOGGLE_COMMENT_MAX_AGE = 24 * 60 * 60
@@ -13,6 +17,10 @@ class UnsupportedLanguageError(Exception):
     pass
 
 
+class InvalidCursorError(ValueError):
+    pass
+
+
 class TokenType:
     TEMP_PREVIEW = "temp-preview"
     TOGGLE_COMMENT = "toggle-comment"
@@ -24,13 +32,54 @@ TOKEN_TYPE_TO_MAX_AGE_MAP = {
 }
 
 
-def aggregate_and_sort_posts_by_month_year(posts):
-    archive_posts = list({post.published_at.strftime("%B %Y") for post in posts})
-    return sorted(
-        archive_posts,
-        key=lambda post: datetime.strptime(post, "%B %Y"),
-        reverse=True,
-    )
+def get_month_range(dt):
+    """
+    Return the [start, end) datetimes of the month containing dt
+    """
+    start = datetime(dt.year, dt.month, 1)
+    if dt.month == 12:
+        return start, datetime(dt.year + 1, 1, 1)
+    return start, datetime(dt.year, dt.month + 1, 1)
+
+
+def get_month_year_range(month_year):
+    """
+    Return the [start, end) datetimes for a month year like "November 2021"
+    """
+    return get_month_range(datetime.strptime(month_year, "%B %Y"))
+
+
+def encode_cursor(dt, id):
+    """
+    Encode the sort key of the last row on a page as an opaque cursor
+    """
+    value = f"{dt.isoformat()}|{id}".encode()
+    return urlsafe_b64encode(value).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Return the (datetime, id) sort key for a cursor from encode_cursor
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        value = urlsafe_b64decode(cursor + padding).decode()
+        dt, id = value.split("|")
+        return datetime.fromisoformat(dt), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}") from e
+
+
+def get_listing_filters(args):
+    """
+    The search, state and order asked for in an admin listing's query string,
+    as keyword arguments for its page query
+    """
+    return {
+        "search": args.get("q") or None,
+        "state": args.get("state") or None,
+        "oldest_first": args.get("order") == "oldest",
+    }
 
 
 def generate_temp_token(obj):
@@ -59,6 +108,6 @@ def validate_token(token, token_type):
 
 
 def validate_comment_text(text):
-    lang = detect(text)
+    lang = lang_utils.detect_language(text)
     if lang != "en":
         raise UnsupportedLanguageError(f"Language of {lang} is not supported.")
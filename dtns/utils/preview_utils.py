@@ -0,0 +1,132 @@
+import secrets
+import threading
+from collections import OrderedDict
+from collections import namedtuple
+
+from flask import current_app
+from flask import session
+
+from dtns.utils import render_utils
+
+MAX_EDITOR_ID_LENGTH = 64
+
+Preview = namedtuple("Preview", ["source", "source_hash", "html"])
+
+
+class InvalidPatchError(ValueError):
+    pass
+
+
+class StalePreviewError(ValueError):
+    """
+    The patch was made against a source this process no longer has, the
+    editor has to send its whole source instead.
+    """
+
+
+class PreviewSessions:
+    """
+    The last preview rendered for each editor, least recently used dropped
+    first once there are more than max_size.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._previews = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._previews:
+                return
+            self._previews.move_to_end(key)
+            return self._previews[key]
+
+    def set(self, key, preview):
+        with self._lock:
+            self._previews[key] = preview
+            self._previews.move_to_end(key)
+            while len(self._previews) > self.max_size:
+                self._previews.popitem(last=False)
+
+
+class PreviewCache:
+    """
+    Renders editor previews, remembering each editor's last source and html
+    so an unchanged source isn't rendered again and editors can send a patch
+    against it instead of the whole source.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["preview_cache"] = PreviewSessions(
+            app.config["PREVIEW_CACHE_SIZE"]
+        )
+
+    @property
+    def sessions(self):
+        return current_app.extensions["preview_cache"]
+
+    def get_source(self, key, form):
+        """
+        Return the source sent in form, either whole as "source" or as a
+        "patch" replacing "start" to "end" of the source with "base_hash".
+
+        The editor works out patches on its text, which has "\n" newlines,
+        but form posts send "\r\n" so newlines are made "\n" again first.
+        """
+        if "source" in form:
+            return normalize_newlines(form["source"])
+
+        preview = self.sessions.get(key)
+        if preview is None or preview.source_hash != form.get("base_hash"):
+            raise StalePreviewError("No source to patch")
+
+        patch = form.get("patch")
+        return apply_patch(
+            preview.source,
+            form.get("start"),
+            form.get("end"),
+            normalize_newlines(patch) if patch is not None else None,
+        )
+
+    def render(self, key, source):
+        # Patches are applied to the source kept here, so it has to match the
+        # editor's text
+        source = normalize_newlines(source)
+        source_hash = render_utils.hash_source(source)
+        preview = self.sessions.get(key)
+        if preview is not None and preview.source_hash == source_hash:
+            return preview
+
+        preview = Preview(source, source_hash, render_utils.render_source(source))
+        self.sessions.set(key, preview)
+        return preview
+
+
+def apply_patch(source, start, end, text):
+    try:
+        start, end = int(start), int(end)
+    except (TypeError, ValueError):
+        raise InvalidPatchError("Patch start and end must be integers")
+
+    if text is None or not 0 <= start <= end <= len(source):
+        raise InvalidPatchError("Patch doesn't fit the source")
+
+    return source[:start] + text + source[end:]
+
+
+def normalize_newlines(text):
+    return render_utils.NEWLINES_RE.sub("\n", text)
+
+
+def get_preview_key(editor_id):
+    """
+    Previews are kept per browser session and editor (i.e. per open tab)
+    """
+    if "preview_id" not in session:
+        session["preview_id"] = secrets.token_hex(16)
+    return f"{session['preview_id']}:{editor_id[:MAX_EDITOR_ID_LENGTH]}"
@@ -1,8 +1,20 @@
+import functools
+import hashlib
+import re
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 
 from markdown_it import MarkdownIt
 
+# Bump whenever md's configuration or render rules change so posts rendered
+# with the old rules are known to be stale.
+RENDERER_VERSION = 1
+
+# Number of rendered top-level blocks kept by render_block
+RENDER_CACHE_SIZE = 4096
+
+NEWLINES_RE = re.compile(r"\r\n?")
+
 
 def render_blank_link(self, tokens, idx, options, env):
     """
@@ -74,3 +86,58 @@ def render_youtube_pin_or_board(self, tokens, idx, options, env):
 md = MarkdownIt("commonmark").enable("strikethrough")
 md.add_render_rule("image", render_youtube_pin_or_board)
 md.add_render_rule("link_open", render_blank_link)
+
+# Only finds where md's top-level blocks start and end so it has to enable
+# the same block rules as md.
+block_md = MarkdownIt("commonmark")
+block_md.core.ruler.enableOnly(["normalize", "block"])
+
+
+def hash_source(source):
+    return hashlib.sha256((source or "").encode()).hexdigest()
+
+
+def normalize_source(source):
+    return NEWLINES_RE.sub("\n", source or "").replace("\0", "\ufffd")
+
+
+def split_blocks(source):
+    """
+    Split normalized source into the source of each top-level block.
+
+    Returns None when the blocks can't be rendered on their own, i.e. when
+    link reference definitions are used since they apply to the whole post.
+    """
+    env = {}
+    tokens = block_md.parse(source, env)
+    if env.get("references"):
+        return
+
+    line_offsets = [0]
+    for line in source.split("\n"):
+        line_offsets.append(line_offsets[-1] + len(line) + 1)
+    line_offsets[-1] = len(source)
+
+    blocks = []
+    for token in tokens:
+        if token.level == 0 and token.map and token.nesting >= 0:
+            start, end = (line_offsets[line] for line in token.map)
+            blocks.append(source[start:end])
+    return blocks
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_block(block):
+    return md.render(block)
+
+
+def render_source(source):
+    """
+    Render source a top-level block at a time so blocks that haven't changed
+    since they were last rendered come from render_block's cache.
+    """
+    source = normalize_source(source)
+    blocks = split_blocks(source)
+    if blocks is None:
+        return md.render(source)
+    return "".join(render_block(block) for block in blocks)
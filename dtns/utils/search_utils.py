@@ -0,0 +1,252 @@
+import math
+import re
+import weakref
+from collections import defaultdict
+
+from sqlalchemy import text
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+MAX_TERM_LENGTH = 64
+MIN_PREFIX_LENGTH = 2
+
+# Gap inserted between indexed fields so a phrase can't span title and body
+FIELD_POSITION_GAP = 100
+
+PHRASE_BONUS = 0.5
+
+DOUBLE_CONSONANT_EXCEPTIONS = ("l", "s", "z")
+
+# InnoDB ignores words shorter than innodb_ft_min_token_size (3 by default)
+MYSQL_MIN_TOKEN_LENGTH = 3
+
+SQLITE_FTS_TABLE = "posts_fts"
+MYSQL_FULLTEXT_INDEX = "ix_posts_fulltext"
+
+SQLITE_FTS_DDL = [
+    f"""
+    CREATE VIRTUAL TABLE {SQLITE_FTS_TABLE} USING fts5(
+        title, description, source,
+        content='posts', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    f"""
+    CREATE TRIGGER {SQLITE_FTS_TABLE}_ai AFTER INSERT ON posts BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, title, description, source)
+        VALUES (new.id, new.title, new.description, new.source);
+    END
+    """,
+    f"""
+    CREATE TRIGGER {SQLITE_FTS_TABLE}_ad AFTER DELETE ON posts BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, title, description, source)
+        VALUES ('delete', old.id, old.title, old.description, old.source);
+    END
+    """,
+    f"""
+    CREATE TRIGGER {SQLITE_FTS_TABLE}_au AFTER UPDATE OF title, description, source ON posts BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, title, description, source)
+        VALUES ('delete', old.id, old.title, old.description, old.source);
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, title, description, source)
+        VALUES (new.id, new.title, new.description, new.source);
+    END
+    """,
+    f"INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_FTS_DROP_DDL = [
+    f"DROP TRIGGER IF EXISTS {SQLITE_FTS_TABLE}_au",
+    f"DROP TRIGGER IF EXISTS {SQLITE_FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {SQLITE_FTS_TABLE}_ai",
+    f"DROP TABLE IF EXISTS {SQLITE_FTS_TABLE}",
+]
+
+
+class SearchBackend:
+    AUTO = "auto"
+    INDEX = "index"
+    LIKE = "like"
+    MYSQL_FULLTEXT = "mysql-fulltext"
+    SQLITE_FTS = "sqlite-fts"
+
+
+_detected_backends = weakref.WeakKeyDictionary()
+
+
+def tokenize(text):
+    """
+    Split text into lowercase alphanumeric tokens
+    """
+    if not text:
+        return []
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(text.lower())]
+
+
+def stem(token):
+    """
+    A light suffix-stripping stemmer so "posts", "posted" and "posting" all
+    index as "post".
+    """
+    if len(token) <= 3 or token.isdigit():
+        return token
+
+    if token.endswith("ies") and len(token) > 4:
+        return token[:-3] + "y"
+    if token.endswith("sses"):
+        return token[:-2]
+
+    for suffix in ("ing", "ed"):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            token = token[: -len(suffix)]
+            if (
+                token[-1] == token[-2]
+                and token[-1] not in "aeiou"
+                and token[-1] not in DOUBLE_CONSONANT_EXCEPTIONS
+            ):
+                token = token[:-1]
+            break
+    else:
+        if token.endswith("s") and not token.endswith(("ss", "us", "is")):
+            token = token[:-1]
+
+    if token.endswith("e") and len(token) > 4:
+        token = token[:-1]
+
+    return token
+
+
+def analyze(text):
+    """
+    Return the stemmed terms for text in the order they appear
+    """
+    return [stem(token) for token in tokenize(text)]
+
+
+def build_postings(*fields):
+    """
+    Return a {term: [positions]} lookup for the given text fields
+    """
+    postings = defaultdict(list)
+    offset = 0
+    for field in fields:
+        terms = analyze(field)
+        for position, term in enumerate(terms, start=offset):
+            postings[term].append(position)
+        offset += len(terms) + FIELD_POSITION_GAP
+    return dict(postings)
+
+
+def serialize_positions(positions):
+    return ",".join(str(position) for position in positions)
+
+
+def deserialize_positions(positions):
+    return [int(position) for position in positions.split(",") if position]
+
+
+def rank(postings, num_docs):
+    """
+    Rank posts matching every query term.
+
+    postings is a list of lookups (one per query term) of
+    {post_id: (frequency, positions)} and num_docs the number of posts in the
+    index. Posts are scored with tf-idf and get a bonus for each pair of query
+    terms that appear next to each other.
+    """
+    if not postings or not all(postings):
+        return []
+
+    candidates = set.intersection(*(set(posting) for posting in postings))
+    if not candidates:
+        return []
+
+    scores = {}
+    for post_id in candidates:
+        score = 0.0
+        for posting in postings:
+            frequency = posting[post_id][0]
+            idf = math.log(1 + num_docs / len(posting))
+            score += (1 + math.log(frequency)) * idf
+
+        for current, following in zip(postings, postings[1:]):
+            next_positions = set(following[post_id][1])
+            if any(position + 1 in next_positions for position in current[post_id][1]):
+                score += PHRASE_BONUS
+
+        scores[post_id] = score
+
+    return sorted(candidates, key=lambda post_id: (-scores[post_id], post_id))
+
+
+def get_search_backend(engine, configured=SearchBackend.AUTO):
+    """
+    Return the search backend to use for an engine.
+
+    With "auto" the database's own full-text search is preferred, then the
+    search_terms index and finally a LIKE scan when neither is set up.
+    """
+    if configured != SearchBackend.AUTO:
+        return configured
+
+    if engine not in _detected_backends:
+        _detected_backends[engine] = _detect_search_backend(engine)
+    return _detected_backends[engine]
+
+
+def reset_search_backend(engine):
+    _detected_backends.pop(engine, None)
+
+
+def _detect_search_backend(engine):
+    with engine.connect() as connection:
+        if engine.dialect.name == "sqlite" and engine.dialect.has_table(
+            connection, SQLITE_FTS_TABLE
+        ):
+            return SearchBackend.SQLITE_FTS
+
+        if (
+            engine.dialect.name in ("mysql", "mariadb")
+            and connection.execute(
+                text(
+                    "SELECT 1 FROM information_schema.statistics "
+                    "WHERE table_schema = DATABASE() AND table_name = 'posts' "
+                    "AND index_name = :index_name LIMIT 1"
+                ),
+                {"index_name": MYSQL_FULLTEXT_INDEX},
+            ).first()
+        ):
+            return SearchBackend.MYSQL_FULLTEXT
+
+        if engine.dialect.has_table(connection, "search_terms"):
+            return SearchBackend.INDEX
+
+    return SearchBackend.LIKE
+
+
+def build_sqlite_fts_query(search_terms):
+    """
+    Return an FTS5 MATCH expression requiring every token, the last one as a
+    prefix.
+    """
+    tokens = tokenize(search_terms)
+    if not tokens:
+        return
+    *complete_tokens, last_token = tokens
+    return " ".join([f'"{token}"' for token in complete_tokens] + [f'"{last_token}"*'])
+
+
+def build_mysql_boolean_query(search_terms):
+    """
+    Return a boolean mode AGAINST expression requiring every token, the last
+    one as a prefix. Words shorter than the full-text index's minimum aren't
+    indexed so can't be required, but a short last token is still a prefix of
+    the longer word being typed.
+    """
+    tokens = tokenize(search_terms)
+    if not tokens:
+        return
+    *complete_tokens, last_token = tokens
+    terms = [
+        f"+{token}" for token in complete_tokens if len(token) >= MYSQL_MIN_TOKEN_LENGTH
+    ]
+    if len(last_token) >= MIN_PREFIX_LENGTH:
+        terms.append(f"+{last_token}*")
+    return " ".join(terms) or None
@@ -6,6 +6,8 @@ from logging.config import fileConfig
 from alembic import context
 from flask import current_app
 
+from dtns.utils import search_utils
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -31,6 +33,19 @@ target_metadata = current_app.extensions["migrate"].db.metadata
 # ... etc.
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    Leave the full-text search index and tables made by the a7cfd30bb62d
+    migration out of autogenerate, they aren't declared on the models.
+    """
+    if reflected and compare_to is None:
+        if type_ == "index" and name == search_utils.MYSQL_FULLTEXT_INDEX:
+            return False
+        if type_ == "table" and name.startswith(search_utils.SQLITE_FTS_TABLE):
+            return False
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -45,7 +60,11 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True, compare_type=True
+        url=url,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        compare_type=True,
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -77,6 +96,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             compare_type=True,
+            include_object=include_object,
             process_revision_directives=process_revision_directives,
             **current_app.extensions["migrate"].configure_args
         )
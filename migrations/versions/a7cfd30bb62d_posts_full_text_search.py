@@ -0,0 +1,44 @@
+"""posts full text search
+
+Revision ID: a7cfd30bb62d
+Revises: ffed8790d3fb
+Create Date: 2026-10-18 10:03:27.914520
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+from dtns.utils import search_utils
+
+# revision identifiers, used by Alembic.
+revision = "a7cfd30bb62d"
+down_revision = "ffed8790d3fb"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == "sqlite":
+        for statement in search_utils.SQLITE_FTS_DDL:
+            op.execute(statement)
+    elif dialect in ("mysql", "mariadb"):
+        op.create_index(
+            search_utils.MYSQL_FULLTEXT_INDEX,
+            "posts",
+            ["title", "description", "source"],
+            unique=False,
+            mysql_prefix="FULLTEXT",
+        )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == "sqlite":
+        for statement in search_utils.SQLITE_FTS_DROP_DDL:
+            op.execute(statement)
+    elif dialect in ("mysql", "mariadb"):
+        op.drop_index(search_utils.MYSQL_FULLTEXT_INDEX, table_name="posts")
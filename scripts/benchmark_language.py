@@ -0,0 +1,83 @@
+import random
+import time
+
+import click
+from langdetect import detect
+
+from dtns.utils import lang_utils
+
+COMMENTS = [
+    "Great post, thanks for sharing this with all of us!",
+    "I think the pandas approach is cleaner than what I was doing before.",
+    "Just leaving a comment!",
+    "Does this work with Postgres too or only with SQLite?",
+    "Thanks, this was exactly what I needed for my dbt project.",
+    "Estoy muy feliz de ver este blog hoy, gracias amigos.",
+    "Je pense que c'est une bonne idée pour le blog.",
+    "Ich habe das ausprobiert und es funktioniert sehr gut.",
+    "Questo articolo è molto utile, grazie mille.",
+    "Эта статья очень полезна, спасибо.",
+]
+
+
+def _make_corpus(size, long_ratio, seed):
+    """
+    Make size comments drawn from COMMENTS, with some repeated into long
+    comments and some exact repeats, like a real comment stream.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        comment = rng.choice(COMMENTS)
+        if rng.random() < long_ratio:
+            comment = " ".join(rng.choice(COMMENTS) for _ in range(200))
+        corpus.append(comment)
+    return corpus
+
+
+def _time(func, corpus):
+    start = time.perf_counter()
+    results = [func(comment) for comment in corpus]
+    return time.perf_counter() - start, results
+
+
+@click.command()
+@click.option("--size", default=500, show_default=True, help="Number of comments.")
+@click.option(
+    "--long-ratio",
+    default=0.1,
+    show_default=True,
+    help="Share of comments that are a couple of hundred sentences long.",
+)
+@click.option("--seed", default=0, show_default=True, help="Seed for the corpus.")
+def benchmark_language(size, long_ratio, seed):
+    """
+    Compare plain langdetect against lang_utils on a corpus of comments,
+    including the one-off cost of loading langdetect's profiles.
+
+    Run from the repository root with: PYTHONPATH=. python scripts/benchmark_language.py
+    """
+    corpus = _make_corpus(size, long_ratio, seed)
+
+    start = time.perf_counter()
+    lang_utils.get_factory()
+    load_time = time.perf_counter() - start
+
+    plain_time, plain_results = _time(detect, corpus)
+    lang_utils._detect.cache_clear()
+    cold_time, results = _time(lang_utils.detect_language, corpus)
+    warm_time, _ = _time(lang_utils.detect_language, corpus)
+
+    agreement = sum(a == b for a, b in zip(plain_results, results)) / size
+    click.echo(f"{size} comments, {long_ratio:.0%} long")
+    click.echo(f"Profile load:         {load_time * 1000:8.2f}ms")
+    click.echo(f"langdetect:           {plain_time / size * 1000:8.2f}ms/comment")
+    click.echo(f"lang_utils (cold):    {cold_time / size * 1000:8.2f}ms/comment")
+    click.echo(f"lang_utils (warm):    {warm_time / size * 1000:8.2f}ms/comment")
+    click.echo(f"Speedup (cold):       {plain_time / cold_time:8.1f}x")
+    click.echo(f"Agreement:            {agreement:8.1%}")
+    click.echo(f"Cache: {lang_utils._detect.cache_info()}")
+
+
+if __name__ == "__main__":
+    benchmark_language()
@@ -0,0 +1,85 @@
+import random
+import time
+
+import click
+
+from dtns.utils import render_utils
+
+BLOCKS = [
+    "## A heading about {word}",
+    "Some text about {word} with *emphasis*, `code` and a "
+    "[link](https://datathingsandstuff.com/{word}).\nIt carries on for another "
+    "line or two so the paragraph is a realistic size for a post.",
+    "- a list item about {word}\n- another item\n- and one more",
+    "```python\ndef {word}():\n    return {{'{word}': 1}}\n```",
+    "> A quote about {word}\nthat wraps onto a second line.",
+    "![An image of {word}](/static/uploads/{word}.jpg)",
+]
+
+WORDS = ["data", "things", "stuff", "sql", "python", "flask", "pandas", "dbt"]
+
+
+def _make_source(size_kb, seed):
+    """
+    Make a synthetic post of roughly size_kb from a mix of markdown blocks
+    """
+    rng = random.Random(seed)
+    blocks = []
+    size = 0
+    while size < size_kb * 1024:
+        block = rng.choice(BLOCKS).format(word=rng.choice(WORDS) + str(len(blocks)))
+        blocks.append(block)
+        size += len(block) + 2
+    return blocks
+
+
+def _time(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+@click.command()
+@click.option("--size-kb", default=50, show_default=True, help="Size of each post.")
+@click.option(
+    "--iterations", default=20, show_default=True, help="Renders to average over."
+)
+@click.option("--seed", default=0, show_default=True, help="Seed for the posts.")
+def benchmark_render(size_kb, iterations, seed):
+    """
+    Compare rendering a whole post against rendering it a block at a time
+    when one paragraph changes between renders, like successive autosaves.
+
+    Run from the repository root with: PYTHONPATH=. python scripts/benchmark_render.py
+    """
+    blocks = _make_source(size_kb, seed)
+    sources = []
+    for i in range(iterations):
+        edited = list(blocks)
+        index = i % len(edited)
+        edited[index] = f"An edited paragraph, revision {i}."
+        sources.append("\n\n".join(edited))
+
+    click.echo(f"{len(blocks)} blocks, {len(sources[0]) / 1024:.1f}KB per post")
+
+    full = iter(sources)
+    full_time = _time(lambda: render_utils.md.render(next(full)), iterations)
+
+    render_utils.render_block.cache_clear()
+    cold_time = _time(lambda: render_utils.render_source(sources[0]), 1)
+
+    incremental = iter(sources)
+    incremental_time = _time(
+        lambda: render_utils.render_source(next(incremental)), iterations
+    )
+
+    click.echo(f"Full render:          {full_time * 1000:8.2f}ms")
+    click.echo(f"Block render (cold):  {cold_time * 1000:8.2f}ms")
+    click.echo(f"Block render (edit):  {incremental_time * 1000:8.2f}ms")
+    click.echo(f"Speedup on edit:      {full_time / incremental_time:8.1f}x")
+    click.echo(f"Cache: {render_utils.render_block.cache_info()}")
+
+
+if __name__ == "__main__":
+    benchmark_render()
@@ -1,19 +1,29 @@
 import glob
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 
 import click
 from PIL import Image
 
+DEFAULT_WIDTH = 1000
+DEFAULT_HEIGHT = 666
 
-def _get_file_list(image_dir):
+
+def _get_file_list(image_dir, resize_name=None):
     """
-    Get a list of .JPGs for given directory
+    Get a list of .JPGs for given directory, leaving out images already
+    resized to resize_name
     """
     file_list = sorted(
         [
             file
             for file in glob.glob(os.path.join(image_dir, "*.JPG"))
             if "_resize" not in file
+            and not (
+                resize_name and os.path.basename(file).startswith(f"{resize_name}_")
+            )
         ]
     )
     return file_list
@@ -32,11 +42,80 @@ def _get_image_rename_lookup(file_list, resize_name):
     return lookup
 
 
-def _resize_rename_images(lookup, dry_run):
+def _fit_size(size, box):
+    """
+    Scale size down to fit inside box, keeping its aspect ratio
+    """
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def _is_up_to_date(old_name, new_name):
+    """
+    Whether new_name was already made from the current old_name. Outputs are
+    numbered by their input's place in the list, so adding or removing an
+    input changes which one an output should be made from, each output
+    records its input's name to check against.
+    """
+    if not os.path.exists(new_name):
+        return False
+    if os.path.getmtime(new_name) < os.path.getmtime(old_name):
+        return False
+    try:
+        with Image.open(new_name) as new_img:
+            source = new_img.info.get("comment")
+    except OSError:
+        return False
+    return source == os.path.basename(old_name).encode()
+
+
+def _resize_image(old_name, new_name, box):
+    """
+    Resize one image to fit box and save it as new_name. Runs in a worker
+    process, so it returns what happened rather than printing it.
+    """
+    start = time.perf_counter()
+    with Image.open(old_name) as old_img:
+        size = _fit_size(old_img.size, box)
+        # Let the JPEG decoder scale down by up to 8x while decoding, which
+        # is much cheaper than decoding the full image and resampling it all
+        old_img.draft("RGB", size)
+        new_img = old_img.resize(size, Image.LANCZOS)
+
+    new_img.save(
+        new_name,
+        optimize=True,
+        quality="web_maximum",
+        comment=os.path.basename(old_name),
+    )
+    new_img.close()
+    return {
+        "name": os.path.basename(new_name),
+        "size": size,
+        "bytes_in": os.path.getsize(old_name),
+        "bytes_out": os.path.getsize(new_name),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _report(result):
+    width, height = result["size"]
+    click.echo(
+        f"{result['name']}: {width}x{height}, "
+        f"{result['bytes_in'] / 1024:.0f}KB -> {result['bytes_out'] / 1024:.0f}KB "
+        f"in {result['seconds'] * 1000:.0f}ms"
+    )
+
+
+def _resize_rename_images(lookup, dry_run, box=None, workers=1, force=False):
     """
-    Resize image and save with new name
+    Resize images and save with new names, skipping any already resized
+    since the image last changed unless force is set
     """
+    box = box or (DEFAULT_WIDTH, DEFAULT_HEIGHT)
     count = 0
+    todo = []
     for old_name, new_name in lookup.items():
         if dry_run:
             old_image_name = old_name.split("/")[-1]
@@ -48,15 +127,39 @@ def _resize_rename_images(lookup, dry_run):
             count += 1
             continue
 
-        old_img = Image.open(old_name)
-
-        new_img = old_img.resize((1000, 666), Image.LANCZOS)
-        old_img.close()
+        if not force and _is_up_to_date(old_name, new_name):
+            click.echo(f"{new_name.split('/')[-1]}: up to date, skipped")
+            continue
 
-        new_img.save(new_name, optimize=True, quality="web_maximum")
-        new_img.close()
-        count += 1
-    return count
+        todo.append((old_name, new_name))
+
+    if not todo:
+        return count
+
+    start = time.perf_counter()
+    results = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_resize_image, old_name, new_name, box)
+                for old_name, new_name in todo
+            ]
+            for future in as_completed(futures):
+                results.append(future.result())
+                _report(results[-1])
+    else:
+        for old_name, new_name in todo:
+            results.append(_resize_image(old_name, new_name, box))
+            _report(results[-1])
+    elapsed = time.perf_counter() - start
+
+    megabytes_in = sum(result["bytes_in"] for result in results) / 1024 / 1024
+    click.echo(
+        f"Resized {len(results)} images ({megabytes_in:.1f}MB) in {elapsed:.2f}s "
+        f"with {workers} worker{'s' if workers > 1 else ''}: "
+        f"{len(results) / elapsed:.1f} images/s, {megabytes_in / elapsed:.1f}MB/s"
+    )
+    return count + len(results)
 
 
 @click.command()
@@ -76,20 +179,45 @@ def _resize_rename_images(lookup, dry_run):
     is_flag=True,
     help="See the changes before actually making them.",
 )
-def resize_images(image_dir, resize_name, dry_run):
+@click.option(
+    "--width",
+    default=DEFAULT_WIDTH,
+    show_default=True,
+    help="Maximum width, images keep their aspect ratio.",
+)
+@click.option(
+    "--height",
+    default=DEFAULT_HEIGHT,
+    show_default=True,
+    help="Maximum height, images keep their aspect ratio.",
+)
+@click.option(
+    "--workers",
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of processes to resize with. 1 resizes in this process.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Resize images even if they were already resized since they changed.",
+)
+def resize_images(image_dir, resize_name, dry_run, width, height, workers, force):
     """
     A simple script for resizing and compressing images (.JPG)
     """
     click.echo(f"Looking for images to resize in: {image_dir}")
     click.echo(f"Images will be renamed with: {resize_name}")
 
-    file_list = _get_file_list(image_dir)
+    file_list = _get_file_list(image_dir, resize_name)
 
     click.echo(f"{len(file_list)} images found in: {image_dir}")
 
     lookup = _get_image_rename_lookup(file_list, resize_name)
 
-    resize_count = _resize_rename_images(lookup, dry_run)
+    resize_count = _resize_rename_images(
+        lookup, dry_run, (width, height), workers, force
+    )
 
     click.echo(
         f"{resize_count} images{' would be ' if dry_run else ' '}resized and renamed!"
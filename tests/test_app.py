@@ -1,7 +1,9 @@
 import unittest
+from unittest import mock
 
 from flask import current_app
 
+from config import TestingConfig
 from dtns import create_app
 
 
@@ -24,6 +26,19 @@ class TestingAppTestCase(unittest.TestCase):
     def test_sentry_dsn_is_none(self):
         self.assertIsNone(current_app.config["SENTRY_DSN"])
 
+    @mock.patch.object(TestingConfig, "COMMENT_DIGEST_INTERVAL", 60)
+    def test_comment_digest_without_job_queue_warns(self):
+        with self.assertLogs("dtns", "WARNING") as logs:
+            create_app("testing")
+
+        self.assertIn("COMMENT_DIGEST_INTERVAL needs JOB_QUEUE_ENABLED", logs.output[0])
+
+    @mock.patch.object(TestingConfig, "COMMENT_DIGEST_INTERVAL", 60)
+    @mock.patch.object(TestingConfig, "JOB_QUEUE_ENABLED", True)
+    def test_comment_digest_with_job_queue(self):
+        with self.assertNoLogs("dtns", "WARNING"):
+            create_app("testing")
+
 
 class AppConfigTestCase(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,127 @@
+import unittest
+from datetime import datetime
+
+from dtns import create_app
+from dtns import db
+from dtns.commands import render_batch
+from dtns.commands import render_posts
+from dtns.commands import run_jobs
+from dtns.commands import write_rendered
+from dtns.models import Job
+from dtns.models import Post
+from dtns.utils import render_utils
+
+NUM_POSTS = 5
+
+
+class RenderPostsCommandTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.runner = self.app.test_cli_runner()
+        db.create_all()
+
+        self.updated_at = datetime(2021, 11, 1)
+        for i in range(1, NUM_POSTS + 1):
+            post = Post(
+                title=f"Title {i}",
+                slug=f"slug-{i}",
+                source=f"# Post {i}",
+                updated_at=self.updated_at,
+            )
+            db.session.add(post)
+        db.session.commit()
+
+        # Make every other post look like it was rendered by an old renderer
+        for post in Post.query.filter(Post.id % 2 == 1):
+            db.session.execute(
+                Post.__table__.update()
+                .where(Post.id == post.id)
+                .values(html="<p>Old</p>", renderer_version=None)
+            )
+        db.session.commit()
+        db.session.expire_all()
+
+    def tearDown(self):
+        db.session.commit()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_render_posts(self):
+        result = self.runner.invoke(
+            render_posts, ["--workers", "1", "--batch-size", "2"]
+        )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f"Rendered {NUM_POSTS} posts", result.output)
+        for post in Post.query.all():
+            self.assertEqual(post.html, f"<h1>Post {post.id}</h1>\n")
+            self.assertEqual(post.renderer_version, render_utils.RENDERER_VERSION)
+            self.assertFalse(post.is_html_stale)
+            self.assertEqual(post.updated_at, self.updated_at)
+
+    def test_render_posts_only_stale(self):
+        result = self.runner.invoke(
+            render_posts, ["--only-stale", "--workers", "1", "--batch-size", "2"]
+        )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Rendered 3 posts", result.output)
+        for post in Post.query.all():
+            self.assertEqual(post.html, f"<h1>Post {post.id}</h1>\n")
+
+    def test_write_rendered_skips_posts_edited_since_read(self):
+        rendered = render_batch([(1, "# Post 1"), (2, "# Post 2")])
+        db.session.execute(
+            Post.__table__.update()
+            .where(Post.id == 2)
+            .values(source="# Edited", html="<h1>Edited</h1>\n")
+        )
+        db.session.commit()
+
+        self.assertEqual(write_rendered(rendered), 1)
+
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Post, 1).html, "<h1>Post 1</h1>\n")
+        self.assertEqual(db.session.get(Post, 2).html, "<h1>Edited</h1>\n")
+
+    def test_render_posts_with_process_pool(self):
+        result = self.runner.invoke(
+            render_posts, ["--workers", "2", "--batch-size", "1"]
+        )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f"Rendered {NUM_POSTS} posts", result.output)
+        for post in Post.query.all():
+            self.assertFalse(post.is_html_stale)
+
+
+class RunJobsCommandTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app.config["JOB_QUEUE_ENABLED"] = True
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.runner = self.app.test_cli_runner()
+        db.create_all()
+
+        for i in range(1, NUM_POSTS + 1):
+            db.session.add(Post(title=f"Title {i}", slug=f"slug-{i}", source=f"# {i}"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.commit()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_run_jobs_burst(self):
+        self.assertEqual(Job.query.count(), NUM_POSTS)
+
+        result = self.runner.invoke(run_jobs, ["--burst"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f"ran {NUM_POSTS} jobs, 0 failed for good", result.output)
+        self.assertEqual(Job.query.count(), 0)
+        for post in Post.query.all():
+            self.assertEqual(post.html, f"<h1>{post.id}</h1>\n")
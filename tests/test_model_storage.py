@@ -1,8 +1,10 @@
 import unittest
 from datetime import datetime
+from datetime import timedelta
 from unittest import mock
 
 from freezegun import freeze_time
+from sqlalchemy import text
 
 from dtns import create_app
 from dtns import db
@@ -12,8 +14,11 @@ from dtns.model_storage import CommentModelStorage
 from dtns.model_storage import PostModelStorage
 from dtns.model_storage import UserModelStorage
 from dtns.models import Comment
+from dtns.models import Job
 from dtns.models import Post
+from dtns.models import SearchTerm
 from dtns.models import User
+from dtns.utils import search_utils
 
 NUM_POSTS = 10
 NUM_USERS = 3
@@ -107,6 +112,125 @@ class PostModelStorageTestCase(unittest.TestCase):
         )
         self.assertTrue(all([post.state == PostStatus.PUBLISHED for post in posts]))
 
+    def test_get_published_posts_page(self):
+        # publish posts, two of them at the same time
+        for i, published_at in enumerate(
+            [
+                "2021-11-01 12:00:00",
+                "2021-11-02 12:00:00",
+                "2021-11-02 12:00:00",
+                "2021-11-03 12:00:00",
+                "2021-11-04 12:00:00",
+            ]
+        ):
+            with freeze_time(published_at):
+                PostModelStorage.publish_post(self.posts[i].id)
+
+        pages = []
+        cursor = None
+        while True:
+            posts, cursor = PostModelStorage.get_published_posts_page(
+                cursor, per_page=2
+            )
+            pages.append([post.id for post in posts])
+            if not cursor:
+                break
+
+        self.assertEqual(pages, [[5, 4], [3, 2], [1]])
+
+    def test_get_published_posts_page_single_page(self):
+        PostModelStorage.publish_post(self.posts[0].id)
+
+        posts, cursor = PostModelStorage.get_published_posts_page()
+
+        self.assertEqual(posts, [self.posts[0]])
+        self.assertIsNone(cursor)
+
+    def test_get_posts_page_ordered_by_updated_at(self):
+        posts, cursor = PostModelStorage.get_posts_page_ordered_by_updated_at(
+            per_page=6
+        )
+        more_posts, next_cursor = PostModelStorage.get_posts_page_ordered_by_updated_at(
+            cursor, per_page=6
+        )
+
+        self.assertEqual(
+            posts + more_posts,
+            sorted(
+                self.posts,
+                key=lambda post: (post.updated_at, post.id),
+                reverse=True,
+            ),
+        )
+        self.assertIsNone(next_cursor)
+
+    def test_get_posts_page_ordered_by_updated_at_oldest_first(self):
+        posts, cursor = PostModelStorage.get_posts_page_ordered_by_updated_at(
+            per_page=6, oldest_first=True
+        )
+        more_posts, next_cursor = PostModelStorage.get_posts_page_ordered_by_updated_at(
+            cursor, per_page=6, oldest_first=True
+        )
+
+        self.assertEqual(
+            posts + more_posts,
+            sorted(self.posts, key=lambda post: (post.updated_at, post.id)),
+        )
+        self.assertIsNone(next_cursor)
+
+    def test_get_posts_page_ordered_by_updated_at_filtered(self):
+        PostModelStorage.publish_post(self.posts[1].id)
+        PostModelStorage.publish_post(self.posts[2].id)
+
+        posts, _ = PostModelStorage.get_posts_page_ordered_by_updated_at(
+            search="TITLE 2"
+        )
+        published, _ = PostModelStorage.get_posts_page_ordered_by_updated_at(
+            state=PostStatus.PUBLISHED
+        )
+
+        self.assertEqual(posts, [self.posts[1]])
+        self.assertEqual(
+            sorted(post.id for post in published), [self.posts[1].id, self.posts[2].id]
+        )
+
+    def test_get_post_archive(self):
+        for i, published_at in enumerate(
+            ["2021-11-01 12:00:00", "2021-11-30 23:59:59", "2021-12-01 00:00:00"]
+        ):
+            with freeze_time(published_at):
+                PostModelStorage.publish_post(self.posts[i].id)
+
+        post_archive = PostModelStorage.get_post_archive()
+
+        self.assertEqual(post_archive, [("December 2021", 1), ("November 2021", 2)])
+
+    def test_get_post_archive_follows_post_state(self):
+        with freeze_time("2021-11-01 12:00:00"):
+            PostModelStorage.publish_post(self.posts[0].id)
+            PostModelStorage.publish_post(self.posts[1].id)
+
+        PostModelStorage.archive_post(self.posts[0].id)
+        self.assertEqual(PostModelStorage.get_post_archive(), [("November 2021", 1)])
+
+        PostModelStorage.mark_post_as_draft(self.posts[1].id)
+        self.assertEqual(PostModelStorage.get_post_archive(), [])
+
+    def test_get_post_archive_follows_direct_updates(self):
+        post = Post.query.get(self.posts[0].id)
+        post.state = PostStatus.PUBLISHED
+        post.published_at = datetime(2021, 11, 1)
+        db.session.commit()
+        self.assertEqual(PostModelStorage.get_post_archive(), [("November 2021", 1)])
+
+        post.published_at = datetime(2021, 10, 1)
+        db.session.commit()
+        self.assertEqual(PostModelStorage.get_post_archive(), [("October 2021", 1)])
+
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(PostModelStorage.get_post_archive(), [])
+
     def test_get_recent_posts(self):
         # "publish" posts
         for i in range(6):
@@ -192,6 +316,115 @@ class PostModelStorageTestCase(unittest.TestCase):
         self.assertEqual(updated_post.source, updated_source)
         self.assertFalse(updated_post.updated_at < post.updated_at)
 
+    def get_edit_data(self, post, **changes):
+        data = {
+            "title": post.title,
+            "slug": post.slug,
+            "description": post.description,
+            "source": post.source,
+        }
+        data.update(changes)
+        return data
+
+    def test_edit_post_without_changes_is_not_saved(self):
+        post = Post.query.first()
+        updated_at = post.updated_at
+
+        with mock.patch.object(db.session, "commit") as mock_commit:
+            saved = PostModelStorage.edit_post(post.id, self.get_edit_data(post))
+
+        self.assertFalse(saved)
+        mock_commit.assert_not_called()
+        self.assertEqual(post.updated_at, updated_at)
+
+    def test_edit_draft_back_to_last_rendered_source(self):
+        self.app.config["JOB_QUEUE_ENABLED"] = True
+        post = Post.query.filter_by(state=PostStatus.DRAFT).first()
+        rendered_source = post.source
+
+        first = PostModelStorage.edit_post(
+            post.id, self.get_edit_data(post, source="An unrendered edit")
+        )
+        second = PostModelStorage.edit_post(
+            post.id, self.get_edit_data(post, source=rendered_source)
+        )
+
+        self.assertTrue(first)
+        self.assertTrue(second)
+        self.assertEqual(Post.query.get(post.id).source, rendered_source)
+
+    def test_edit_post_only_writes_changed_columns(self):
+        post = Post.query.first()
+        statements = []
+
+        def on_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", on_execute)
+        try:
+            saved = PostModelStorage.edit_post(
+                post.id, self.get_edit_data(post, title="A New Title")
+            )
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", on_execute)
+
+        self.assertTrue(saved)
+        self.assertEqual(post.title, "A New Title")
+        update = next(s for s in statements if s.startswith("UPDATE posts"))
+        self.assertIn("title=", update)
+        self.assertNotIn("source=", update)
+        self.assertNotIn("html=", update)
+
+    def test_autosave_draft_renders_once_viewed(self):
+        post = Post.query.filter_by(state=PostStatus.DRAFT).first()
+
+        saved = PostModelStorage.edit_post(
+            post.id, self.get_edit_data(post, source="# Autosaved"), autosave=True
+        )
+
+        self.assertTrue(saved)
+        self.assertEqual(post.source, "# Autosaved")
+        self.assertTrue(post.is_html_stale)
+        self.assertFalse(post.defer_render)
+
+        self.assertTrue(PostModelStorage.render_html(post))
+        self.assertEqual(post.html, "<h1>Autosaved</h1>\n")
+
+    def test_autosave_draft_is_rendered_when_published(self):
+        post = Post.query.filter_by(state=PostStatus.DRAFT).first()
+        PostModelStorage.edit_post(
+            post.id, self.get_edit_data(post, source="# Autosaved"), autosave=True
+        )
+
+        PostModelStorage.publish_post(post.id)
+
+        self.assertEqual(post.html, "<h1>Autosaved</h1>\n")
+
+    def test_autosave_published_post_renders(self):
+        post = Post.query.filter_by(state=PostStatus.DRAFT).first()
+        PostModelStorage.publish_post(post.id)
+
+        PostModelStorage.edit_post(
+            post.id, self.get_edit_data(post, source="# Autosaved"), autosave=True
+        )
+
+        self.assertEqual(post.html, "<h1>Autosaved</h1>\n")
+
+    def test_autosave_bursts_queue_one_delayed_render(self):
+        self.app.config["JOB_QUEUE_ENABLED"] = True
+        self.app.config["AUTOSAVE_RENDER_DELAY"] = 60
+        post = Post.query.filter_by(state=PostStatus.DRAFT).first()
+
+        for i in range(3):
+            PostModelStorage.edit_post(
+                post.id, self.get_edit_data(post, source=f"# Save {i}"), autosave=True
+            )
+
+        jobs = Job.query.filter_by(name="render-post").all()
+        self.assertEqual(len(jobs), 1)
+        self.assertGreater(jobs[0].run_at, datetime.utcnow() + timedelta(seconds=30))
+        self.assertEqual(post.source, "# Save 2")
+
     @freeze_time("2021-12-07")
     def test_publish_post(self):
         post = Post.query.first()
@@ -258,6 +491,69 @@ class PostModelStorageTestCase(unittest.TestCase):
         self.assertEqual(len(found_posts), 1)
         self.assertIn("Find me", found_posts[0].source)
 
+    def test_search_posts_ranks_results(self):
+        for slug, source in [
+            ("one-mention", "A post about data and a few other things."),
+            ("many-mentions", "Data, data, data! All about data."),
+            ("no-mentions", "Nothing to see here."),
+        ]:
+            post = Post(title=slug, slug=slug, description="", source=source)
+            db.session.add(post)
+            db.session.commit()
+            PostModelStorage.publish_post(post.id)
+
+        found_posts = PostModelStorage.search_posts("data")
+
+        self.assertEqual(
+            [post.slug for post in found_posts], ["many-mentions", "one-mention"]
+        )
+
+    def test_search_posts_matches_stems_and_prefixes(self):
+        post = self.posts[0]
+        post.source = "Publishing posts about running."
+        db.session.add(post)
+        db.session.commit()
+        PostModelStorage.publish_post(post.id)
+
+        self.assertEqual(PostModelStorage.search_posts("published post"), [post])
+        self.assertEqual(PostModelStorage.search_posts("runs"), [post])
+        self.assertEqual(PostModelStorage.search_posts("about ru"), [post])
+        self.assertEqual(PostModelStorage.search_posts("walking"), [])
+
+    def test_search_posts_no_terms_returns_all_published_posts(self):
+        PostModelStorage.publish_post(self.posts[0].id)
+
+        found_posts = PostModelStorage.search_posts("  ")
+
+        self.assertEqual(found_posts, [self.posts[0]])
+
+    def test_search_terms_follow_post_state(self):
+        post = self.posts[0]
+        self.assertEqual(SearchTerm.query.filter_by(post_id=post.id).count(), 0)
+
+        PostModelStorage.publish_post(post.id)
+        self.assertGreater(SearchTerm.query.filter_by(post_id=post.id).count(), 0)
+        self.assertEqual(PostModelStorage.search_posts("post 1"), [post])
+
+        PostModelStorage.edit_post(
+            post.id,
+            {
+                "title": post.title,
+                "slug": post.slug,
+                "description": post.description,
+                "source": "Completely rewritten",
+            },
+        )
+        self.assertEqual(PostModelStorage.search_posts("rewritten"), [post])
+
+        PostModelStorage.archive_post(post.id)
+        self.assertEqual(SearchTerm.query.filter_by(post_id=post.id).count(), 0)
+        self.assertEqual(PostModelStorage.search_posts("rewritten"), [])
+
+        PostModelStorage.publish_post(post.id)
+        PostModelStorage.mark_post_as_draft(post.id)
+        self.assertEqual(SearchTerm.query.filter_by(post_id=post.id).count(), 0)
+
     def test_get_posts_by_month_year(self):
         # "publish" posts
         for i in range(8):
@@ -293,6 +589,123 @@ class PostModelStorageTestCase(unittest.TestCase):
         for post in posts:
             self.assertEqual(post.published_at.strftime("%B %Y"), "November 2021")
 
+    def test_get_posts_by_month_year_only_published_posts_in_range(self):
+        with freeze_time("2021-10-31 23:59:59"):
+            PostModelStorage.publish_post(self.posts[0].id)
+        with freeze_time("2021-11-01 00:00:00"):
+            PostModelStorage.publish_post(self.posts[1].id)
+        with freeze_time("2021-11-30 23:59:59"):
+            PostModelStorage.publish_post(self.posts[2].id)
+            PostModelStorage.publish_post(self.posts[3].id)
+            PostModelStorage.archive_post(self.posts[3].id)
+        with freeze_time("2021-12-01 00:00:00"):
+            PostModelStorage.publish_post(self.posts[4].id)
+
+        posts = PostModelStorage.get_posts_by_month_year("November 2021")
+
+        self.assertEqual(posts, [self.posts[2], self.posts[1]])
+
+    def test_get_posts_by_month_year_invalid_month_year(self):
+        posts = PostModelStorage.get_posts_by_month_year("not a month")
+
+        self.assertEqual(posts, [])
+
+
+class PostSearchBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.posts = []
+        for slug, source in [
+            ("one-mention", "A post about searching data."),
+            ("many-mentions", "Data, data, data! Searches about data."),
+            ("no-mentions", "Nothing to see here."),
+            ("draft", "A draft about data."),
+        ]:
+            post = Post(title=slug, slug=slug, description="", source=source)
+            db.session.add(post)
+            db.session.commit()
+            if slug != "draft":
+                PostModelStorage.publish_post(post.id)
+            self.posts.append(post)
+
+    def tearDown(self):
+        db.session.commit()
+        for statement in search_utils.SQLITE_FTS_DROP_DDL:
+            db.session.execute(text(statement))
+        search_utils.reset_search_backend(db.engine)
+        db.drop_all()
+        self.app_context.pop()
+
+    def create_sqlite_fts(self):
+        for statement in search_utils.SQLITE_FTS_DDL:
+            db.session.execute(text(statement))
+        db.session.commit()
+        search_utils.reset_search_backend(db.engine)
+
+    def test_auto_backend_uses_search_index(self):
+        backend = search_utils.get_search_backend(db.engine)
+
+        self.assertEqual(backend, search_utils.SearchBackend.INDEX)
+
+    def test_auto_backend_uses_sqlite_fts(self):
+        self.create_sqlite_fts()
+
+        backend = search_utils.get_search_backend(db.engine)
+
+        self.assertEqual(backend, search_utils.SearchBackend.SQLITE_FTS)
+
+    def test_auto_backend_falls_back_to_like(self):
+        SearchTerm.__table__.drop(db.engine)
+        search_utils.reset_search_backend(db.engine)
+
+        backend = search_utils.get_search_backend(db.engine)
+        found_posts = PostModelStorage.search_posts("data")
+
+        self.assertEqual(backend, search_utils.SearchBackend.LIKE)
+        self.assertEqual(
+            {post.slug for post in found_posts}, {"one-mention", "many-mentions"}
+        )
+
+    def test_search_posts_sqlite_fts(self):
+        self.create_sqlite_fts()
+
+        found_posts = PostModelStorage.search_posts("search dat")
+
+        self.assertEqual(
+            [post.slug for post in found_posts], ["many-mentions", "one-mention"]
+        )
+
+    def test_search_posts_sqlite_fts_follows_edits(self):
+        self.create_sqlite_fts()
+        post = self.posts[2]
+
+        PostModelStorage.edit_post(
+            post.id,
+            {
+                "title": post.title,
+                "slug": post.slug,
+                "description": post.description,
+                "source": "Now there is something to see.",
+            },
+        )
+
+        self.assertEqual(PostModelStorage.search_posts("something"), [post])
+        self.assertEqual(PostModelStorage.search_posts("nothing"), [])
+
+    def test_search_posts_like_backend(self):
+        self.app.config["SEARCH_BACKEND"] = search_utils.SearchBackend.LIKE
+
+        found_posts = PostModelStorage.search_posts("data about")
+
+        self.assertEqual(found_posts, [])
+        self.assertEqual(
+            PostModelStorage.search_posts("searching data"), [self.posts[0]]
+        )
+
 
 class UserModelStorageTestCase(unittest.TestCase):
     def setUp(self):
@@ -376,6 +789,26 @@ class UserModelStorageTestCase(unittest.TestCase):
             self.assertIn("is_admin", user)
             self.assertNotIn("password", user)
 
+    def test_get_all_for_admin_counts_comments(self):
+        post = Post(title="Title", slug="slug", source="# Post")
+        users = UserModelStorage.get_all()
+        comments = [
+            Comment(text="Comment", user=users[0], post=post),
+            Comment(text="Comment", user=users[0], post=post),
+            Comment(text="Comment", user=users[2], post=post),
+        ]
+        db.session.add_all([post, *comments])
+        db.session.commit()
+
+        num_comments = {
+            user["username"]: user["num_comments"]
+            for user in UserModelStorage.get_all_for_admin()
+        }
+
+        self.assertEqual(num_comments["test_user_1"], 2)
+        self.assertEqual(num_comments["test_user_2"], 0)
+        self.assertEqual(num_comments["test_user_3"], 1)
+
     def test_get_or_create_comment_user_get_user(self):
         email = "test_1@test.com"
         user = UserModelStorage.get_user_by_email(email)
@@ -439,6 +872,71 @@ class CommentModelStorageTestCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    def add_comments_from_new_users(self, num_comments):
+        for i in range(num_comments):
+            user = User(
+                email=f"user_{i}@test.com", username=f"user_{i}", password="password"
+            )
+            db.session.add(Comment(text=f"Comment {i}", user=user, post=self.post))
+        db.session.commit()
+        db.session.expunge_all()
+
+    def count_statements(self, func):
+        statements = []
+
+        def on_execute(*args):
+            statements.append(args)
+
+        db.event.listen(db.engine, "before_cursor_execute", on_execute)
+        try:
+            func()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", on_execute)
+        return len(statements)
+
+    def test_get_all_loads_users_and_posts(self):
+        self.add_comments_from_new_users(10)
+
+        def render():
+            for comment in CommentModelStorage.get_all():
+                comment.user.username, comment.post.title
+
+        self.assertEqual(self.count_statements(render), 1)
+
+    def test_get_all_by_user_id_loads_users_and_posts(self):
+        db.session.add_all([self.comment, self.comment2])
+        db.session.commit()
+        user_id = self.user.id
+        db.session.expunge_all()
+
+        def render():
+            for comment in CommentModelStorage.get_all_by_user_id(user_id):
+                comment.user.username, comment.post.title
+
+        self.assertEqual(self.count_statements(render), 1)
+
+    def test_get_page_loads_users_and_posts(self):
+        self.add_comments_from_new_users(10)
+
+        def render():
+            comments, _ = CommentModelStorage.get_page(per_page=5)
+            for comment in comments:
+                comment.user.username, comment.post.title
+
+        self.assertEqual(self.count_statements(render), 1)
+
+    def test_get_post_and_comments_loads_users(self):
+        self.add_comments_from_new_users(10)
+
+        def render():
+            post, comments = PostModelStorage.get_post_by_slug(
+                "slug-1", include_comments=True
+            )
+            for comment in comments:
+                comment.user.username, comment.post.title
+
+        self.assertEqual(self.count_statements(render), 2)
+
     @mock.patch("dtns.utils.email_utils.send_new_comment_notif")
     def test_create_comment(self, mock_send_new_comment_notif):
         comment_text = "Just leaving a comment!"
@@ -458,6 +956,36 @@ class CommentModelStorageTestCase(unittest.TestCase):
         self.assertEqual(comment.post_id, self.post.id)
         mock_send_new_comment_notif.assert_called_with(comment)
 
+    def test_create_comment_pending_with_job_queue(self):
+        self.app.config["JOB_QUEUE_ENABLED"] = True
+        data = {
+            "email": self.email,
+            "username": self.username,
+            "comment": "Just leaving a comment!",
+            "post": self.post,
+        }
+
+        with self.app.test_request_context():
+            comment = CommentModelStorage.create_comment(data)
+
+        self.assertEqual(comment.state, CommentState.PENDING)
+        self.assertNotIn(
+            comment, PostModelStorage.get_post_by_slug(self.post.slug, True)[1]
+        )
+
+        CommentModelStorage.publish_comment(comment.id)
+
+        self.assertEqual(comment.state, CommentState.VISIBLE)
+
+    def test_publish_comment_keeps_hidden_comment_hidden(self):
+        self.comment.state = CommentState.HIDDEN
+        db.session.add(self.comment)
+        db.session.commit()
+
+        CommentModelStorage.publish_comment(self.comment.id)
+
+        self.assertEqual(self.comment.state, CommentState.HIDDEN)
+
     def test_toggle_visibility_state(self):
         comment = Comment.query.order_by(-Comment.id).first()
         self.assertEqual(comment.state, CommentState.VISIBLE)
@@ -472,6 +1000,15 @@ class CommentModelStorageTestCase(unittest.TestCase):
         comment = Comment.query.order_by(-Comment.id).first()
         self.assertEqual(comment.state, CommentState.VISIBLE)
 
+    def test_toggle_visibility_state_pending(self):
+        self.comment.state = CommentState.PENDING
+        db.session.add(self.comment)
+        db.session.commit()
+
+        CommentModelStorage.toggle_visibility_state(self.comment.id)
+
+        self.assertEqual(self.comment.state, CommentState.VISIBLE)
+
     def test_toggle_visibility_state_no_comment(self):
         comment_id = 100
 
@@ -496,3 +1033,49 @@ class CommentModelStorageTestCase(unittest.TestCase):
 
         self.assertEqual(len(comments), 1)
         self.assertEqual(comments[0].text, self.comment2.text)
+
+    def test_get_page(self):
+        db.session.add_all([self.comment, self.comment2])
+        db.session.commit()
+
+        comments, cursor = CommentModelStorage.get_page(per_page=1)
+        more_comments, next_cursor = CommentModelStorage.get_page(cursor, per_page=1)
+
+        self.assertEqual(comments, [self.comment2])
+        self.assertEqual(more_comments, [self.comment])
+        self.assertIsNone(next_cursor)
+
+    def test_get_page_by_user_id(self):
+        db.session.add_all([self.comment, self.comment2])
+        db.session.commit()
+
+        comments, cursor = CommentModelStorage.get_page(user_id=self.user.id)
+
+        self.assertEqual(comments, [self.comment])
+        self.assertIsNone(cursor)
+
+    def test_get_page_oldest_first(self):
+        db.session.add_all([self.comment, self.comment2])
+        db.session.commit()
+
+        comments, cursor = CommentModelStorage.get_page(per_page=1, oldest_first=True)
+        more_comments, next_cursor = CommentModelStorage.get_page(
+            cursor, per_page=1, oldest_first=True
+        )
+
+        self.assertEqual(comments, [self.comment])
+        self.assertEqual(more_comments, [self.comment2])
+        self.assertIsNone(next_cursor)
+
+    def test_get_page_filtered(self):
+        self.comment2.state = CommentState.PENDING
+        db.session.add_all([self.comment, self.comment2])
+        db.session.commit()
+
+        by_text, _ = CommentModelStorage.get_page(search="Different")
+        by_username, _ = CommentModelStorage.get_page(search="test_user")
+        pending, _ = CommentModelStorage.get_page(state=CommentState.PENDING)
+
+        self.assertEqual(by_text, [self.comment2])
+        self.assertEqual(by_username, [self.comment])
+        self.assertEqual(pending, [self.comment2])
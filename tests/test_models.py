@@ -1,6 +1,6 @@
 import unittest
-from unittest import mock
 from datetime import datetime
+from unittest import mock
 
 from werkzeug.security import generate_password_hash
 
@@ -11,6 +11,7 @@ from dtns.constants import PostStatus
 from dtns.models import Comment
 from dtns.models import Post
 from dtns.models import User
+from dtns.utils import render_utils
 
 
 class PostModelTestCase(unittest.TestCase):
@@ -104,6 +105,61 @@ class PostModelTestCase(unittest.TestCase):
         self.assertIsInstance(post.created_at, datetime)
         self.assertIsInstance(post.updated_at, datetime)
 
+    def create_post(self):
+        p = Post(
+            title=self.title,
+            slug=self.slug,
+            description=self.description,
+            source=self.source,
+        )
+        db.session.add(p)
+        db.session.commit()
+        return p
+
+    def test_create_post_records_source_hash_and_renderer_version(self):
+        post = self.create_post()
+
+        self.assertEqual(post.source_hash, render_utils.hash_source(self.source))
+        self.assertEqual(post.renderer_version, render_utils.RENDERER_VERSION)
+        self.assertFalse(post.is_html_stale)
+
+    def test_edit_post_source_renders_html(self):
+        post = self.create_post()
+
+        post.source = "# Hello"
+        db.session.commit()
+
+        self.assertEqual(post.html, "<h1>Hello</h1>\n")
+        self.assertEqual(post.source_hash, render_utils.hash_source("# Hello"))
+
+    @mock.patch("dtns.utils.render_utils.render_source")
+    def test_edit_post_with_same_source_does_not_render(self, mock_render_source):
+        mock_render_source.return_value = self.html
+        post = self.create_post()
+        mock_render_source.reset_mock()
+
+        post.source = self.source
+        post.title = "A New Title"
+        db.session.commit()
+
+        mock_render_source.assert_not_called()
+        self.assertEqual(post.html, self.html)
+
+    def test_stale_renderer_version_renders_html(self):
+        post = self.create_post()
+        post.html = "<p>Old</p>"
+        post.renderer_version = render_utils.RENDERER_VERSION - 1
+        db.session.commit()
+
+        self.assertEqual(post.html, self.html)
+        self.assertEqual(post.renderer_version, render_utils.RENDERER_VERSION)
+
+    def test_render_html_force(self):
+        post = self.create_post()
+
+        self.assertFalse(post.render_html())
+        self.assertTrue(post.render_html(force=True))
+
 
 class UserModelTestCase(unittest.TestCase):
     def setUp(self):
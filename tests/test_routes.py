@@ -1,10 +1,15 @@
+import hashlib
 import io
 import os
+import tempfile
+import time
 import unittest
 from datetime import datetime
+from datetime import timedelta
 from unittest import mock
 from urllib.parse import quote
 
+import flask
 from itsdangerous import SignatureExpired
 from PIL import Image
 from PIL import ImageDraw
@@ -12,9 +17,16 @@ from PIL import ImageDraw
 from dtns import create_app
 from dtns import db
 from dtns.constants import PostStatus
+from dtns.constants import UploadState
+from dtns.model_storage import CommentModelStorage
+from dtns.model_storage import PostModelStorage
 from dtns.models import Comment
 from dtns.models import Post
+from dtns.models import Upload
 from dtns.models import User
+from dtns.utils import asset_utils
+from dtns.utils import cache_utils
+from dtns.utils import metrics_utils
 from dtns.utils import post_utils
 
 
@@ -60,9 +72,14 @@ class BaseRouteTestCase(unittest.TestCase):
         self.filename = "image-from-test.jpeg"
 
     def tearDown(self):
-        test_file_path = os.path.join(self.full_upload_path, self.filename)
-        if os.path.isfile(test_file_path):
-            os.remove(test_file_path)
+        # Uploads are processed in the background
+        if "job_pool" in self.app.extensions:
+            self.app.extensions["job_pool"].join()
+
+        for filename in [self.filename, f"{self.filename}.webp"]:
+            test_file_path = os.path.join(self.full_upload_path, filename)
+            if os.path.isfile(test_file_path):
+                os.remove(test_file_path)
 
         db.session.commit()
         db.drop_all()
@@ -86,6 +103,63 @@ class RoutesAsUserTestCase(BaseRouteTestCase):
             self.assertIn(post.slug, response_text)
             self.assertIn(post.description, response_text)
 
+    def test_pages_use_fingerprinted_static_urls(self):
+        response = self.client.get("/")
+        response_text = response.get_data(as_text=True)
+
+        fingerprint = asset_utils.get_fingerprint("css/style.css")
+        self.assertIn(f"/assets/{fingerprint}/css/style.css", response_text)
+        self.assertNotIn("/static/", response_text)
+
+    def test_post_upload_images_are_fingerprinted_when_served(self):
+        path = os.path.join(self.full_upload_path, self.filename)
+        Image.new("RGB", (1, 1)).save(path, "JPEG")
+        PostModelStorage.edit_post(
+            1,
+            {
+                "title": "Title 1",
+                "slug": "slug-1",
+                "description": "Post description 1",
+                "source": f"![a](/uploads/{self.filename})",
+            },
+        )
+        first = self.client.get("/post/slug-1")
+
+        Image.new("RGB", (2, 2)).save(path, "JPEG")
+        # Uploads are rewritten by renaming a new file into place
+        os.utime(self.full_upload_path)
+        second = self.client.get(
+            "/post/slug-1", headers={"If-None-Match": first.headers["ETag"]}
+        )
+
+        fingerprint = asset_utils.get_fingerprint(f"uploads/{self.filename}")
+        self.assertEqual(second.status_code, 200)
+        self.assertNotIn(fingerprint, first.get_data(as_text=True))
+        self.assertIn(
+            f"/assets/{fingerprint}/uploads/{self.filename}",
+            second.get_data(as_text=True),
+        )
+
+    def test_post_upload_images_have_srcset(self):
+        path = os.path.join(self.full_upload_path, self.filename)
+        Image.new("RGB", (1, 1)).save(path, "JPEG")
+        PostModelStorage.edit_post(
+            1,
+            {
+                "title": "Title 1",
+                "slug": "slug-1",
+                "description": "Post description 1",
+                "source": f"![a](http://localhost/uploads/{self.filename})",
+            },
+        )
+
+        response = self.client.get("/post/slug-1")
+        response_text = response.get_data(as_text=True)
+
+        self.assertIn(
+            f"http://localhost/uploads/{self.filename}/640.jpg 640w", response_text
+        )
+
     def test_about_route_as_user(self):
         response = self.client.get("/about")
 
@@ -228,6 +302,11 @@ class RoutesAsUserTestCase(BaseRouteTestCase):
 
         self.assertEqual(response.status_code, 401)
 
+    def test_preview_post_as_user(self):
+        response = self.client.post("/preview", data={"source": "# Hey"})
+
+        self.assertEqual(response.status_code, 401)
+
     def test_delete_image_manager_image_as_user(self):
         response = self.client.get("/image-manager/delete?image=fake.jpg")
 
@@ -290,6 +369,45 @@ class RoutesAsUserTestCase(BaseRouteTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(f'Results for: "{today}"', response_text)
 
+    @mock.patch("dtns.routes.PostModelStorage.get_published_posts_page")
+    def test_home_route_load_more_as_user(self, mock_get_published_posts_page):
+        mock_get_published_posts_page.return_value = (self.published_posts, "cursor")
+
+        response = self.client.get("/")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("/load-more/posts?cursor=cursor", response_text)
+
+    def test_load_more_posts(self):
+        posts = Post.query.filter_by(state=PostStatus.PUBLISHED).all()
+        last_post = min(posts, key=lambda post: (post.published_at, post.id))
+        newest_post = max(posts, key=lambda post: (post.published_at, post.id))
+        cursor = post_utils.encode_cursor(newest_post.published_at, newest_post.id)
+
+        response = self.client.get(f"/load-more/posts?cursor={cursor}")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(last_post.title, response_text)
+        self.assertNotIn(newest_post.title, response_text)
+        self.assertNotIn("Load more", response_text)
+
+    def test_load_more_posts_invalid_cursor(self):
+        response = self.client.get("/load-more/posts?cursor=nope")
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_load_more_admin_posts_as_user(self):
+        response = self.client.get("/load-more/admin/posts?cursor=nope")
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_load_more_admin_comments_as_user(self):
+        response = self.client.get("/load-more/admin/comments?cursor=nope")
+
+        self.assertEqual(response.status_code, 401)
+
     def test_404_page(self):
         response = self.client.get("/nope")
         response_text = response.get_data(as_text=True)
@@ -354,6 +472,23 @@ class RoutesAsUserTestCase(BaseRouteTestCase):
         self.assertIn("Your comment has been added!", response_text)
         self.assertIn("success", response_text)
 
+    def test_create_comment_on_post_as_user_with_job_queue(self):
+        self.app.config["JOB_QUEUE_ENABLED"] = True
+        comment_data = {
+            "email": "foo@bar.com",
+            "username": "foobar",
+            "comment": "This is a comment!",
+        }
+
+        response = self.client.post(
+            "/post/slug-1", data=comment_data, follow_redirects=True
+        )
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Your comment will show once it", response_text)
+        self.assertNotIn("This is a comment!", response_text)
+
     @mock.patch("dtns.model_storage.CommentModelStorage.create_comment")
     def test_create_comment_on_post_as_user_handle_exception(self, mock_create_comment):
         mock_create_comment.side_effect = Exception()
@@ -420,6 +555,15 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertIn("New Post", response_text)
         self.assertIn('id="post-table"', response_text)
 
+    def test_admin_posts_route_filtered_as_admin(self):
+        response = self.client.get("/admin/posts?q=title+5&state=archived")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Title 5", response_text)
+        self.assertNotIn("Title 4", response_text)
+        self.assertIn('value="title 5"', response_text)
+
     def test_admin_users_route_as_admin(self):
         response = self.client.get("/admin/users")
         response_text = response.get_data(as_text=True)
@@ -428,6 +572,37 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertIn("Users", response_text)
         self.assertIn('id="user-table"', response_text)
 
+    def test_admin_users_route_query_count_is_constant(self):
+        def count_statements():
+            statements = []
+
+            def on_execute(*args):
+                statements.append(args)
+
+            db.event.listen(db.engine, "before_cursor_execute", on_execute)
+            try:
+                self.client.get("/admin/users")
+            finally:
+                db.event.remove(db.engine, "before_cursor_execute", on_execute)
+            return len(statements)
+
+        def add_users(start, stop):
+            for i in range(start, stop):
+                user = User(
+                    email=f"test_{i}@test.com",
+                    username=f"test_user_{i}",
+                    password=f"test_password_{i}",
+                )
+                comment = Comment(text="A test comment", user=user, post=self.posts[0])
+                db.session.add_all([user, comment])
+            db.session.commit()
+
+        add_users(1, 3)
+        num_statements = count_statements()
+        add_users(3, 13)
+
+        self.assertEqual(count_statements(), num_statements)
+
     def test_admin_comments_route_as_admin(self):
         response = self.client.get("/admin/comments")
         response_text = response.get_data(as_text=True)
@@ -436,6 +611,24 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertIn("Comments", response_text)
         self.assertIn('id="comments-table"', response_text)
 
+    def test_admin_comments_route_filtered_as_admin(self):
+        user = User(
+            email="test_1@test.com", username="test_user_1", password="test_password_1"
+        )
+        comments = [
+            Comment(text=f"Comment {i}", user=user, post=self.posts[0])
+            for i in range(1, 3)
+        ]
+        db.session.add_all([user] + comments)
+        db.session.commit()
+
+        response = self.client.get("/admin/comments?q=comment+2")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Comment 2", response_text)
+        self.assertNotIn("Comment 1", response_text)
+
     def test_admin_comment_toggle_visibility_route_as_admin(self):
         user = User(
             email="test_1@test.com", username="test_user_1", password="test_password_1"
@@ -513,6 +706,57 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("this link has expired", response_text)
 
+    def test_load_more_admin_posts_as_admin(self):
+        post = Post.query.get(1)
+        cursor = post_utils.encode_cursor(post.updated_at, post.id)
+
+        response = self.client.get(f"/load-more/admin/posts?cursor={cursor}")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("<tr>", response_text)
+        self.assertNotIn("Load more", response_text)
+
+    def test_load_more_admin_posts_keeps_filters_as_admin(self):
+        with mock.patch(
+            "dtns.routes.PostModelStorage.get_posts_page_ordered_by_updated_at",
+            return_value=(self.posts[:1], "next"),
+        ) as mock_get_page:
+            response = self.client.get("/admin/posts?q=title&order=oldest")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        mock_get_page.assert_called_once_with(
+            search="title", state=None, oldest_first=True
+        )
+        self.assertIn("cursor=next&amp;q=title&amp;order=oldest", response_text)
+
+    def test_load_more_admin_comments_as_admin(self):
+        user = User(
+            email="test_1@test.com", username="test_user_1", password="test_password_1"
+        )
+        comment = Comment(
+            text="A test comment",
+            user=user,
+            post=self.posts[0],
+        )
+        db.session.add_all([user, comment])
+        db.session.commit()
+        cursor = post_utils.encode_cursor(datetime.utcnow(), comment.id + 1)
+
+        response = self.client.get(
+            f"/load-more/admin/comments?cursor={cursor}&user_id={user.id}"
+        )
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("A test comment", response_text)
+
+    def test_load_more_admin_comments_invalid_cursor_as_admin(self):
+        response = self.client.get("/load-more/admin/comments?cursor=nope")
+
+        self.assertEqual(response.status_code, 400)
+
     def test_create_route_as_admin(self):
         response = self.client.get("/create")
 
@@ -543,6 +787,17 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertIn('id="blog-home-page-preview"', response_text)
         self.assertIn('id="blog-post-preview"', response_text)
 
+    def test_edit_post_route_autosaves_as_admin(self):
+        self.app.config["AUTOSAVE_IDLE_SECONDS"] = 2
+        self.app.config["AUTOSAVE_MAX_WAIT_SECONDS"] = 20
+
+        response_text = self.client.get("/edit/1").get_data(as_text=True)
+
+        self.assertIn('var autosaveUrl = "/save/1"', response_text)
+        self.assertIn("var autosaveIdle = 2000", response_text)
+        self.assertIn("var autosaveMaxWait = 20000", response_text)
+        self.assertNotIn("autosaveUrl", self.client.get("/create").get_data(True))
+
     def test_edit_post_from_edit_route_as_admin(self):
         updated_post_data = {
             "title": "updated title",
@@ -573,6 +828,102 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("Saved at", response_text)
 
+    def test_save_post_without_changes_as_admin(self):
+        post = Post.query.get(1)
+        save_post_data = {
+            "title": post.title,
+            "slug": post.slug,
+            "description": post.description,
+            "source": post.source,
+        }
+
+        response = self.client.post("/save/1", data=save_post_data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("No changes to save!", response.get_data(as_text=True))
+
+    def test_save_post_burst_as_admin(self):
+        save_post_data = {
+            "title": "Saved title",
+            "slug": "slug-1",
+            "description": "saved description",
+            "source": "saved source",
+        }
+
+        self.client.post("/save/1", data=save_post_data)
+        save_post_data["source"] = "saved source again"
+        response = self.client.post("/save/1", data=save_post_data)
+
+        self.assertIn("Saved at", response.get_data(as_text=True))
+        self.assertEqual(Post.query.get(1).source, "saved source again")
+
+        response = self.client.get("/preview/slug-1")
+
+        self.assertIn("saved source again", response.get_data(as_text=True))
+
+    def test_preview_post_as_admin(self):
+        source = "# Hey\n\n![yt](https://www.youtube.com/watch?v=Lgwlta7ccnI)"
+
+        response = self.client.post("/preview", data={"source": source})
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('id="post-content"', response_text)
+        self.assertIn("<h1>Hey</h1>", response_text)
+        self.assertIn("https://www.youtube.com/embed/Lgwlta7ccnI", response_text)
+        self.assertIsNotNone(response.headers.get("X-Preview-Hash"))
+
+    def test_preview_post_patch_as_admin(self):
+        response = self.client.post(
+            "/preview", data={"source": "# Hey there", "editor": "a"}
+        )
+
+        response = self.client.post(
+            "/preview",
+            data={
+                "editor": "a",
+                "base_hash": response.headers["X-Preview-Hash"],
+                "start": 6,
+                "end": 11,
+                "patch": "you",
+            },
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("<h1>Hey you</h1>", response.get_data(as_text=True))
+
+    def test_preview_post_patch_without_base_as_admin(self):
+        self.client.post("/preview", data={"source": "# Hey", "editor": "a"})
+
+        response = self.client.post(
+            "/preview",
+            data={
+                "editor": "b",
+                "base_hash": "nope",
+                "start": 0,
+                "end": 0,
+                "patch": "",
+            },
+        )
+
+        self.assertEqual(response.status_code, 409)
+
+    def test_preview_post_invalid_patch_as_admin(self):
+        response = self.client.post("/preview", data={"source": "# Hey", "editor": "a"})
+
+        response = self.client.post(
+            "/preview",
+            data={
+                "editor": "a",
+                "base_hash": response.headers["X-Preview-Hash"],
+                "start": 3,
+                "end": 100,
+                "patch": "",
+            },
+        )
+
+        self.assertEqual(response.status_code, 400)
+
     def test_preview_page_as_admin(self):
         response = self.client.get("/preview/slug-1")
         response_text = response.get_data(as_text=True)
@@ -658,6 +1009,119 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertIn(self.filename, response_text)
         self.assertIn("success", response_text)
 
+    def test_upload_image_is_processed_as_admin(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees
+        exif[0x010F] = "Camera Maker"
+        upload = io.BytesIO()
+        Image.new("RGB", (4000, 3000)).save(upload, "JPEG", exif=exif)
+        upload.seek(0)
+
+        self.client.post("/image-manager", data={"file": (upload, self.filename)})
+        self.app.extensions["job_pool"].join()
+
+        upload = Upload.query.filter_by(name=self.filename).one()
+        self.assertEqual(upload.state, UploadState.DONE)
+        self.assertEqual((upload.width, upload.height), (1920, 2560))
+        self.assertEqual(len(upload.content_hash), 64)
+        self.assertEqual(upload.webp_name, f"{self.filename}.webp")
+        with Image.open(os.path.join(self.full_upload_path, self.filename)) as img:
+            self.assertEqual(img.size, (1920, 2560))
+            self.assertEqual(dict(img.getexif()), {})
+        self.assertEqual(
+            upload.num_bytes,
+            os.path.getsize(os.path.join(self.full_upload_path, self.filename)),
+        )
+
+        response = self.client.get(f"/image-manager/uploads/{upload.id}")
+        response_text = response.get_data(as_text=True)
+        self.assertIn("1920x2560", response_text)
+        self.assertNotIn("hx-trigger", response_text)
+
+    def test_upload_image_already_uploaded_as_admin(self):
+        upload = io.BytesIO()
+        Image.new("RGB", (40, 30)).save(upload, "JPEG")
+        data = upload.getvalue()
+
+        self.client.post(
+            "/image-manager", data={"file": (io.BytesIO(data), self.filename)}
+        )
+        self.app.extensions["job_pool"].join()
+        response = self.client.post(
+            "/image-manager",
+            data={"file": (io.BytesIO(data), "copy.jpg")},
+            follow_redirects=True,
+        )
+        response_text = response.get_data(as_text=True)
+
+        self.assertIn(
+            f"This image has already been uploaded as &#34;{self.filename}&#34;",
+            response_text,
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.full_upload_path, "copy.jpg"))
+        )
+        self.assertEqual(Upload.query.count(), 1)
+        self.assertEqual(
+            Upload.query.one().source_hash, hashlib.sha256(data).hexdigest()
+        )
+
+    def test_upload_image_too_large_as_admin(self):
+        self.app.config["IMAGE_UPLOAD_MAX_BYTES"] = 4
+
+        response = self.client.post(
+            "/image-manager",
+            data={"file": (io.BytesIO(b"abcdef"), self.filename)},
+            follow_redirects=True,
+        )
+        response_text = response.get_data(as_text=True)
+
+        self.assertIn("images can&#39;t be bigger than", response_text)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.full_upload_path, self.filename))
+        )
+        self.assertEqual(Upload.query.count(), 0)
+
+    def test_upload_request_too_large_as_admin(self):
+        self.app.config["MAX_CONTENT_LENGTH"] = 4
+
+        response = self.client.post(
+            "/image-manager", data={"file": (io.BytesIO(b"abcdef"), self.filename)}
+        )
+
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("too big", response.get_data(as_text=True))
+
+    def test_upload_progress_as_admin(self):
+        upload = Upload(name="uploading.jpg", state=UploadState.PROCESSING, progress=33)
+        db.session.add(upload)
+        db.session.commit()
+
+        response = self.client.get(f"/image-manager/uploads/{upload.id}")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hx-trigger="every 1s"', response_text)
+        self.assertIn("width: 33%", response_text)
+        self.assertEqual(self.client.get("/image-manager/uploads/99").status_code, 404)
+
+    def test_upload_progress_stalled_as_admin(self):
+        upload = Upload(
+            name="uploading.jpg",
+            state=UploadState.QUEUED,
+            created_at=datetime.utcnow() - timedelta(hours=1),
+        )
+        db.session.add(upload)
+        db.session.commit()
+
+        response = self.client.get(f"/image-manager/uploads/{upload.id}")
+        response_text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("hx-trigger", response_text)
+        self.assertIn("Processing failed", response_text)
+        self.assertEqual(db.session.get(Upload, upload.id).state, UploadState.FAILED)
+
     def test_upload_image_failure_as_admin(self):
         data = {}
         data["file"] = (io.BytesIO(b"abcdef"), "test-image.tiff")
@@ -693,12 +1157,283 @@ class RoutesAsAdminTestCase(BaseRouteTestCase):
         self.assertIn("warning", response_text)
 
 
+class ResponseCacheTestCase(BaseRouteTestCase):
+    def setUp(self):
+        super(ResponseCacheTestCase, self).setUp()
+        self.app.extensions["response_cache"] = cache_utils.LRUCacheBackend(
+            max_bytes=1024 * 1024
+        )
+        self.app.config["WTF_CSRF_ENABLED"] = True
+
+    def test_home_route_is_cached(self):
+        self.client.get("/")
+        post = Post.query.get(1)
+        post.title = "Changed behind the cache's back"
+        db.session.commit()
+
+        response = self.client.get("/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Title 1", response.get_data(as_text=True))
+
+    def test_cached_responses_expire(self):
+        self.client.get("/")
+        post = Post.query.get(1)
+        post.title = "Changed by another process"
+        db.session.commit()
+
+        later = time.time() + self.app.config["RESPONSE_CACHE_TTL"] + 1
+        with mock.patch("dtns.utils.cache_utils.time.time", return_value=later):
+            response = self.client.get("/")
+
+        self.assertIn("Changed by another process", response.get_data(as_text=True))
+
+    def test_cache_is_invalidated_when_post_changes(self):
+        self.client.get("/")
+
+        PostModelStorage.publish_post(4)
+        response = self.client.get("/")
+
+        self.assertIn("Title 4", response.get_data(as_text=True))
+
+    def test_cache_is_invalidated_when_comment_changes(self):
+        user = User(
+            email="test_1@test.com", username="test_user_1", password="test_password_1"
+        )
+        comment = Comment(text="A test comment", user=user, post=self.posts[0])
+        db.session.add_all([user, comment])
+        db.session.commit()
+        self.assertIn(
+            "A test comment", self.client.get("/post/slug-1").get_data(as_text=True)
+        )
+
+        CommentModelStorage.toggle_visibility_state(comment.id)
+        response = self.client.get("/post/slug-1")
+
+        self.assertNotIn("A test comment", response.get_data(as_text=True))
+
+    def test_cached_post_page_has_session_csrf_token(self):
+        other_client = self.app.test_client()
+        self.client.get("/post/slug-1")
+
+        with other_client:
+            response = other_client.get("/post/slug-1")
+            csrf_token = flask.g.csrf_token
+
+        response_text = response.get_data(as_text=True)
+        self.assertIn(csrf_token, response_text)
+        self.assertNotIn(cache_utils.CSRF_TOKEN_PLACEHOLDER.decode(), response_text)
+
+    def test_not_found_is_not_cached(self):
+        self.client.get("/post/slug-100")
+        post = Post(title="Late post", slug="slug-100", source="# Late")
+        db.session.add(post)
+        db.session.commit()
+
+        response = self.client.get("/post/slug-100")
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_is_not_cached(self):
+        self.app.config["LOGIN_DISABLED"] = True
+        user = User(
+            email="admin@test.com", username="admin", password="p", is_admin=True
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+            session["_fresh"] = True
+        self.client.get("/")
+        PostModelStorage.get(1).title = "Changed behind the cache's back"
+        db.session.commit()
+
+        response = self.client.get("/")
+
+        self.assertIn("Changed behind the cache", response.get_data(as_text=True))
+
+
 def create_test_image():
     img = Image.new(mode="RGB", size=(200, 200))
     ImageDraw.Draw(img).text((100, 100), "Testing... 1,2,3", (255, 255, 255))
     return img
 
 
+class ConditionalGetTestCase(BaseRouteTestCase):
+    def get_comment(self, post):
+        user = User(
+            email="test_1@test.com", username="test_user_1", password="test_password_1"
+        )
+        return Comment(text="A test comment", user=user, post=post)
+
+    def setUp(self):
+        super(ConditionalGetTestCase, self).setUp()
+        cursor = post_utils.encode_cursor(datetime.utcnow(), 100)
+        self.load_more_url = f"/load-more/posts?cursor={cursor}"
+
+    def test_validators_are_set(self):
+        for url in ("/", "/post/slug-1", "/posts/November%202021", self.load_more_url):
+            response = self.client.get(url)
+
+            self.assertIsNotNone(response.headers.get("ETag"), url)
+            self.assertIsNotNone(response.last_modified, url)
+            self.assertTrue(response.cache_control.private, msg=url)
+            self.assertTrue(response.cache_control.no_cache, msg=url)
+
+    def test_not_modified_by_etag(self):
+        for url in ("/", "/post/slug-1", "/about", self.load_more_url):
+            etag = self.client.get(url).headers["ETag"]
+
+            with mock.patch("dtns.routes.render_template") as render_template:
+                response = self.client.get(url, headers={"If-None-Match": etag})
+
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.headers["ETag"], etag, url)
+            self.assertEqual(response.get_data(), b"", url)
+            render_template.assert_not_called()
+
+    def test_not_modified_by_date(self):
+        last_modified = self.client.get("/").headers["Last-Modified"]
+
+        response = self.client.get("/", headers={"If-Modified-Since": last_modified})
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_post_change_changes_etag(self):
+        etag = self.client.get("/").headers["ETag"]
+
+        PostModelStorage.publish_post(4)
+        response = self.client.get("/", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_comment_changes_post_etag(self):
+        etag = self.client.get("/post/slug-1").headers["ETag"]
+        comment = self.get_comment(self.posts[0])
+        db.session.add(comment)
+        db.session.commit()
+
+        response = self.client.get("/post/slug-1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("A test comment", response.get_data(as_text=True))
+
+        etag = response.headers["ETag"]
+        CommentModelStorage.toggle_visibility_state(comment.id)
+        response = self.client.get("/post/slug-1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_comment_on_other_post_keeps_etag(self):
+        etag = self.client.get("/post/slug-1").headers["ETag"]
+        db.session.add(self.get_comment(self.posts[1]))
+        db.session.commit()
+
+        response = self.client.get("/post/slug-1", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_render_changes_post_etag(self):
+        etag = self.client.get("/post/slug-1").headers["ETag"]
+        db.session.execute(
+            Post.__table__.update()
+            .where(Post.id == self.posts[0].id)
+            .values(html="<p>Re-rendered</p>", renderer_version=0)
+        )
+        db.session.commit()
+
+        response = self.client.get("/post/slug-1", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Re-rendered", response.get_data(as_text=True))
+
+    def test_missing_post_is_not_conditional(self):
+        response = self.client.get("/post/slug-100", headers={"If-None-Match": "*"})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(response.headers.get("ETag"))
+
+    def test_post_request_is_not_conditional(self):
+        etag = self.client.get("/post/slug-1").headers["ETag"]
+
+        response = self.client.post("/post/slug-1", headers={"If-None-Match": etag})
+
+        self.assertNotEqual(response.status_code, 304)
+
+
+class MetricsTestCase(BaseRouteTestCase):
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        self.registry = self.app.extensions["metrics"]
+
+    def login(self):
+        user = User(
+            email="admin@test.com", username="admin", password="p", is_admin=True
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+            session["_fresh"] = True
+
+    def test_request_is_recorded(self):
+        self.client.get("/post/slug-1")
+        self.client.get("/post/slug-2")
+
+        statements = self.registry.get(
+            metrics_utils.RequestMetric.DB_STATEMENTS, "main.post"
+        )
+        self.assertEqual(statements.count, 2)
+        self.assertGreater(statements.sum, 0)
+        for name in (
+            metrics_utils.RequestMetric.DB_DURATION,
+            metrics_utils.RequestMetric.DURATION,
+            metrics_utils.RequestMetric.TEMPLATE_DURATION,
+        ):
+            histogram = self.registry.get(name, "main.post")
+            self.assertEqual(histogram.count, 2)
+            self.assertGreater(histogram.sum, 0)
+
+    def test_statements_outside_requests_are_not_recorded(self):
+        PostModelStorage.get_all()
+
+        self.assertIsNone(
+            self.registry.get(metrics_utils.RequestMetric.DB_STATEMENTS, "main.post")
+        )
+
+    def test_metrics_route_as_user(self):
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_metrics_route_as_admin(self):
+        self.login()
+        self.client.get("/")
+
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, metrics_utils.PROMETHEUS_CONTENT_TYPE)
+        self.assertIn(
+            'dtns_request_duration_seconds_count{endpoint="main.index"} 1',
+            response.get_data(as_text=True),
+        )
+
+    def test_metrics_route_from_localhost(self):
+        self.app.config["METRICS_ALLOW_LOCALHOST"] = True
+
+        local_response = self.client.get(
+            "/metrics", environ_base={"REMOTE_ADDR": "127.0.0.1"}
+        )
+        remote_response = self.client.get(
+            "/metrics", environ_base={"REMOTE_ADDR": "203.0.113.7"}
+        )
+
+        self.assertEqual(local_response.status_code, 200)
+        self.assertEqual(remote_response.status_code, 401)
+
+
 class ServeUploadTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app("testing")
@@ -713,6 +1448,10 @@ class ServeUploadTestCase(unittest.TestCase):
         img = create_test_image()
         img.save(os.path.join(self.full_upload_path, self.filename))
 
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.app.config["IMAGE_VARIANT_CACHE_DIR"] = cache_dir.name
+
     def tearDown(self):
         self.app_context.pop()
 
@@ -724,3 +1463,67 @@ class ServeUploadTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.mimetype, "image/jpeg")
         self.assertIn("max-age=3600", response.headers.get("Cache-Control"))
+
+    def test_serve_image_variant(self):
+        response = self.client.get(f"/uploads/{self.filename}/320.webp")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/webp")
+        self.assertIn("max-age=2592000", response.headers.get("Cache-Control"))
+        self.assertIsNotNone(response.headers.get("ETag"))
+        with Image.open(io.BytesIO(response.data)) as img:
+            self.assertEqual(img.format, "WEBP")
+            # Smaller images aren't made bigger
+            self.assertEqual(img.size, (200, 200))
+
+    def test_serve_image_variant_from_cache(self):
+        first = self.client.get(f"/uploads/{self.filename}/640.jpg")
+        with mock.patch("dtns.utils.image_utils.make_variant") as mock_make_variant:
+            second = self.client.get(f"/uploads/{self.filename}/640.jpg")
+            revalidated = self.client.get(
+                f"/uploads/{self.filename}/640.jpg",
+                headers={"If-None-Match": first.headers["ETag"]},
+            )
+
+        mock_make_variant.assert_not_called()
+        self.assertEqual(second.mimetype, "image/jpeg")
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_serve_image_variant_not_allowed(self):
+        for url in [
+            f"/uploads/{self.filename}/321.webp",
+            f"/uploads/{self.filename}/320.gif",
+            "/uploads/not-an-upload.jpg/320.webp",
+        ]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404, msg=url)
+
+    def test_serve_fingerprinted_upload(self):
+        fingerprint = asset_utils.get_fingerprint(f"uploads/{self.filename}")
+
+        response = self.client.get(f"/assets/{fingerprint}/uploads/{self.filename}")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/jpeg")
+        self.assertEqual(response.cache_control.max_age, asset_utils.IMMUTABLE_MAX_AGE)
+        self.assertTrue(response.cache_control.immutable)
+
+    def test_serve_fingerprinted_asset_with_old_fingerprint(self):
+        with self.app.test_request_context():
+            url = asset_utils.asset_url(f"uploads/{self.filename}")
+
+        response = self.client.get(f"/assets/0123456789ab/uploads/{self.filename}")
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith(url))
+        self.assertIsNone(response.cache_control.max_age)
+
+    def test_serve_fingerprinted_asset_not_found(self):
+        for url in [
+            "/assets/0123456789ab/uploads/not-an-upload.jpg",
+            "/assets/0123456789ab/uploads",
+            "/assets/0123456789ab/../config.py",
+        ]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404, msg=url)
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+
+from PIL import Image
+
+from scripts import resize_images
+
+
+class ResizeImagesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def make_image(self, filename, size=(100, 50)):
+        path = os.path.join(self.tmp_dir.name, filename)
+        Image.new("RGB", size).save(path)
+        return path
+
+    def test_fit_size(self):
+        box = (1000, 666)
+
+        self.assertEqual(resize_images._fit_size((4000, 3000), box), (888, 666))
+        self.assertEqual(resize_images._fit_size((3000, 4000), box), (500, 666))
+        self.assertEqual(resize_images._fit_size((4000, 2000), box), (1000, 500))
+
+    def test_fit_size_does_not_scale_up(self):
+        self.assertEqual(resize_images._fit_size((400, 300), (1000, 666)), (400, 300))
+
+    def test_fit_size_keeps_at_least_one_pixel(self):
+        self.assertEqual(resize_images._fit_size((10000, 1), (1000, 666)), (1000, 1))
+
+    def test_get_file_list(self):
+        for filename in [
+            "b.JPG",
+            "a.JPG",
+            "a_resize.JPG",
+            "trip_01.JPG",
+            "other_01.JPG",
+            "c.png",
+        ]:
+            self.make_image(filename)
+
+        file_list = resize_images._get_file_list(self.tmp_dir.name, "trip")
+
+        self.assertEqual(
+            [os.path.basename(file) for file in file_list],
+            ["a.JPG", "b.JPG", "other_01.JPG"],
+        )
+
+    def test_get_file_list_without_resize_name(self):
+        self.make_image("a.JPG")
+        self.make_image("trip_01.JPG")
+
+        file_list = resize_images._get_file_list(self.tmp_dir.name)
+
+        self.assertEqual(
+            [os.path.basename(file) for file in file_list], ["a.JPG", "trip_01.JPG"]
+        )
+
+    def test_is_up_to_date(self):
+        old_name = self.make_image("a.JPG")
+        new_name = os.path.join(self.tmp_dir.name, "trip_01.JPG")
+
+        self.assertFalse(resize_images._is_up_to_date(old_name, new_name))
+
+        resize_images._resize_image(old_name, new_name, (50, 50))
+
+        self.assertTrue(resize_images._is_up_to_date(old_name, new_name))
+
+    def test_is_up_to_date_after_input_changes(self):
+        old_name = self.make_image("a.JPG")
+        new_name = os.path.join(self.tmp_dir.name, "trip_01.JPG")
+        resize_images._resize_image(old_name, new_name, (50, 50))
+        mtime = os.path.getmtime(new_name)
+        os.utime(old_name, (mtime + 10, mtime + 10))
+
+        self.assertFalse(resize_images._is_up_to_date(old_name, new_name))
+
+    def test_is_up_to_date_after_inputs_shift(self):
+        a = self.make_image("a.JPG")
+        b = self.make_image("b.JPG")
+        lookup = resize_images._get_image_rename_lookup([a, b], "trip")
+        resize_images._resize_rename_images(lookup, dry_run=False)
+        new_name = lookup[a]
+
+        # A new first input takes over trip_01, made from a.JPG
+        first = self.make_image("0.JPG")
+        os.utime(first, (0, 0))
+        lookup = resize_images._get_image_rename_lookup([first, a, b], "trip")
+
+        self.assertEqual(lookup[first], new_name)
+        self.assertFalse(resize_images._is_up_to_date(first, new_name))
+        self.assertFalse(resize_images._is_up_to_date(a, lookup[a]))
+
+    def test_is_up_to_date_without_recorded_source(self):
+        old_name = self.make_image("a.JPG")
+        os.utime(old_name, (0, 0))
+        new_name = self.make_image("trip_01.JPG")
+
+        self.assertFalse(resize_images._is_up_to_date(old_name, new_name))
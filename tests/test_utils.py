@@ -1,42 +1,78 @@
+import hashlib
+import io
+import os
+import smtplib
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from unittest import mock
 
+from flask_mail import Message
 from freezegun import freeze_time
+from PIL import Image
+from werkzeug.datastructures import FileStorage
 
 from dtns import create_app
 from dtns import db
-from dtns.constants import PostStatus
+from dtns import mail
+from dtns.constants import IMAGE_VARIANT_WIDTHS
+from dtns.constants import CommentState
+from dtns.constants import JobState
+from dtns.model_storage import CommentModelStorage
 from dtns.model_storage import PostModelStorage
+from dtns.models import Comment
+from dtns.models import Job
 from dtns.models import Post
+from dtns.models import User
+from dtns.utils import asset_utils
+from dtns.utils import cache_utils
+from dtns.utils import email_utils
+from dtns.utils import http_utils
 from dtns.utils import image_utils
+from dtns.utils import job_utils
+from dtns.utils import lang_utils
+from dtns.utils import mail_queue_utils
+from dtns.utils import metrics_utils
 from dtns.utils import post_utils
-
+from dtns.utils import preview_utils
+from dtns.utils import render_utils
+from dtns.utils import search_utils
 
 NUM_POSTS = 10
 
 
-@mock.patch(
-    "dtns.utils.image_utils.os.listdir",
-    return_value=[
-        "test-img-2.jpg",
-        "test-img-1.jpg",
-        "test-img-3.jpg",
-        "test-img-4.tiff",
-    ],
-)
 class ImageManagerTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app("testing")
         self.app_context = self.app.app_context()
         self.app_context.push()
 
-    def test_get_all_images(self, mock_listdir):
+        static_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(static_dir.cleanup)
+        self.app.static_folder = static_dir.name
+        self.upload_path = os.path.join(
+            static_dir.name, self.app.config["UPLOAD_FOLDER"]
+        )
+        os.mkdir(self.upload_path)
+        for i, name in enumerate(
+            ["test-img-2.jpg", "test-img-1.jpg", "test-img-3.jpg", "test-img-4.tiff"],
+            start=1,
+        ):
+            Image.new("RGB", (10 * i, 5 * i)).save(os.path.join(self.upload_path, name))
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_get_all_images(self):
         image_manager = image_utils.ImageManager(self.app)
 
         image_list = image_manager.get_all_images()
 
-        self.assertEqual(
+        self.assertCountEqual(
             image_list,
             [
                 "test-img-2.jpg",
@@ -45,7 +81,7 @@ class ImageManagerTestCase(unittest.TestCase):
             ],
         )
 
-    def test_get_all_images_sorted_default(self, mock_listdir):
+    def test_get_all_images_sorted_default(self):
         image_manager = image_utils.ImageManager(self.app)
 
         image_list = image_manager.get_all_images_sorted()
@@ -59,7 +95,7 @@ class ImageManagerTestCase(unittest.TestCase):
             ],
         )
 
-    def test_get_all_images_sorted_asc_false(self, mock_listdir):
+    def test_get_all_images_sorted_asc_false(self):
         image_manager = image_utils.ImageManager(self.app)
 
         image_list = image_manager.get_all_images_sorted(asc=False)
@@ -73,63 +109,286 @@ class ImageManagerTestCase(unittest.TestCase):
             ],
         )
 
-    def test_get_image(self, mock_listdir):
+    def test_get_image(self):
         image_manager = image_utils.ImageManager(self.app)
 
         image = image_manager.get_image("test-img-1.jpg")
 
         self.assertEqual(image, "test-img-1.jpg")
 
-    def test_save_image(self, mock_listdir):
+    def test_get_image_info(self):
         image_manager = image_utils.ImageManager(self.app)
-        mock_file_upload = mock.MagicMock()
-        mock_file_upload.filename = "test-img-5.jpg"
-        mock_file_upload.save.return_value = f"/mock_path/{mock_file_upload.filename}"
 
-        image = image_manager.save_image(mock_file_upload)
+        info = image_manager.get_image_info("test-img-1.jpg")
 
-        self.assertEqual(image, mock_file_upload.filename)
+        self.assertEqual(info.name, "test-img-1.jpg")
+        self.assertEqual((info.width, info.height), (20, 10))
+        self.assertEqual(
+            info.size, os.path.getsize(os.path.join(self.upload_path, info.name))
+        )
+
+    def _make_upload(self, filename, size=(1, 1)):
+        data = io.BytesIO()
+        Image.new("RGB", size).save(data, "JPEG")
+        data.seek(0)
+        return FileStorage(stream=data, filename=filename)
 
-    def test_save_image_invalid_filename_returns_none(self, mock_listdir):
+    def _get_temp_files(self):
+        return [name for name in os.listdir(self.upload_path) if name.endswith(".tmp")]
+
+    def test_save_image(self):
         image_manager = image_utils.ImageManager(self.app)
-        mock_file_upload = mock.MagicMock()
-        mock_file_upload.filename = "test-img-5.tiff"
-        mock_file_upload.save.return_value = f"/mock_path/{mock_file_upload.filename}"
+        file_upload = self._make_upload("test-img-5.jpg")
+        data = file_upload.stream.getvalue()
+
+        saved = image_manager.save_image(file_upload)
 
-        image = image_manager.save_image(mock_file_upload)
+        self.assertEqual(saved.name, "test-img-5.jpg")
+        self.assertTrue(saved.is_new)
+        self.assertEqual(saved.content_hash, hashlib.sha256(data).hexdigest())
+        self.assertIn("test-img-5.jpg", image_manager.get_all_images())
+        with open(os.path.join(self.upload_path, "test-img-5.jpg"), "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self._get_temp_files(), [])
+
+    def test_save_image_invalid_filename_returns_none(self):
+        image_manager = image_utils.ImageManager(self.app)
+        file_upload = self._make_upload("test-img-5.tiff")
+
+        image = image_manager.save_image(file_upload)
 
         self.assertIsNone(image)
+        self.assertNotIn("test-img-5.tiff", os.listdir(self.upload_path))
 
-    def test_save_image_already_saved_returns_none(self, mock_listdir):
+    def test_save_image_already_saved_returns_none(self):
         image_manager = image_utils.ImageManager(self.app)
-        mock_file_upload = mock.MagicMock()
-        mock_file_upload.filename = "test-img-1.jpg"
-        mock_file_upload.save.return_value = f"/mock_path/{mock_file_upload.filename}"
+        file_upload = self._make_upload("test-img-1.jpg", (3, 3))
 
-        image = image_manager.save_image(mock_file_upload)
+        image = image_manager.save_image(file_upload)
 
         self.assertIsNone(image)
+        self.assertEqual(image_manager.get_image_info("test-img-1.jpg").width, 20)
+        self.assertEqual(self._get_temp_files(), [])
+
+    def test_save_image_duplicate_returns_existing_name(self):
+        image_manager = image_utils.ImageManager(self.app)
+        with open(os.path.join(self.upload_path, "test-img-2.jpg"), "rb") as f:
+            file_upload = FileStorage(stream=io.BytesIO(f.read()), filename="copy.jpg")
+
+        saved = image_manager.save_image(file_upload)
+
+        self.assertEqual(saved.name, "test-img-2.jpg")
+        self.assertFalse(saved.is_new)
+        self.assertNotIn("copy.jpg", image_manager.get_all_images())
+        self.assertEqual(self._get_temp_files(), [])
+
+    def test_save_image_duplicate_found_by_source_hash(self):
+        image_manager = image_utils.ImageManager(self.app)
+        file_upload = self._make_upload("copy.jpg")
+        content_hash = hashlib.sha256(file_upload.stream.getvalue()).hexdigest()
+        find_existing = mock.Mock(return_value="test-img-3.jpg")
+
+        saved = image_manager.save_image(file_upload, find_existing)
+
+        find_existing.assert_called_once_with(content_hash)
+        self.assertEqual(saved, ("test-img-3.jpg", content_hash, False))
+        self.assertNotIn("copy.jpg", image_manager.get_all_images())
+
+    def test_save_image_source_hash_of_deleted_image_is_ignored(self):
+        image_manager = image_utils.ImageManager(self.app)
+        file_upload = self._make_upload("test-img-5.jpg")
 
-    @mock.patch("dtns.utils.image_utils.os.remove")
-    def test_delete_image(self, mock_remove, mock_listdir):
-        mock_remove.return_value = None
+        saved = image_manager.save_image(file_upload, lambda content_hash: "gone.jpg")
+
+        self.assertEqual(saved.name, "test-img-5.jpg")
+        self.assertTrue(saved.is_new)
+
+    def test_save_image_too_large(self):
+        self.app.config["IMAGE_UPLOAD_MAX_BYTES"] = 100
+        image_manager = image_utils.ImageManager(self.app)
+        file_upload = self._make_upload("test-img-5.jpg", (100, 100))
+
+        with self.assertRaises(image_utils.UploadTooLargeError):
+            image_manager.save_image(file_upload)
+
+        self.assertNotIn("test-img-5.jpg", image_manager.get_all_images())
+        self.assertEqual(self._get_temp_files(), [])
+
+    def test_delete_image(self):
         image_manager = image_utils.ImageManager(self.app)
 
         image = image_manager.delete_image("test-img-2.jpg")
 
         self.assertEqual(image, "test-img-2.jpg")
+        self.assertNotIn("test-img-2.jpg", image_manager.get_all_images())
+        self.assertFalse(
+            os.path.exists(os.path.join(self.upload_path, "test-img-2.jpg"))
+        )
 
-    @mock.patch("dtns.utils.image_utils.os.remove")
-    def test_delete_image_non_exist_image_returns_none(self, mock_remove, mock_listdir):
-        mock_remove.return_value = None
+    def test_delete_image_non_exist_image_returns_none(self):
         image_manager = image_utils.ImageManager(self.app)
 
         image = image_manager.delete_image("wont-find.jpg")
 
         self.assertIsNone(image)
 
-    def tearDown(self):
-        self.app_context.pop()
+    def test_index_scans_only_when_directory_changes(self):
+        image_manager = image_utils.ImageManager(self.app)
+        image_manager.get_all_images()
+
+        with mock.patch(
+            "dtns.utils.image_utils.os.scandir", wraps=os.scandir
+        ) as mock_scandir:
+            image_manager.get_all_images()
+            image_manager.get_image("test-img-1.jpg")
+            mock_scandir.assert_not_called()
+
+            # Made by another process, e.g. a second web worker
+            Image.new("RGB", (1, 1)).save(os.path.join(self.upload_path, "new.png"))
+            os.utime(self.upload_path, ns=(0, time.time_ns() + 10**9))
+
+            self.assertEqual(image_manager.get_image("new.png"), "new.png")
+            mock_scandir.assert_called_once()
+
+    def test_index_only_opens_new_images(self):
+        image_manager = image_utils.ImageManager(self.app)
+        image_manager.get_all_images()
+        Image.new("RGB", (1, 1)).save(os.path.join(self.upload_path, "new.png"))
+
+        with mock.patch(
+            "dtns.utils.image_utils.get_image_dimensions", return_value=(1, 1)
+        ) as mock_dimensions:
+            image_manager.index.refresh(force=True)
+
+        mock_dimensions.assert_called_once_with(
+            os.path.join(self.upload_path, "new.png")
+        )
+
+
+class ImageVariantTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache = image_utils.VariantCache(
+            os.path.join(self.tmp_dir.name, "variants"), max_bytes=350
+        )
+
+    def test_make_variant(self):
+        path = os.path.join(self.tmp_dir.name, "wide.png")
+        Image.new("RGBA", (2000, 1000)).save(path)
+
+        data = image_utils.make_variant(path, 640, "JPEG")
+
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.format, "JPEG")
+            self.assertEqual(img.size, (640, 320))
+
+    def test_make_variant_applies_orientation(self):
+        path = os.path.join(self.tmp_dir.name, "rotated.jpg")
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees
+        Image.new("RGB", (2000, 1000)).save(path, exif=exif)
+
+        data = image_utils.make_variant(path, 320, "WEBP")
+
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.size, (320, 640))
+            self.assertNotIn(0x0112, img.getexif())
+
+    def test_process_image(self):
+        path = os.path.join(self.tmp_dir.name, "photo.jpg")
+        webp_path = f"{path}.webp"
+        exif = Image.Exif()
+        exif[0x0112] = 8  # Rotated 270 degrees
+        exif[0x8825] = {2: (51.0, 30.0, 0.0)}  # Where it was taken
+        Image.new("RGB", (3000, 1500)).save(path, exif=exif, quality=100)
+        steps = []
+
+        metadata = image_utils.process_image(path, webp_path, steps.append)
+
+        self.assertEqual(steps, [0, 1, 2])
+        self.assertEqual((metadata["width"], metadata["height"]), (1280, 2560))
+        self.assertEqual(metadata["num_bytes"], os.path.getsize(path))
+        self.assertEqual(metadata["content_hash"], image_utils.hash_file(path))
+        self.assertTrue(metadata["has_webp"])
+        with Image.open(path) as img:
+            self.assertEqual(dict(img.getexif()), {})
+        with Image.open(webp_path) as img:
+            self.assertEqual((img.format, img.size), ("WEBP", (1280, 2560)))
+
+    def test_process_image_keeps_smaller_original(self):
+        path = os.path.join(self.tmp_dir.name, "photo.jpg")
+        Image.effect_noise((400, 300), 64).convert("RGB").save(path, quality=60)
+        content_hash = image_utils.hash_file(path)
+
+        metadata = image_utils.process_image(path, f"{path}.webp")
+
+        self.assertEqual(metadata["content_hash"], content_hash)
+        self.assertTrue(metadata["has_webp"])
+
+    def test_process_image_strips_exif_from_smaller_original(self):
+        path = os.path.join(self.tmp_dir.name, "photo.jpg")
+        exif = Image.Exif()
+        exif[0x8825] = {2: (51.0, 30.0, 0.0)}  # Where it was taken
+        Image.effect_noise((400, 300), 64).convert("RGB").save(
+            path, exif=exif, quality=60
+        )
+
+        image_utils.process_image(path, f"{path}.webp")
+
+        with Image.open(path) as img:
+            self.assertEqual(dict(img.getexif()), {})
+
+    def test_process_image_leaves_animations_alone(self):
+        path = os.path.join(self.tmp_dir.name, "animated.gif")
+        frames = [Image.new("P", (10, 10), color) for color in range(3)]
+        frames[0].save(path, save_all=True, append_images=frames[1:])
+        content_hash = image_utils.hash_file(path)
+
+        metadata = image_utils.process_image(path, f"{path}.webp")
+
+        self.assertEqual(metadata["content_hash"], content_hash)
+        self.assertFalse(metadata["has_webp"])
+
+    def test_variant_cache(self):
+        self.assertIsNone(self.cache.get("abcd", "webp"))
+
+        path = self.cache.set("abcd", "webp", b"x" * 100)
+
+        self.assertEqual(self.cache.get("abcd", "webp"), path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"x" * 100)
+
+    def test_variant_cache_evicts_least_recently_used(self):
+        for i, key in enumerate(["aa01", "bb02", "cc03"]):
+            path = self.cache.set(key, "jpg", b"x" * 100)
+            os.utime(path, (i, i))
+        # Reading aa01 makes bb02 the least recently used
+        self.cache.get("aa01", "jpg")
+
+        self.cache.set("dd04", "jpg", b"x" * 100)
+
+        self.assertIsNotNone(self.cache.get("aa01", "jpg"))
+        self.assertIsNone(self.cache.get("bb02", "jpg"))
+        self.assertIsNotNone(self.cache.get("cc03", "jpg"))
+        self.assertIsNotNone(self.cache.get("dd04", "jpg"))
+        self.assertEqual(self.cache.num_bytes, 300)
+
+    def test_variant_key_follows_content(self):
+        app = create_app("testing")
+        app.static_folder = self.tmp_dir.name
+        app.config["IMAGE_VARIANT_CACHE_DIR"] = self.cache.cache_dir
+        os.mkdir(os.path.join(self.tmp_dir.name, app.config["UPLOAD_FOLDER"]))
+        path = os.path.join(self.tmp_dir.name, app.config["UPLOAD_FOLDER"], "a.png")
+        image_manager = image_utils.ImageManager(app)
+
+        Image.new("RGB", (10, 10), "red").save(path)
+        first = image_manager.get_variant("a.png", 320, "webp")
+        Image.new("RGB", (20, 20), "blue").save(path)
+        second = image_manager.get_variant("a.png", 320, "webp")
+
+        self.assertNotEqual(first.key, second.key)
+        self.assertIsNone(image_manager.get_variant("missing.png", 320, "webp"))
 
 
 class ImageUtilsTestCase(unittest.TestCase):
@@ -190,41 +449,37 @@ class PostUtilsTestCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
-    def test_aggregate_and_sort_posts_by_month_year(self):
-        # "publish" posts
-        for i in range(8):
-            post = self.posts[i]
-            if i <= 4:
-                freezer = freeze_time("2021-11-01 12:00:00")
-                freezer.start()
-
-                now = datetime.utcnow()
-                post.state = PostStatus.PUBLISHED
-                post.updated_at = now
-                post.published_at = now
+    def test_get_month_range(self):
+        self.assertEqual(
+            post_utils.get_month_range(datetime(2021, 11, 15, 8, 30)),
+            (datetime(2021, 11, 1), datetime(2021, 12, 1)),
+        )
+        self.assertEqual(
+            post_utils.get_month_range(datetime(2021, 12, 31, 23, 59)),
+            (datetime(2021, 12, 1), datetime(2022, 1, 1)),
+        )
 
-                db.session.add(post)
-                db.session.commit()
-                freezer.stop()
-            else:
-                freezer = freeze_time("2021-12-01 12:00:00")
-                freezer.start()
+    def test_get_month_year_range(self):
+        self.assertEqual(
+            post_utils.get_month_year_range("February 2024"),
+            (datetime(2024, 2, 1), datetime(2024, 3, 1)),
+        )
 
-                now = datetime.utcnow()
-                post.state = PostStatus.PUBLISHED
-                post.updated_at = now
-                post.published_at = now
+        with self.assertRaises(ValueError):
+            post_utils.get_month_year_range("Smarch 2024")
 
-                db.session.add(post)
-                db.session.commit()
-                freezer.stop()
+    def test_encode_decode_cursor(self):
+        published_at = datetime(2021, 11, 1, 12, 30, 15, 1234)
 
-        posts = PostModelStorage.get_all_published_posts()
+        cursor = post_utils.encode_cursor(published_at, 42)
 
-        post_archive = post_utils.aggregate_and_sort_posts_by_month_year(posts)
+        self.assertEqual(post_utils.decode_cursor(cursor), (published_at, 42))
 
-        self.assertEqual(post_archive, ["December 2021", "November 2021"])
-        self.assertEqual(len(post_archive), 2)
+    def test_decode_cursor_invalid(self):
+        truncated_cursor = post_utils.encode_cursor(datetime.now(), 1)[2:]
+        for cursor in ["", "not-a-cursor", truncated_cursor]:
+            with self.assertRaises(post_utils.InvalidCursorError):
+                post_utils.decode_cursor(cursor)
 
     def test_validate_comment_text_exception(self):
         with self.assertRaises(post_utils.UnsupportedLanguageError):
@@ -234,3 +489,968 @@ class PostUtilsTestCase(unittest.TestCase):
         post_utils.validate_comment_text(
             "War doesn't show who's right, just who's left."
         )
+
+
+class LangUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        lang_utils._detect.cache_clear()
+
+    def test_detect_language(self):
+        self.assertEqual(lang_utils.detect_language("Ein, zwei, drei, vier"), "de")
+        self.assertEqual(
+            lang_utils.detect_language("Je pense que c'est une bonne idée"), "fr"
+        )
+
+    def test_detect_language_is_deterministic(self):
+        # Short text like this used to flip between languages run to run
+        results = set()
+        for _ in range(20):
+            lang_utils._detect.cache_clear()
+            results.add(lang_utils.detect_language("Just leaving a comment!"))
+
+        self.assertEqual(results, {"en"})
+
+    def test_detect_language_fast_path(self):
+        with mock.patch("dtns.utils.lang_utils._detect") as mock_detect:
+            lang = lang_utils.detect_language(
+                "Great post, thanks for sharing this with all of us"
+            )
+
+        self.assertEqual(lang, "en")
+        mock_detect.assert_not_called()
+
+    def test_is_probably_english(self):
+        self.assertTrue(lang_utils.is_probably_english("I think that this is great"))
+        for text in [
+            "",
+            "Hi there",
+            "Estoy muy feliz de ver este blog hoy amigos",
+            "Was ist das? Ich will es so haben",
+            "Привет, как дела? I think that this is it",
+        ]:
+            self.assertFalse(lang_utils.is_probably_english(text), msg=text)
+
+    def test_detect_language_is_cached(self):
+        for _ in range(3):
+            lang_utils.detect_language("Ein, zwei, drei, vier")
+
+        info = lang_utils._detect.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+    def test_sample_text(self):
+        text = "a" * 1000 + "b" * 1000 + "c" * 1000
+
+        sample = lang_utils.sample_text(text, max_length=300)
+
+        self.assertEqual(sample, "a" * 100 + " " + "b" * 100 + " " + "c" * 100)
+        self.assertEqual(lang_utils.sample_text("short", max_length=300), "short")
+
+
+class SearchUtilsTestCase(unittest.TestCase):
+    def test_tokenize(self):
+        tokens = search_utils.tokenize("Here's a Post, find me later!")
+
+        self.assertEqual(tokens, ["here", "s", "a", "post", "find", "me", "later"])
+
+    def test_tokenize_no_text(self):
+        self.assertEqual(search_utils.tokenize(None), [])
+        self.assertEqual(search_utils.tokenize(""), [])
+
+    def test_stem(self):
+        for word in ["post", "posts", "posted", "posting"]:
+            self.assertEqual(search_utils.stem(word), "post")
+
+        self.assertEqual(search_utils.stem("running"), "run")
+        self.assertEqual(search_utils.stem("queries"), "query")
+        self.assertEqual(search_utils.stem("create"), search_utils.stem("created"))
+
+    def test_build_postings(self):
+        postings = search_utils.build_postings("Data Things", "data and stuff")
+
+        self.assertEqual(postings["data"], [0, 2 + search_utils.FIELD_POSITION_GAP])
+        self.assertEqual(postings["thing"], [1])
+        self.assertEqual(postings["stuff"], [4 + search_utils.FIELD_POSITION_GAP])
+
+    def test_serialize_deserialize_positions(self):
+        positions = [1, 5, 12]
+
+        serialized = search_utils.serialize_positions(positions)
+
+        self.assertEqual(serialized, "1,5,12")
+        self.assertEqual(search_utils.deserialize_positions(serialized), positions)
+
+    def test_rank_requires_all_terms(self):
+        postings = [
+            {1: (1, [0]), 2: (1, [0])},
+            {2: (1, [4])},
+        ]
+
+        self.assertEqual(search_utils.rank(postings, 10), [2])
+
+    def test_rank_no_matches(self):
+        self.assertEqual(search_utils.rank([], 10), [])
+        self.assertEqual(search_utils.rank([{1: (1, [0])}, {}], 10), [])
+
+    def test_rank_orders_by_frequency_and_phrase(self):
+        postings = [
+            {1: (1, [0]), 2: (5, [0, 3, 8, 12, 20]), 3: (1, [7])},
+            {1: (1, [9]), 2: (1, [30]), 3: (1, [8])},
+        ]
+
+        self.assertEqual(search_utils.rank(postings, 10), [2, 3, 1])
+
+    def test_rank_idf_uses_all_posts(self):
+        # Terms found in 2 of 100 posts are rare enough that frequency
+        # outweighs the phrase bonus
+        postings = [
+            {1: (2, [0, 5]), 2: (1, [0])},
+            {1: (1, [9]), 2: (1, [1])},
+        ]
+
+        self.assertEqual(search_utils.rank(postings, 100), [1, 2])
+        self.assertEqual(search_utils.rank(postings, 2), [2, 1])
+
+    def test_build_sqlite_fts_query(self):
+        query = search_utils.build_sqlite_fts_query("Data things & st")
+
+        self.assertEqual(query, '"data" "things" "st"*')
+        self.assertIsNone(search_utils.build_sqlite_fts_query("&"))
+
+    def test_build_mysql_boolean_query(self):
+        query = search_utils.build_mysql_boolean_query("Find me later, pl")
+
+        self.assertEqual(query, "+find +later +pl*")
+        self.assertEqual(
+            search_utils.build_mysql_boolean_query("Find me later"), "+find +later*"
+        )
+        self.assertEqual(search_utils.build_mysql_boolean_query("ab"), "+ab*")
+        self.assertIsNone(search_utils.build_mysql_boolean_query("a b"))
+        self.assertIsNone(search_utils.build_mysql_boolean_query(""))
+
+    def test_get_search_backend_configured(self):
+        backend = search_utils.get_search_backend(
+            mock.Mock(), search_utils.SearchBackend.LIKE
+        )
+
+        self.assertEqual(backend, search_utils.SearchBackend.LIKE)
+
+
+class CacheUtilsTestCase(unittest.TestCase):
+    def make_value(self, body):
+        return {"body": body, "mimetype": "text/html"}
+
+    def test_lru_cache_get_set(self):
+        cache = cache_utils.LRUCacheBackend(max_bytes=1024)
+
+        cache.set("key", self.make_value(b"body"))
+
+        self.assertEqual(cache.get("key"), self.make_value(b"body"))
+        self.assertIsNone(cache.get("missing"))
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = cache_utils.LRUCacheBackend(max_bytes=25)
+        cache.set("a", self.make_value(b"x" * 9))
+        cache.set("b", self.make_value(b"x" * 9))
+        cache.get("a")
+
+        cache.set("c", self.make_value(b"x" * 9))
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.num_bytes, 20)
+
+    def test_lru_cache_skips_values_larger_than_cache(self):
+        cache = cache_utils.LRUCacheBackend(max_bytes=10)
+
+        cache.set("key", self.make_value(b"x" * 20))
+
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.num_bytes, 0)
+
+    def test_lru_cache_clear(self):
+        cache = cache_utils.LRUCacheBackend(max_bytes=1024)
+        cache.set("key", self.make_value(b"body"))
+
+        cache.clear()
+
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.num_bytes, 0)
+
+    def test_filesystem_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = cache_utils.FileSystemCacheBackend(cache_dir, max_bytes=1024)
+            other_worker_cache = cache_utils.FileSystemCacheBackend(
+                cache_dir, max_bytes=1024
+            )
+
+            cache.set("key", self.make_value(b"body"))
+            self.assertEqual(other_worker_cache.get("key"), self.make_value(b"body"))
+
+            other_worker_cache.clear()
+            self.assertIsNone(cache.get("key"))
+
+    def test_filesystem_cache_evicts_when_full(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = cache_utils.FileSystemCacheBackend(cache_dir, max_bytes=500)
+
+            for i in range(10):
+                cache.set(f"key-{i}", self.make_value(b"x" * 100))
+
+            self.assertIsNotNone(cache.get("key-9"))
+            self.assertIsNone(cache.get("key-0"))
+            self.assertLessEqual(
+                sum(entry.stat().st_size for entry in cache._get_cache_files()), 500
+            )
+
+    def test_unknown_cache_type(self):
+        app = create_app("testing")
+        app.config["RESPONSE_CACHE_TYPE"] = "nope"
+
+        with self.assertRaises(ValueError):
+            cache_utils.ResponseCache(app)
+
+
+class HttpUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.last_modified = datetime(2021, 11, 1, 10, 30, 15, 123456)
+
+    def test_make_etag(self):
+        self.assertEqual(http_utils.make_etag(1, "a"), http_utils.make_etag(1, "a"))
+        self.assertNotEqual(http_utils.make_etag(1, "a"), http_utils.make_etag(1, "b"))
+
+    def test_to_http_date(self):
+        aware = datetime(2021, 11, 1, 12, 30, 15, tzinfo=timezone(timedelta(hours=2)))
+
+        self.assertEqual(
+            http_utils.to_http_date(self.last_modified),
+            datetime(2021, 11, 1, 10, 30, 15),
+        )
+        self.assertEqual(
+            http_utils.to_http_date(aware), datetime(2021, 11, 1, 10, 30, 15)
+        )
+
+    def test_is_not_modified_by_etag(self):
+        with self.app.test_request_context(headers={"If-None-Match": '"abc"'}):
+            self.assertTrue(http_utils.is_not_modified("abc", self.last_modified))
+            self.assertFalse(http_utils.is_not_modified("def", self.last_modified))
+
+    def test_is_not_modified_by_date(self):
+        headers = {"If-Modified-Since": "Mon, 01 Nov 2021 10:30:15 GMT"}
+        with self.app.test_request_context(headers=headers):
+            self.assertTrue(http_utils.is_not_modified("abc", self.last_modified))
+            self.assertFalse(
+                http_utils.is_not_modified(
+                    "abc", self.last_modified + timedelta(seconds=1)
+                )
+            )
+            self.assertFalse(http_utils.is_not_modified("abc", None))
+
+    def test_etag_takes_precedence_over_date(self):
+        headers = {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Mon, 01 Nov 2021 10:30:15 GMT",
+        }
+        with self.app.test_request_context(headers=headers):
+            self.assertFalse(http_utils.is_not_modified("def", self.last_modified))
+
+    def test_no_conditional_headers(self):
+        with self.app.test_request_context():
+            self.assertFalse(http_utils.is_not_modified("abc", self.last_modified))
+
+
+class MetricsUtilsTestCase(unittest.TestCase):
+    def test_histogram_observe(self):
+        histogram = metrics_utils.Histogram((1, 5))
+
+        for value in (0, 1, 3, 10):
+            histogram.observe(value)
+
+        self.assertEqual(
+            list(histogram.get_cumulative_counts()), [(1, 2), (5, 3), ("+Inf", 4)]
+        )
+        self.assertEqual(histogram.sum, 14)
+        self.assertEqual(histogram.count, 4)
+
+    def test_registry_render(self):
+        registry = metrics_utils.MetricsRegistry()
+        registry.observe(metrics_utils.RequestMetric.DB_STATEMENTS, "main.index", 3)
+        registry.observe(metrics_utils.RequestMetric.DB_STATEMENTS, "main.index", 7)
+
+        text = registry.render()
+
+        self.assertIn("# TYPE dtns_request_db_statements histogram", text)
+        self.assertIn(
+            'dtns_request_db_statements_bucket{endpoint="main.index",le="5"} 1', text
+        )
+        self.assertIn(
+            'dtns_request_db_statements_bucket{endpoint="main.index",le="+Inf"} 2',
+            text,
+        )
+        self.assertIn('dtns_request_db_statements_sum{endpoint="main.index"} 10', text)
+        self.assertIn('dtns_request_db_statements_count{endpoint="main.index"} 2', text)
+
+    def test_escape_label(self):
+        self.assertEqual(metrics_utils.escape_label('a"b\\c'), 'a\\"b\\\\c')
+
+    def test_is_local_request(self):
+        app = create_app("testing")
+
+        with app.test_request_context(environ_base={"REMOTE_ADDR": "127.0.0.1"}):
+            self.assertTrue(metrics_utils.is_local_request())
+        with app.test_request_context(environ_base={"REMOTE_ADDR": "::1"}):
+            self.assertTrue(metrics_utils.is_local_request())
+        with app.test_request_context(environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+            self.assertFalse(metrics_utils.is_local_request())
+
+
+class AssetUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+        static_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(static_dir.cleanup)
+        self.app.static_folder = static_dir.name
+        os.mkdir(os.path.join(static_dir.name, "css"))
+        self.path = os.path.join(static_dir.name, "css", "style.css")
+        with open(self.path, "w") as f:
+            f.write("body { color: red; }")
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_get_fingerprint(self):
+        fingerprint = asset_utils.get_fingerprint("css/style.css")
+
+        self.assertEqual(
+            fingerprint,
+            image_utils.hash_file(self.path)[: asset_utils.FINGERPRINT_LENGTH],
+        )
+        with mock.patch("dtns.utils.asset_utils.hash_file") as mock_hash_file:
+            self.assertEqual(asset_utils.get_fingerprint("css/style.css"), fingerprint)
+        mock_hash_file.assert_not_called()
+
+    def test_get_fingerprint_changes_with_content(self):
+        fingerprint = asset_utils.get_fingerprint("css/style.css")
+
+        with open(self.path, "w") as f:
+            f.write("body { color: blue; }")
+
+        self.assertNotEqual(asset_utils.get_fingerprint("css/style.css"), fingerprint)
+
+    def test_get_fingerprint_not_a_file(self):
+        for filename in ["css/missing.css", "css", "css/style.css/x", "../secret"]:
+            self.assertIsNone(asset_utils.get_fingerprint(filename), msg=filename)
+
+    def test_asset_url(self):
+        fingerprint = asset_utils.get_fingerprint("css/style.css")
+
+        with self.app.test_request_context():
+            self.assertEqual(
+                asset_utils.asset_url("css/style.css"),
+                f"/assets/{fingerprint}/css/style.css",
+            )
+            self.assertEqual(
+                asset_utils.asset_url("css/missing.css"), "/static/css/missing.css"
+            )
+
+    def test_fingerprint_uploads(self):
+        os.mkdir(os.path.join(self.app.static_folder, "uploads"))
+        path = os.path.join(self.app.static_folder, "uploads", "a.jpg")
+        Image.new("RGB", (1, 1)).save(path)
+        html = render_utils.render_source(
+            "![a](/uploads/a.jpg)\n\n![b](/uploads/b.jpg)\n"
+        )
+
+        with self.app.test_request_context():
+            fingerprinted = asset_utils.fingerprint_uploads(html)
+            Image.new("RGB", (2, 2)).save(path)
+            refingerprinted = asset_utils.fingerprint_uploads(html)
+
+        fingerprint = image_utils.hash_file(path)[: asset_utils.FINGERPRINT_LENGTH]
+        self.assertIn('src="/uploads/a.jpg"', html)
+        self.assertNotIn(f"/assets/{fingerprint}/", fingerprinted)
+        self.assertIn(f'src="/assets/{fingerprint}/uploads/a.jpg"', refingerprinted)
+        self.assertIn('src="/uploads/b.jpg"', refingerprinted)
+
+    def test_fingerprint_uploads_absolute_urls(self):
+        os.mkdir(os.path.join(self.app.static_folder, "uploads"))
+        path = os.path.join(self.app.static_folder, "uploads", "a.jpg")
+        Image.new("RGB", (1, 1)).save(path)
+        html = render_utils.render_source(
+            "![a](https://dtns.test/uploads/a.jpg)\n\n"
+            "![b](https://elsewhere.test/uploads/a.jpg)\n"
+        )
+
+        with self.app.test_request_context(base_url="https://dtns.test/"):
+            fingerprinted = asset_utils.fingerprint_uploads(html)
+
+        fingerprint = image_utils.hash_file(path)[: asset_utils.FINGERPRINT_LENGTH]
+        self.assertIn(
+            f'src="https://dtns.test/assets/{fingerprint}/uploads/a.jpg"', fingerprinted
+        )
+        self.assertIn('src="https://elsewhere.test/uploads/a.jpg"', fingerprinted)
+        self.assertIn("https://dtns.test/uploads/a.jpg/320.jpg 320w", fingerprinted)
+
+    def test_fingerprint_uploads_srcset(self):
+        os.mkdir(os.path.join(self.app.static_folder, "uploads"))
+        for name in ["a.jpg", "b.png", "c.gif"]:
+            path = os.path.join(self.app.static_folder, "uploads", name)
+            Image.new("RGB", (1, 1)).save(path)
+        html = render_utils.render_source(
+            "![a](/uploads/a.jpg)\n\n![b](/uploads/b.png)\n\n![c](/uploads/c.gif)\n"
+        )
+
+        with self.app.test_request_context():
+            fingerprinted = asset_utils.fingerprint_uploads(html)
+
+        srcset = ", ".join(
+            f"/uploads/a.jpg/{width}.jpg {width}w" for width in IMAGE_VARIANT_WIDTHS
+        )
+        self.assertIn(f'srcset="{srcset}"', fingerprinted)
+        self.assertIn(f'sizes="{asset_utils.POST_IMAGE_SIZES}"', fingerprinted)
+        self.assertIn("/uploads/b.png/640.webp 640w", fingerprinted)
+        self.assertEqual(fingerprinted.count("srcset="), 2, msg="Gifs are left whole")
+
+    def test_get_uploads_version(self):
+        self.assertIsNone(asset_utils.get_uploads_version())
+
+        os.mkdir(os.path.join(self.app.static_folder, "uploads"))
+        version = asset_utils.get_uploads_version()
+        os.utime(
+            os.path.join(self.app.static_folder, "uploads"),
+            ns=(version + 10**9, version + 10**9),
+        )
+
+        self.assertIsNotNone(version)
+        self.assertNotEqual(asset_utils.get_uploads_version(), version)
+
+
+class RenderUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        render_utils.render_block.cache_clear()
+        self.source = "\n\n".join(
+            [
+                "# Title",
+                "A paragraph\nwith a lazy line and ~~strike~~",
+                "- loose\n\n- list",
+                "```python\nx = 1\n\ny = 2\n```",
+                "> a quote\ncontinued",
+                "<div>\nhtml\n</div>",
+                "![30 for 30](https://www.youtube.com/watch?v=Lgwlta7ccnI)",
+                "Last [link](https://datathingsandstuff.com)",
+            ]
+        )
+
+    def test_render_source_matches_full_render(self):
+        for source in (self.source, self.source + "\n", "", None, "    code\n"):
+            self.assertEqual(
+                render_utils.render_source(source), render_utils.md.render(source or "")
+            )
+
+    def test_split_blocks(self):
+        blocks = render_utils.split_blocks("# Title\n\n- a\n\n- b\n\npara\n")
+
+        self.assertEqual(blocks, ["# Title\n", "- a\n\n- b\n\n", "para\n"])
+
+    def test_only_changed_blocks_are_rendered(self):
+        render_utils.render_source(self.source)
+        misses = render_utils.render_block.cache_info().misses
+
+        html = render_utils.render_source(
+            self.source.replace("A paragraph", "An edited paragraph")
+        )
+
+        self.assertEqual(render_utils.render_block.cache_info().misses, misses + 1)
+        self.assertIn("An edited paragraph", html)
+
+    def test_reference_definitions_render_whole_source(self):
+        source = "A [link][ref]\n\n[ref]: https://datathingsandstuff.com\n"
+
+        self.assertIsNone(render_utils.split_blocks(source))
+        self.assertIn(
+            'href="https://datathingsandstuff.com"', render_utils.render_source(source)
+        )
+
+    def test_render_source_normalizes_newlines(self):
+        self.assertEqual(
+            render_utils.render_source("# Title\r\n\r\npara\r\n"),
+            render_utils.md.render("# Title\n\npara\n"),
+        )
+
+
+class PreviewUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.preview_cache = preview_utils.PreviewCache(self.app)
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_apply_patch(self):
+        self.assertEqual(preview_utils.apply_patch("# Hey", 2, 5, "Yo"), "# Yo")
+        self.assertEqual(preview_utils.apply_patch("# Hey", "5", "5", "!"), "# Hey!")
+
+    def test_apply_patch_invalid(self):
+        for start, end, text in ((3, 2, ""), (0, 10, ""), ("a", 1, ""), (0, 1, None)):
+            with self.assertRaises(preview_utils.InvalidPatchError):
+                preview_utils.apply_patch("# Hey", start, end, text)
+
+    def test_preview_sessions_evicts_least_recently_used(self):
+        sessions = preview_utils.PreviewSessions(max_size=2)
+        sessions.set("a", 1)
+        sessions.set("b", 2)
+        sessions.get("a")
+
+        sessions.set("c", 3)
+
+        self.assertEqual(sessions.get("a"), 1)
+        self.assertIsNone(sessions.get("b"))
+        self.assertEqual(sessions.get("c"), 3)
+
+    @mock.patch("dtns.utils.render_utils.render_source")
+    def test_render_unchanged_source_is_not_rendered_again(self, mock_render_source):
+        mock_render_source.return_value = "<h1>Hey</h1>\n"
+
+        self.preview_cache.render("key", "# Hey")
+        preview = self.preview_cache.render("key", "# Hey")
+
+        mock_render_source.assert_called_once_with("# Hey")
+        self.assertEqual(preview.html, "<h1>Hey</h1>\n")
+
+    def test_get_source(self):
+        preview = self.preview_cache.render("key", "# Hey")
+
+        self.assertEqual(
+            self.preview_cache.get_source("key", {"source": "# Yo"}), "# Yo"
+        )
+        self.assertEqual(
+            self.preview_cache.get_source(
+                "key",
+                {"base_hash": preview.source_hash, "start": 5, "end": 5, "patch": "!"},
+            ),
+            "# Hey!",
+        )
+
+    def test_get_source_patch_multi_line_form_source(self):
+        # What the editor's text "# Hey\nthere\nyou" is posted as
+        source = self.preview_cache.get_source(
+            "key", {"source": "# Hey\r\nthere\r\nyou"}
+        )
+        preview = self.preview_cache.render("key", source)
+
+        patched = self.preview_cache.get_source(
+            "key",
+            {
+                "base_hash": preview.source_hash,
+                "start": 12,
+                "end": 15,
+                "patch": "all\r\n!",
+            },
+        )
+
+        self.assertEqual(preview.source, "# Hey\nthere\nyou")
+        self.assertEqual(patched, "# Hey\nthere\nall\n!")
+
+    def test_render_normalizes_newlines(self):
+        preview = self.preview_cache.render("key", "# Hey\r\nthere")
+
+        self.assertEqual(preview.source, "# Hey\nthere")
+        self.assertEqual(preview.source_hash, render_utils.hash_source("# Hey\nthere"))
+
+    def test_get_source_stale_patch(self):
+        self.preview_cache.render("key", "# Hey")
+        patch = {"base_hash": "nope", "start": 0, "end": 0, "patch": ""}
+
+        with self.assertRaises(preview_utils.StalePreviewError):
+            self.preview_cache.get_source("key", patch)
+        with self.assertRaises(preview_utils.StalePreviewError):
+            self.preview_cache.get_source("other", patch)
+
+
+class MailQueueUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app.config["MAIL_RETRY_DELAY"] = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.mail_queue = mail_queue_utils.MailQueue(self.app)
+        self.app.extensions["mail"].suppress = False
+        smtp_patcher = mock.patch("flask_mail.smtplib.SMTP")
+        self.mock_smtp = smtp_patcher.start()
+        self.addCleanup(smtp_patcher.stop)
+
+    def tearDown(self):
+        self.mail_queue.worker.stop()
+        self.app_context.pop()
+
+    def make_message(self, subject="Subject"):
+        return Message(subject, sender="from@test.com", recipients=["to@test.com"])
+
+    def test_messages_share_a_connection(self):
+        for i in range(3):
+            self.assertTrue(self.mail_queue.send(self.make_message(f"Subject {i}")))
+
+        self.mail_queue.join()
+
+        self.mock_smtp.assert_called_once()
+        self.assertEqual(self.mock_smtp.return_value.sendmail.call_count, 3)
+
+    def test_failed_send_reconnects_and_retries(self):
+        self.mock_smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPServerDisconnected(),
+            None,
+        ]
+
+        self.mail_queue.send(self.make_message())
+        self.mail_queue.join()
+
+        self.assertEqual(self.mock_smtp.call_count, 2)
+        self.assertEqual(self.mock_smtp.return_value.sendmail.call_count, 2)
+
+    def test_gives_up_after_max_attempts(self):
+        self.mock_smtp.return_value.sendmail.side_effect = smtplib.SMTPException()
+
+        with mock.patch("dtns.utils.mail_queue_utils.time.sleep") as mock_sleep:
+            self.mail_queue.send(self.make_message())
+            self.mail_queue.join()
+
+        max_attempts = self.app.config["MAIL_MAX_ATTEMPTS"]
+        self.assertEqual(self.mock_smtp.return_value.sendmail.call_count, max_attempts)
+        self.assertEqual(mock_sleep.call_count, max_attempts - 1)
+
+    def test_full_queue_drops_message(self):
+        worker = mail_queue_utils.MailWorker(self.app)
+        worker.queue = mail_queue_utils.queue.Queue(maxsize=1)
+        worker.put_timeout = 0.01
+
+        with mock.patch.object(worker, "_ensure_started"):
+            self.assertTrue(worker.put(self.make_message()))
+            self.assertFalse(worker.put(self.make_message()))
+
+    def test_dead_worker_is_restarted(self):
+        worker = self.mail_queue.worker
+        self.mail_queue.send(self.make_message("Subject 0"))
+        thread = worker._thread
+        # Ends the thread without stop(), as an unexpected error would
+        worker.queue.put(mail_queue_utils.STOP)
+        thread.join()
+
+        self.assertTrue(self.mail_queue.send(self.make_message("Subject 1")))
+
+        self.assertTrue(worker._thread.is_alive())
+        self.mail_queue.join()
+        self.assertEqual(self.mock_smtp.return_value.sendmail.call_count, 2)
+
+    def test_stop_sends_queued_messages(self):
+        for i in range(5):
+            self.mail_queue.send(self.make_message(f"Subject {i}"))
+
+        self.mail_queue.worker.stop()
+
+        self.assertEqual(self.mock_smtp.return_value.sendmail.call_count, 5)
+        self.mock_smtp.return_value.quit.assert_called_once()
+
+
+class EmailUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app.config["SITE_ADMIN"] = "admin@test.com"
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        post = Post(title="title 1", slug="slug-1", source="# Post 1")
+        self.comments = []
+        for i in range(3):
+            user = User(email=f"test_{i}@test.com", username=f"user_{i}", password="p")
+            self.comments.append(Comment(text=f"Comment {i}", user=user, post=post))
+        db.session.add_all(self.comments)
+        db.session.commit()
+
+    def tearDown(self):
+        self.app.extensions["mail_queue"].stop()
+        db.session.commit()
+        db.drop_all()
+        self.app_context.pop()
+
+    def send_notifs(self, comments):
+        with mail.record_messages() as outbox:
+            with self.app.test_request_context(base_url="https://dtns.test/"):
+                for comment in comments:
+                    email_utils.send_new_comment_notif(comment)
+            self.app.extensions["mail_queue"].join()
+        return outbox
+
+    def test_send_new_comment_notif(self):
+        outbox = self.send_notifs(self.comments[:1])
+
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox[0].subject, "New Comment from: user_0")
+        self.assertEqual(outbox[0].recipients, ["admin@test.com"])
+        self.assertIn("Comment 0", outbox[0].html)
+        self.assertIn("https://dtns.test/post/slug-1", outbox[0].html)
+        self.assertIsNotNone(self.comments[0].notified_at)
+
+    def test_send_new_comment_notif_digest_needs_job_queue(self):
+        self.app.config["COMMENT_DIGEST_INTERVAL"] = 60
+
+        outbox = self.send_notifs(self.comments)
+
+        self.assertEqual(len(outbox), 3)
+
+    def test_send_new_comment_notif_renders_off_request_thread(self):
+        render_threads = []
+        render_template = email_utils.render_template
+
+        def record_thread(*args, **kwargs):
+            render_threads.append(threading.get_ident())
+            return render_template(*args, **kwargs)
+
+        with mock.patch("dtns.utils.email_utils.render_template", record_thread):
+            self.send_notifs(self.comments[:1])
+
+        self.assertEqual(len(render_threads), 1)
+        self.assertNotEqual(render_threads[0], threading.get_ident())
+
+
+class JobUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app.config["JOB_QUEUE_ENABLED"] = True
+        self.app.config["JOB_MAX_ATTEMPTS"] = 2
+        self.app.config["SITE_ADMIN"] = "admin@test.com"
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.worker = job_utils.JobWorker(self.app)
+        self.calls = []
+
+        tasks_patcher = mock.patch.dict(job_utils.TASKS)
+        tasks_patcher.start()
+        self.addCleanup(tasks_patcher.stop)
+
+        @job_utils.task("record")
+        def record(**kwargs):
+            self.calls.append(kwargs)
+
+        @job_utils.task("fail")
+        def fail():
+            raise RuntimeError("Broken")
+
+    def tearDown(self):
+        db.session.commit()
+        db.drop_all()
+        self.app_context.pop()
+
+    def enqueue(self, name, **kwargs):
+        job_utils.enqueue(name, **kwargs)
+        db.session.commit()
+
+    def test_worker_runs_and_removes_jobs(self):
+        self.enqueue("record", n=1)
+        self.enqueue("record", n=2)
+
+        self.worker.run(burst=True)
+
+        self.assertEqual(self.calls, [{"n": 1}, {"n": 2}])
+        self.assertEqual(self.worker.num_done, 2)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_delayed_job_waits(self):
+        self.enqueue("record", delay=60)
+
+        self.worker.run(burst=True)
+        self.assertEqual(self.calls, [])
+
+        with freeze_time(datetime.utcnow() + timedelta(seconds=61)):
+            self.worker.run(burst=True)
+        self.assertEqual(self.calls, [{}])
+
+    def test_unique_job_is_queued_once(self):
+        for _ in range(2):
+            self.enqueue("record", unique=True, n=1)
+        self.enqueue("record", unique=True, n=2)
+
+        self.assertEqual(Job.query.count(), 2)
+
+    def test_claimed_job_is_hidden_until_visibility_timeout(self):
+        self.enqueue("record")
+
+        self.assertEqual(len(self.worker.claim()), 1)
+        self.assertEqual(self.worker.claim(), [])
+
+        later = datetime.utcnow() + timedelta(
+            seconds=self.app.config["JOB_VISIBILITY_TIMEOUT"] + 1
+        )
+        with freeze_time(later):
+            jobs = self.worker.claim()
+
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0].state, JobState.RUNNING)
+        self.assertEqual(jobs[0].attempts, 2)
+
+    def test_failed_job_is_retried_then_kept(self):
+        self.enqueue("fail")
+
+        self.worker.run(burst=True)
+        job = Job.query.one()
+        self.assertEqual(job.state, JobState.QUEUED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("RuntimeError: Broken", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        with freeze_time(job.run_at + timedelta(seconds=1)):
+            self.worker.run(burst=True)
+        db.session.expire_all()
+        job = Job.query.one()
+        self.assertEqual(job.state, JobState.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(self.worker.num_failed, 1)
+
+        with freeze_time(job.run_at + timedelta(days=1)):
+            self.worker.run(burst=True)
+        self.assertEqual(Job.query.one().attempts, 2)
+
+    def test_unknown_task_fails(self):
+        self.enqueue("missing")
+
+        self.worker.run(burst=True)
+
+        self.assertIn("UnknownTaskError", Job.query.one().last_error)
+
+    def test_finish_after_claim_taken_over(self):
+        self.enqueue("record")
+        (job,) = self.worker.claim()
+        db.session.execute(
+            Job.__table__.update().values(run_at=job.run_at + timedelta(1))
+        )
+        db.session.commit()
+
+        self.worker.run_job(job)
+
+        self.assertEqual(Job.query.count(), 1, msg="Job was taken over, so kept")
+
+    def create_comment(self, text):
+        post = Post(title="title 1", slug="slug-1", source="# Post 1")
+        db.session.add(post)
+        db.session.commit()
+        with self.app.test_request_context(base_url="https://dtns.test/"):
+            CommentModelStorage.create_comment(
+                {"email": "a@test.com", "username": "a", "comment": text, "post": post}
+            )
+        return Comment.query.one()
+
+    def test_comment_language_checked_by_job(self):
+        from dtns import tasks  # noqa: F401
+
+        comment = self.create_comment("Estoy muy feliz de ver este blog hoy amigos")
+        self.assertEqual(comment.state, CommentState.PENDING)
+        self.assertEqual(Job.query.filter_by(name="check-comment-language").count(), 1)
+
+        with mock.patch("dtns.utils.lang_utils.detect_language", return_value="es"):
+            self.worker.run(burst=True)
+
+        self.assertEqual(Comment.query.one().state, CommentState.HIDDEN)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_comment_notif_sent_by_job(self):
+        from dtns import tasks  # noqa: F401
+
+        comment = self.create_comment("I really enjoyed reading this post")
+        self.assertEqual(comment.state, CommentState.PENDING)
+
+        with mock.patch("dtns.utils.lang_utils.detect_language", return_value="en"):
+            with mail.record_messages() as outbox:
+                self.worker.run(burst=True)
+
+        self.assertEqual(Comment.query.one().state, CommentState.VISIBLE)
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox[0].subject, "New Comment from: a")
+        self.assertIn("https://dtns.test/post/slug-1", outbox[0].html)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_comment_digest_sent_by_job(self):
+        from dtns import tasks  # noqa: F401
+
+        self.app.config["COMMENT_DIGEST_INTERVAL"] = 60
+        post = Post(title="title 1", slug="slug-1", source="# Post 1")
+        user = User(email="a@test.com", username="a", password="p")
+        comments = [
+            Comment(text=f"Comment {i}", user=user, post=post) for i in range(3)
+        ]
+        notified = Comment(
+            text="Old comment", user=user, post=post, notified_at=datetime.utcnow()
+        )
+        hidden = Comment(
+            text="Hidden comment", user=user, post=post, state=CommentState.HIDDEN
+        )
+        db.session.add_all(comments + [notified, hidden])
+        db.session.commit()
+
+        with self.app.test_request_context(base_url="https://dtns.test/"):
+            for comment in comments:
+                email_utils.send_new_comment_notif(comment)
+                db.session.commit()
+
+        (job,) = Job.query.filter_by(name="send-comment-digest").all()
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        db.session.execute(
+            Job.__table__.update()
+            .where(Job.id == job.id)
+            .values(run_at=job.run_at - timedelta(seconds=60))
+        )
+        db.session.commit()
+        with mail.record_messages() as outbox:
+            self.worker.run(burst=True)
+
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox[0].subject, "3 New Comments")
+        for i in range(3):
+            self.assertIn(f"Comment {i}", outbox[0].html)
+        self.assertEqual(outbox[0].html.count("/admin/comment/toggle/"), 3)
+        self.assertNotIn("Old comment", outbox[0].html)
+        self.assertNotIn("Hidden comment", outbox[0].html)
+        self.assertEqual(CommentModelStorage.get_ids_to_notify(), [])
+        self.assertEqual(Job.query.filter_by(name="send-comment-digest").count(), 0)
+
+    def test_draft_rendered_by_job(self):
+        from dtns import tasks  # noqa: F401
+
+        post = Post(title="title 1", slug="slug-1", source="# Post 1")
+        db.session.add(post)
+        db.session.commit()
+        post_id = post.id
+        self.assertIsNone(post.html)
+
+        PostModelStorage.edit_post(
+            post_id,
+            {
+                "title": "title 1",
+                "slug": "slug-1",
+                "description": None,
+                "source": "# Post 2",
+            },
+        )
+        self.assertEqual(Job.query.count(), 1, msg="Render job is only queued once")
+
+        self.worker.run(burst=True)
+
+        post = PostModelStorage.get(post_id)
+        self.assertEqual(post.html, "<h1>Post 2</h1>\n")
+        self.assertFalse(post.is_html_stale)
+
+    def test_published_post_rendered_inline(self):
+        post = Post(title="title 1", slug="slug-1", source="# Post 1")
+        db.session.add(post)
+        db.session.commit()
+
+        PostModelStorage.publish_post(post.id)
+
+        self.assertEqual(post.html, "<h1>Post 1</h1>\n")